@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Асинхронный конвейер: Тинькофф (AsyncClient) → Supabase и Yandex S3 одновременно
+Страницы операций загружаются в Supabase и S3, пока следующие страницы еще скачиваются
+"""
+
+import asyncio
+import csv
+import datetime
+import io
+import logging
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+import httpx
+from tinkoff.invest import AsyncClient, GetOperationsByCursorRequest
+
+from invest import (
+    CSV_FIELDNAMES,
+    DEFAULT_FETCH_CONCURRENCY,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_WATERMARK_OVERLAP,
+    OperationRecord,
+    _advance_watermark,
+    _newest_date_msk,
+    add_to_totals,
+    enrich_records,
+    new_totals,
+    _pick_accounts,
+    _resolve_range,
+    record_to_row,
+    record_to_supabase,
+    to_record,
+)
+from instruments import get_instrument_resolver
+from rate_limit import get_rate_limiter
+from s3_exports import new_compressor, upload_args
+from supabase_client import http_client_options
+from upsert_engine import (
+    CONFLICT_COLUMNS,
+    get_upsert_concurrency,
+    HASH_COLUMN,
+    HASH_LOOKUP_CHUNK,
+    PARTITION_COLUMN,
+    lookup_key,
+    new_counts,
+    partition_bounds,
+    row_hash,
+    split_changed,
+)
+
+if TYPE_CHECKING:
+    from outbox import Outbox
+
+# Сколько страниц может ждать медленного потребителя, прежде чем выгрузка притормозит
+QUEUE_PAGES = 8
+# Минимальный размер части multipart upload в S3 (кроме последней)
+S3_PART_SIZE = 5 * 1024 * 1024
+
+Page = List[OperationRecord]
+# Вместо None (конец выгрузки): выгрузка упала, результат неполный
+FETCH_FAILED = object()
+
+
+class FetchFailed(RuntimeError):
+    """Выгрузка операций упала: неполный CSV нельзя публиковать"""
+
+
+def _signal_failure(queues: List[asyncio.Queue]) -> None:
+    # Без ожидания: потребитель может уже не читать очередь. Если она полна,
+    # одна страница выбрасывается — результат все равно неполный
+    for queue in queues:
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(FETCH_FAILED)
+
+
+async def _fetch_account(
+    client: AsyncClient,
+    account_id: str,
+    days_back: int,
+    watermarks: Optional[Dict[str, str]],
+    overlap: datetime.timedelta,
+    page_size: int,
+    queues: List[asyncio.Queue],
+) -> int:
+    start_date, end_date = _resolve_range(days_back, account_id, watermarks, overlap)
+    logging.info("Streaming operations of account %s from %s to %s", account_id, start_date, end_date)
+
+    cursor = ""
+    newest = ""
+    total = 0
+    while True:
+        response = await get_rate_limiter().acall(
+            "get_operations_by_cursor",
+            client.operations.get_operations_by_cursor,
+            GetOperationsByCursorRequest(
+                account_id=account_id,
+                from_=start_date,
+                to=end_date,
+                cursor=cursor,
+                limit=page_size,
+                without_trades=True,
+            ),
+        )
+        page = [to_record(item, account_id) for item in response.items]
+        resolver = get_instrument_resolver()
+        if resolver is not None and page:
+            page = enrich_records(page, await resolver.aresolve(client, {record.figi for record in page}))
+        if page:
+            newest = max(newest, _newest_date_msk(page))
+            total += len(page)
+            for queue in queues:
+                await queue.put(page)
+
+        if not response.has_next:
+            break
+        cursor = response.next_cursor
+
+    _advance_watermark(watermarks, account_id, newest)
+    return total
+
+
+async def _produce(
+    invest_token: str,
+    days_back: int,
+    watermarks: Optional[Dict[str, str]],
+    overlap: datetime.timedelta,
+    page_size: int,
+    account_ids: Optional[Iterable[str]],
+    max_workers: int,
+    queues: List[asyncio.Queue],
+) -> int:
+    try:
+        async with AsyncClient(invest_token) as client:
+            response = await get_rate_limiter().acall("get_accounts", client.users.get_accounts)
+            selected = _pick_accounts(response.accounts, account_ids)
+            semaphore = asyncio.Semaphore(max(1, max_workers))
+
+            async def fetch(account_id: str) -> int:
+                async with semaphore:
+                    return await _fetch_account(
+                        client, account_id, days_back, watermarks, overlap, page_size, queues
+                    )
+
+            totals = await asyncio.gather(*(fetch(account_id) for account_id in selected))
+    except BaseException:
+        # В том числе отмена: потребители должны узнать, что данные неполные
+        _signal_failure(queues)
+        raise
+    for queue in queues:
+        await queue.put(None)
+    return sum(totals)
+
+
+async def _upsert_pages(
+    queue: asyncio.Queue, supabase_url: str, supabase_key: str, concurrency: int, outbox: Optional["Outbox"]
+) -> Dict[str, int]:
+    """Upsert страниц в tinkoff_operations через PostgREST, до concurrency запросов одновременно"""
+    headers = {
+        "apikey": supabase_key,
+        "Authorization": f"Bearer {supabase_key}",
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    }
+    result = {"loaded": 0, "failed": 0, "queued": 0, **new_counts()}
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    key = lookup_key(CONFLICT_COLUMNS)
+
+    async with httpx.AsyncClient(
+        base_url=f"{supabase_url.rstrip('/')}/rest/v1",
+        headers=headers,
+        **http_client_options(max(1, concurrency)),
+    ) as http:
+
+        async def stored_hashes(rows: List[Dict]) -> Dict[str, Optional[str]]:
+            stored: Dict[str, Optional[str]] = {}
+            for i in range(0, len(rows), HASH_LOOKUP_CHUNK):
+                chunk = rows[i:i + HASH_LOOKUP_CHUNK]
+                keys = ",".join(f'"{row[key]}"' for row in chunk)
+                params = [("select", f"{key},{HASH_COLUMN}"), (key, f"in.({keys})")]
+                bounds = partition_bounds(chunk, CONFLICT_COLUMNS)
+                if bounds:
+                    # Только секции с датами пачки
+                    params += [(PARTITION_COLUMN, f"gte.{bounds[0]}"), (PARTITION_COLUMN, f"lte.{bounds[1]}")]
+                response = await http.get("/tinkoff_operations", params=params)
+                response.raise_for_status()
+                stored.update((row[key], row[HASH_COLUMN]) for row in response.json())
+            return stored
+
+        async def send(page: Page) -> None:
+            try:
+                rows = []
+                for record in page:
+                    row = record_to_supabase(record)
+                    row[HASH_COLUMN] = row_hash(row)
+                    rows.append(row)
+                # Как в upsert_engine: неизмененные строки не отправляются
+                counts = new_counts()
+                changed = split_changed(rows, await stored_hashes(rows), key, counts)
+                if changed:
+                    response = await http.post(
+                        "/tinkoff_operations",
+                        params={"on_conflict": CONFLICT_COLUMNS},
+                        json=changed,
+                    )
+                    response.raise_for_status()
+                for name, count in counts.items():
+                    result[name] += count
+                result["loaded"] += len(page)
+            except Exception as e:
+                logging.error(f"Ошибка загрузки пачки из {len(page)} операций в Supabase: {e}")
+                result["failed"] += len(page)
+                if outbox is not None:
+                    outbox.append("tinkoff_operations", CONFLICT_COLUMNS, [record_to_supabase(record) for record in page])
+                    result["queued"] += len(page)
+            finally:
+                semaphore.release()
+
+        tasks = []
+        while True:
+            page = await queue.get()
+            # Уже полученные страницы записываются и при сбое выгрузки: upsert идемпотентен
+            if page is None or page is FETCH_FAILED:
+                break
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(send(page)))
+        await asyncio.gather(*tasks)
+
+    return result
+
+
+async def _write_pages(
+    queue: asyncio.Queue, filepath: str, s3_client, bucket_name: Optional[str], key: str, compression: str
+) -> Dict[str, int]:
+    """Пишет страницы в локальный CSV и параллельно отправляет в S3 частями multipart upload.
+
+    Локальный CSV остается несжатым; в S3 части уходят уже сжатыми (compression).
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDNAMES)
+    writer.writeheader()
+    upload_id = None
+    parts = []
+    # Итоги считаются здесь же, чтобы не перечитывать CSV
+    totals = new_totals()
+    compressor = new_compressor(compression) if compression != "none" else None
+
+    async def flush_part(data: bytes) -> None:
+        nonlocal upload_id
+        if upload_id is None:
+            created = await asyncio.to_thread(
+                s3_client.create_multipart_upload, Bucket=bucket_name, Key=key, **upload_args(compression)
+            )
+            upload_id = created["UploadId"]
+        number = len(parts) + 1
+        uploaded = await asyncio.to_thread(
+            s3_client.upload_part, Bucket=bucket_name, Key=key, UploadId=upload_id, PartNumber=number, Body=data
+        )
+        parts.append({"ETag": uploaded["ETag"], "PartNumber": number})
+
+    pending = b""
+    try:
+        with open(filepath, "wb") as f:
+            while True:
+                page = await queue.get()
+                if page is None:
+                    break
+                if page is FETCH_FAILED:
+                    raise FetchFailed(f"operations fetch failed, {key or filepath} is not published")
+                writer.writerows(record_to_row(record) for record in page)
+                add_to_totals(totals, page)
+                chunk = buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                f.write(chunk)
+                if s3_client is None:
+                    continue
+                pending += compressor.compress(chunk) if compressor is not None else chunk
+                if len(pending) >= S3_PART_SIZE:
+                    await flush_part(pending)
+                    pending = b""
+
+            # Заголовок пустого файла или хвост последней страницы
+            chunk = buffer.getvalue().encode("utf-8")
+            f.write(chunk)
+            if s3_client is not None:
+                pending += chunk if compressor is None else compressor.compress(chunk) + compressor.flush()
+
+        if s3_client is not None:
+            if upload_id is None:
+                await asyncio.to_thread(
+                    s3_client.put_object, Bucket=bucket_name, Key=key, Body=pending, **upload_args(compression)
+                )
+            else:
+                if pending:
+                    await flush_part(pending)
+                await asyncio.to_thread(
+                    s3_client.complete_multipart_upload,
+                    Bucket=bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+    except BaseException:
+        # И при отмене: незавершенная multipart-загрузка иначе остается в бакете
+        if upload_id is not None:
+            await asyncio.to_thread(
+                s3_client.abort_multipart_upload, Bucket=bucket_name, Key=key, UploadId=upload_id
+            )
+        raise
+    return totals
+
+
+async def run_pipeline(
+    invest_token: str,
+    days_back: int,
+    filepath: str,
+    watermarks: Optional[Dict[str, str]] = None,
+    overlap: datetime.timedelta = DEFAULT_WATERMARK_OVERLAP,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    account_ids: Optional[Iterable[str]] = None,
+    max_workers: int = DEFAULT_FETCH_CONCURRENCY,
+    s3_client=None,
+    bucket_name: Optional[str] = None,
+    s3_key: Optional[str] = None,
+    supabase_url: Optional[str] = None,
+    supabase_key: Optional[str] = None,
+    upsert_concurrency: Optional[int] = None,
+    outbox: Optional["Outbox"] = None,
+    compression: str = "none",
+) -> Dict[str, int]:
+    """Выгрузка, запись CSV/S3 и upsert в Supabase, перекрывающиеся во времени.
+
+    Каждая страница GetOperationsByCursor раздается всем потребителям через
+    ограниченные очереди. Водяные знаки сдвигаются в watermarks на месте, как в
+    fetch_operations; сохранять их вызывающий должен только когда все
+    незаписанные страницы попали в outbox (failed == queued).
+
+    Если выгрузка упала или отменена, объект в S3 не публикуется (multipart
+    upload отменяется), а исключение выгрузки поднимается дальше.
+
+    Upsert идет только через PostgREST, до ``upsert_concurrency`` (по умолчанию
+    UPSERT_CONCURRENCY) запросов одновременно; UPSERT_BACKEND=copy конвейер не
+    поддерживает — в этом случае вызывающий не передает supabase_url и грузит
+    CSV через upsert_rows после конвейера.
+    """
+    if upsert_concurrency is None:
+        upsert_concurrency = get_upsert_concurrency()
+    csv_queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_PAGES)
+    queues = [csv_queue]
+    upsert_queue: Optional[asyncio.Queue] = None
+    if supabase_url and supabase_key:
+        upsert_queue = asyncio.Queue(maxsize=QUEUE_PAGES)
+        queues.append(upsert_queue)
+
+    consumers = [_write_pages(csv_queue, filepath, s3_client, bucket_name, s3_key or "", compression)]
+    if upsert_queue is not None:
+        consumers.append(_upsert_pages(upsert_queue, supabase_url, supabase_key, upsert_concurrency, outbox))
+
+    fetched, totals, *upserted = await asyncio.gather(
+        _produce(invest_token, days_back, watermarks, overlap, page_size, account_ids, max_workers, queues),
+        *consumers,
+    )
+    upsert_result = upserted[0] if upserted else {"loaded": 0, "failed": 0, "queued": 0, **new_counts()}
+    logging.info(
+        "Async pipeline: fetched %d, written %d, upserted %d (%d new, %d changed, %d unchanged), failed %d",
+        fetched,
+        totals["count"],
+        upsert_result["loaded"],
+        upsert_result["inserted"],
+        upsert_result["updated"],
+        upsert_result["unchanged"],
+        upsert_result["failed"],
+    )
+    return {"fetched": fetched, "totals": totals, **upsert_result}
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк конвертации операций
+Сравнивает прежний построчный конвертер (Decimal, словари строк, float() в
+итогах) с OperationRecord + to_record + add_to_totals
+
+Запуск: python3 bench_operations.py [число_операций]
+"""
+
+import datetime
+import sys
+import timeit
+from decimal import Decimal, ROUND_HALF_UP
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+from tinkoff.invest import OperationState, OperationType
+
+from invest import add_to_totals, new_totals, record_to_row, to_record
+
+
+def _legacy_money(money_obj: object) -> str:
+    units = getattr(money_obj, "units", 0)
+    nano = getattr(money_obj, "nano", 0)
+    sign = -1 if units < 0 or nano < 0 else 1
+    total = (Decimal(abs(units)) + (Decimal(abs(nano)) / Decimal(1_000_000_000))) * sign
+    return str(total.quantize(Decimal("0.00"), rounding=ROUND_HALF_UP))
+
+
+def _legacy_type(op_type: object) -> str:
+    name = getattr(op_type, "name", str(op_type))
+    mapping = {
+        "OPERATION_TYPE_BUY": "Покупка ценных бумаг",
+        "OPERATION_TYPE_SELL": "Продажа ценных бумаг",
+        "OPERATION_TYPE_BROKER_FEE": "Комиссия брокера",
+        "OPERATION_TYPE_DIVIDEND": "Выплата дивидендов",
+        "OPERATION_TYPE_COUPON": "Выплата купона",
+        "OPERATION_TYPE_INPUT": "Ввод денежных средств",
+        "OPERATION_TYPE_OUTPUT": "Вывод денежных средств",
+    }
+    return mapping.get(name, name)
+
+
+def _legacy_state(state: object) -> str:
+    name = getattr(state, "name", str(state))
+    mapping = {
+        "OPERATION_STATE_EXECUTED": "Проведена",
+        "OPERATION_STATE_DECLINED": "Отклонена",
+        "OPERATION_STATE_PROGRESS": "В обработке",
+    }
+    return mapping.get(name, name)
+
+
+def legacy_run(operations):
+    """Прежний путь: строка-словарь на операцию и три прохода float() в итогах"""
+    msk = ZoneInfo("Europe/Moscow")
+    rows = []
+    for op in operations:
+        rows.append({
+            "operation_id": str(op.id),
+            "account_id": "",
+            "date_msk": op.date.astimezone(msk).strftime("%Y-%m-%d %H:%M:%S"),
+            "action": _legacy_type(op.type),
+            "amount": _legacy_money(op.payment),
+            "currency": str(op.payment.currency),
+            "status": _legacy_state(op.state),
+            "description": str(op.description),
+        })
+    total = sum(float(row["amount"]) for row in rows)
+    positive = sum(1 for row in rows if float(row["amount"]) > 0)
+    negative = sum(1 for row in rows if float(row["amount"]) < 0)
+    return rows, total, positive, negative
+
+
+def record_run(operations):
+    records = [to_record(op) for op in operations]
+    totals = new_totals()
+    add_to_totals(totals, records)
+    return records, totals
+
+
+def make_operations(count: int):
+    types = [OperationType.OPERATION_TYPE_BUY, OperationType.OPERATION_TYPE_SELL,
+             OperationType.OPERATION_TYPE_DIVIDEND, OperationType.OPERATION_TYPE_BROKER_FEE]
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        SimpleNamespace(
+            id=str(100000 + i),
+            date=start + datetime.timedelta(minutes=i),
+            type=types[i % len(types)],
+            state=OperationState.OPERATION_STATE_EXECUTED,
+            payment=SimpleNamespace(units=(i % 5000) - 2500, nano=(i * 7919) % 1_000_000_000, currency="rub"),
+            description="Операция по счету",
+        )
+        for i in range(count)
+    ]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    operations = make_operations(count)
+
+    # Результаты должны совпадать, иначе сравнение бессмысленно
+    rows, total, _, _ = legacy_run(operations)
+    records, totals = record_run(operations)
+    assert [row["amount"] for row in rows] == [record_to_row(r)["amount"] for r in records]
+    assert round(total, 2) == totals["amount_minor"] / 100
+
+    legacy = min(timeit.repeat(lambda: legacy_run(operations), number=1, repeat=5))
+    current = min(timeit.repeat(lambda: record_run(operations), number=1, repeat=5))
+    sink = min(timeit.repeat(lambda: [record_to_row(r) for r in records], number=1, repeat=5))
+
+    print(f"Операций: {count}")
+    print(f"• Прежний конвертер + итоги: {legacy / count * 1e6:.2f} мкс/операция")
+    print(f"• to_record + add_to_totals:  {current / count * 1e6:.2f} мкс/операция")
+    print(f"• record_to_row (на стоке):   {sink / count * 1e6:.2f} мкс/операция")
+    print(f"• Ускорение: {legacy / current:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
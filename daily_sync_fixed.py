@@ -5,21 +5,47 @@
 """
 
 import os
-import csv
+import asyncio
 import logging
 import tempfile
 from datetime import datetime
-from typing import List, Dict
+from typing import Dict, Iterable, Optional
 
 # Импортируем функции из существующего invest.py
 from invest import (
-    get_env_variable, 
-    fetch_operations, 
+    fetch_records, 
     write_csv,
-    upload_to_yandex_s3
+    upload_to_yandex_s3,
+    iter_records,
+    read_csv,
+    record_to_row,
+    record_to_supabase,
+    row_to_supabase,
+    new_totals,
+    add_to_totals,
+    track_totals,
+    get_page_size,
+    get_account_ids,
+    get_fetch_concurrency,
+    create_s3_client,
+    load_watermarks,
+    save_watermarks,
+    watermark_from_supabase,
+    get_watermark_overlap
 )
 
-from supabase import create_client, Client
+from async_pipeline import run_pipeline
+from instruments import get_instrument_resolver
+from migrations import ensure_schema
+from operations_cache import get_operations_cache
+from outbox import Outbox, get_outbox
+from rate_limit import get_rate_limiter
+from parquet_export import export_parquet, get_export_parquet, parquet_name
+from s3_exports import compressed_key, export_key, get_export_compression
+from supabase_client import get_supabase_client
+from supabase_stats import empty_stats, fetch_stats
+from upsert_engine import get_upsert_backend, get_upsert_batch_size, get_upsert_concurrency, upsert_rows
+from supabase import Client
 
 
 def load_env_from_file(filename='config.env'):
@@ -41,7 +67,7 @@ def load_env_from_file(filename='config.env'):
 
 
 def setup_supabase():
-    """Настройка Supabase"""
+    """Настройка Supabase; ошибка миграции схемы останавливает синхронизацию"""
     try:
         supabase_url = os.environ.get("SUPABASE_URL")
         supabase_key = os.environ.get("SUPABASE_KEY")
@@ -50,68 +76,86 @@ def setup_supabase():
             logging.error("SUPABASE_URL или SUPABASE_KEY не настроены")
             return None
         
-        supabase = create_client(supabase_url, supabase_key)
+        supabase = get_supabase_client(supabase_url, supabase_key)
         logging.info("Supabase подключен")
-        return supabase
         
     except Exception as e:
         logging.error(f"Ошибка подключения к Supabase: {e}")
         return None
+    
+    # Upsert идет по (operation_id, date_msk): без миграций каждая пачка отклоняется.
+    # При актуальном локальном маркере — без единого запроса к базе
+    ensure_schema(supabase)
+    return supabase
 
 
-def upload_to_supabase(supabase: Client, операции: List[Dict]) -> int:
-    """Загрузка операций в Supabase"""
+def upload_to_supabase(supabase: Client, строки: Iterable[Dict], outbox: Optional[Outbox] = None) -> Dict[str, float]:
+    """Загрузка строк в формате таблицы (record_to_supabase/row_to_supabase) пачками параллельно"""
     try:
-        if not операции:
+        результат = upsert_rows(
+            supabase, строки, batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency(),
+            outbox=outbox,
+        )
+        if not результат['loaded'] and not результат['failed']:
             logging.warning("Нет операций для загрузки")
-            return 0
-        
-        # Преобразуем данные для Supabase
-        supabase_data = []
-        for операция in операции:
-            supabase_data.append({
-                'operation_id': операция['operation_id'],
-                'date_msk': операция['date_msk'],
-                'action': операция['action'],
-                'amount': float(операция['amount']),
-                'currency': операция['currency'],
-                'status': операция['status'],
-                'description': операция['description']
-            })
-        
-        # Загружаем данные в Supabase (upsert - обновляем существующие)
-        result = supabase.table('tinkoff_operations').upsert(
-            supabase_data, 
-            on_conflict='operation_id'
-        ).execute()
-        
-        загружено = len(result.data)
-        logging.info(f"Загружено {загружено} операций в Supabase")
-        
-        return загружено
+        else:
+            logging.info(f"Загружено {результат['loaded']} операций в Supabase "
+                         f"({результат['rows_per_sec']:.0f} строк/с)")
+        return результат
         
     except Exception as e:
         logging.error(f"Ошибка загрузки в Supabase: {e}")
-        return 0
+        return {'loaded': 0, 'failed': 0, 'queued': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0,
+                'rows_per_sec': 0.0}
+
+
+def drain_outbox(supabase: Client, outbox: Outbox) -> None:
+    """Отправка пачек, не записанных в прошлых запусках, раньше новых данных"""
+    ожидает = outbox.pending()
+    if not ожидает:
+        return
+    logging.info(f"В локальной очереди {ожидает} неотправленных строк, отправляем их первыми")
+    try:
+        итог = outbox.drain(supabase, batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency())
+        logging.info(f"Из очереди отправлено {итог['replayed']} строк, осталось {итог['remaining']}")
+        if итог['dead']:
+            logging.error(f"Отложено после {outbox.max_attempts} неудач: {итог['dead']} строк (см. {outbox.path})")
+    except Exception as e:
+        logging.error(f"Ошибка отправки локальной очереди: {e}")
 
 
 def get_supabase_stats(supabase: Client) -> Dict:
-    """Получение статистики из Supabase"""
+    """Получение статистики из Supabase (серверный агрегат, без чтения таблицы)"""
     try:
-        result = supabase.table('tinkoff_operations').select('*', count='exact').execute()
-        total = result.count if result.count else 0
-        
-        last_op = supabase.table('tinkoff_operations').select('date_msk').order('date_msk', desc=True).limit(1).execute()
-        last_update = last_op.data[0]['date_msk'] if last_op.data else ''
-        
-        return {
-            'total': total,
-            'last_update': last_update
-        }
+        return fetch_stats(supabase)
         
     except Exception as e:
         logging.error(f"Ошибка получения статистики: {e}")
-        return {'total': 0, 'last_update': ''}
+        return empty_stats()
+
+
+def load_sync_watermarks(supabase: Optional[Client]) -> Optional[Dict[str, str]]:
+    """Водяные знаки для инкрементальной загрузки (None — полная выгрузка)"""
+    if os.environ.get("FULL_SYNC", "").lower() in ("1", "true", "yes"):
+        logging.info("FULL_SYNC включен, загружаем всю историю")
+        return None
+    if not supabase:
+        # Без Supabase строки никуда не накапливаются: выгрузка в S3 должна быть полной
+        logging.info("Supabase не настроен, загружаем всю историю без водяных знаков")
+        return None
+    
+    state_file = os.environ.get("SYNC_STATE_FILE", "sync_state.json")
+    watermarks = load_watermarks(state_file)
+    if not watermarks:
+        # Первый запуск на этой машине: берем max(date_msk) из Supabase
+        try:
+            watermarks = watermark_from_supabase(supabase)
+        except Exception as e:
+            logging.warning(f"Не удалось получить водяной знак из Supabase: {e}")
+    
+    if watermarks:
+        logging.info(f"Инкрементальная загрузка, водяные знаки: {watermarks}")
+    return watermarks
 
 
 def daily_sync():
@@ -147,57 +191,161 @@ def daily_sync():
             logging.error("Не все обязательные переменные настроены")
             return False
         
+        supabase = setup_supabase()
+        outbox = get_outbox() if supabase else None
+        if outbox is not None:
+            drain_outbox(supabase, outbox)
+        # Пока очередь не разобрана, новые строки встают за ней (см. upsert_rows)
+        очередь_занята = bool(outbox is not None and outbox.pending())
+        # Конвейер пишет только через PostgREST; при COPY или занятой очереди CSV грузится после него
+        конвейер_в_supabase = bool(supabase) and not очередь_занята and get_upsert_backend() == "postgrest"
+        watermarks = load_sync_watermarks(supabase)
+        
         logging.info(f"Получение операций за последние {days_back} дней...")
         
+        # Имя CSV файла
+        now = datetime.now()
+        date_suffix = now.strftime("%Y-%m-%d_%H-%M")
+        filename = f"operations_{date_suffix}.csv"
+        filepath = os.path.join(tempfile.gettempdir(), filename)
+        compression = get_export_compression()
+        s3_key = compressed_key(export_key(filename, now.date()), compression)
+        parquet_key = export_key(parquet_name(filename), now.date()) if get_export_parquet() else None
+        
         # Получаем операции из Тинькофф
-        операции = fetch_operations(invest_token, days_back)
+        stream = os.environ.get("STREAM_FETCH", "").lower() in ("1", "true", "yes")
+        use_async = os.environ.get("ASYNC_PIPELINE", "").lower() in ("1", "true", "yes")
+        page_size = get_page_size()
+        конвейер = None
+        записи = None
+        итоги = new_totals()
+        if use_async:
+            # Асинхронный конвейер: CSV, S3 и Supabase получают страницы,
+            # пока следующие страницы еще скачиваются
+            конвейер = asyncio.run(run_pipeline(
+                invest_token, days_back, filepath, watermarks, get_watermark_overlap(), page_size,
+                account_ids=get_account_ids(), max_workers=get_fetch_concurrency(),
+                s3_client=create_s3_client(ya_access_key, ya_secret_key), bucket_name=bucket_name, s3_key=s3_key, compression=compression,
+                supabase_url=os.environ.get("SUPABASE_URL") if конвейер_в_supabase else None,
+                supabase_key=os.environ.get("SUPABASE_KEY") if конвейер_в_supabase else None,
+                upsert_concurrency=get_upsert_concurrency(),
+                outbox=outbox,
+            ))
+            итоги = конвейер['totals']
+        elif stream:
+            # Потоковый режим: страницы курсора сразу пишутся в CSV,
+            # дальше данные читаются из файла лениво
+            write_csv(filepath, map(record_to_row, track_totals(iter_records(
+                invest_token, days_back, watermarks, get_watermark_overlap(), page_size,
+                account_ids=get_account_ids()
+            ), итоги)))
+        else:
+            записи = fetch_records(
+                invest_token, days_back, watermarks, get_watermark_overlap(),
+                account_ids=get_account_ids(), max_workers=get_fetch_concurrency(),
+                cache=get_operations_cache()
+            )
+            add_to_totals(итоги, записи)
+        получено = итоги['count']
+        
+        def строки_для_supabase() -> Iterable[Dict]:
+            # Сериализация только на границе со стоком
+            if записи is None:
+                return map(row_to_supabase, read_csv(filepath))
+            return map(record_to_supabase, записи)
         
-        if not операции:
+        if not получено:
+            if watermarks:
+                logging.info("Новых операций нет, синхронизация не требуется")
+                return True
             logging.error("Не получено операций из Тинькофф")
             return False
         
-        logging.info(f"Получено {len(операций)} операций из Тинькофф")
+        logging.info(f"Получено {получено} операций из Тинькофф")
         
         # Создаем CSV файл
-        now = datetime.now()
-        date_suffix = now.strftime("%Y-%m-%d_%H-%M")
-        filename = f"operations_{date_suffix}.csv"
-        filepath = os.path.join(tempfile.gettempdir(), filename)
-        
-        write_csv(filepath, операции)
+        if записи is not None:
+            write_csv(filepath, map(record_to_row, записи))
         logging.info(f"CSV файл создан: {filename}")
         
         # Загружаем в Yandex S3
-        upload_to_yandex_s3(filepath, bucket_name, ya_access_key, ya_secret_key)
+        if конвейер is None:
+            upload_to_yandex_s3(filepath, bucket_name, ya_access_key, ya_secret_key, s3_key, compression)
         logging.info("Данные загружены в Yandex S3")
         
+        # Parquet рядом с CSV; его сбой не мешает загрузке в Supabase
+        if parquet_key:
+            try:
+                parquet = export_parquet(create_s3_client(ya_access_key, ya_secret_key), filepath, bucket_name, parquet_key)
+                logging.info(f"Parquet загружен в Yandex S3: {parquet['rows']} строк, "
+                             f"{parquet['row_groups']} групп строк по месяцам")
+            except Exception as e:
+                logging.warning(f"Не удалось выгрузить Parquet: {e}")
+                parquet_key = None
+        
         # Загружаем в Supabase
-        supabase = setup_supabase()
+        не_загружено = 0
+        скорость = 0.0
+        результат = None
         if supabase:
-            загружено = upload_to_supabase(supabase, операции)
+            if конвейер is None or not конвейер_в_supabase:
+                результат = upload_to_supabase(supabase, строки_для_supabase(), outbox)
+            else:
+                результат = конвейер
+            загружено, в_очереди = результат['loaded'], результат.get('queued', 0)
+            # Строки из локальной очереди не потеряны: их отправит следующий запуск
+            не_загружено = результат['failed'] - в_очереди
+            скорость = результат.get('rows_per_sec', 0.0)
+            if в_очереди:
+                logging.warning(f"Отложено в локальную очередь: {в_очереди} операций")
+            if не_загружено:
+                logging.error(f"Не загружено в Supabase: {не_загружено} операций")
             статистика = get_supabase_stats(supabase)
             
             logging.info(f"Статистика Supabase:")
             logging.info(f"  • Всего операций: {статистика.get('total', 0)}")
             logging.info(f"  • Последнее обновление: {статистика.get('last_update', 'N/A')}")
+            for валюта, сумма in статистика.get('by_currency', {}).items():
+                logging.info(f"  • Сумма в {валюта}: {float(сумма):,.2f}")
         else:
             logging.warning("Supabase не настроен, пропускаем загрузку")
-            загружено = 0
+            загружено = в_очереди = 0
         
-        # Итоговая статистика
-        total_amount = sum(float(op['amount']) for op in операции)
-        positive_ops = len([op for op in операции if float(op['amount']) > 0])
-        negative_ops = len([op for op in операции if float(op['amount']) < 0])
+        # Водяной знак сдвигаем, только если все строки записаны в Supabase или сохранены в локальную очередь:
+        # S3 хранит отдельные выгрузки, и инкрементальная выгрузка в нем была бы неполной
+        полностью = not не_загружено
+        if watermarks is not None and supabase and полностью and (загружено or в_очереди):
+            save_watermarks(os.environ.get("SYNC_STATE_FILE", "sync_state.json"), watermarks)
         
         logging.info("="*60)
         logging.info("📈 ИТОГОВАЯ СТАТИСТИКА:")
         logging.info("="*60)
-        logging.info(f"• Операций получено: {len(операций)}")
-        logging.info(f"• Загружено в Supabase: {загружено}")
-        logging.info(f"• Общая сумма: {total_amount:,.2f} ₽")
-        logging.info(f"• Положительных: {positive_ops}")
-        logging.info(f"• Отрицательных: {negative_ops}")
-        logging.info(f"• CSV файл: {filename}")
+        logging.info(f"• Операций получено: {итоги['count']}")
+        logging.info(f"• Загружено в Supabase: {загружено}" + (f" ({скорость:.0f} строк/с)" if скорость else ""))
+        if результат is not None:
+            logging.info(f"  • Новых: {результат.get('inserted', 0)}, измененных: {результат.get('updated', 0)}, "
+                         f"без изменений (не отправлялись): {результат.get('unchanged', 0)}")
+        logging.info(f"• Общая сумма: {итоги['amount_minor'] / 100:,.2f} ₽")
+        logging.info(f"• Положительных: {итоги['positive']}")
+        logging.info(f"• Отрицательных: {итоги['negative']}")
+        api = get_rate_limiter().stats
+        logging.info(f"• Запросов к API Тинькофф: {api['calls']} (ожиданий квоты: {api['waits']}, "
+                     f"{api['wait_seconds']:.1f} с; повторов: {api['retries']})")
+        if outbox is not None and (outbox.stats['queued'] or outbox.stats['replayed'] or outbox.stats['dead']):
+            logging.info(f"• Локальная очередь Supabase: отправлено {outbox.stats['replayed']}, "
+                         f"добавлено {outbox.stats['queued']}, отложено {outbox.stats['dead']} строк")
+        справочник = get_instrument_resolver()
+        if справочник is not None:
+            logging.info(f"• Справочник инструментов: из памяти {справочник.stats['memory_hits']}, "
+                         f"с диска {справочник.stats['disk_hits']}, запросов {справочник.stats['requests']} "
+                         f"(ошибок: {справочник.stats['failures']})")
+        кеш = get_operations_cache()
+        if кеш is not None:
+            logging.info(f"• Кеш операций: попаданий {кеш.stats['hits']}, промахов {кеш.stats['misses']}, "
+                         f"с диска {кеш.stats['operations']} операций (~{кеш.stats['bytes_saved'] / 1024:.0f} КБ)")
+        logging.info(f"• CSV файл: {s3_key}")
+        if parquet_key:
+            logging.info(f"• Parquet файл: {parquet_key}")
         logging.info("• Данные в Yandex S3: ✅")
         if supabase:
             logging.info("• Данные в Supabase: ✅")
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Дневные итоги операций в Supabase
+Таблица daily_operation_totals (день, счет, валюта, тип операции → сумма и
+число операций) ведется триггерами уровня оператора по каждой пачке
+вставленных, измененных и удаленных строк tinkoff_operations, как и
+tinkoff_operations_stats. Графики читают тысячи строк итогов, а не весь
+журнал операций. DAILY_TOTALS_SQL применяется миграцией 5 в migrations.py.
+
+Пересчет за период: python3 daily_totals.py rebuild 2024-01-01 2024-12-31
+"""
+
+import datetime
+import os
+import sys
+from typing import Dict, List, Optional
+
+DAILY_TOTALS_PAGE = 1000
+
+DAILY_TOTALS_SQL = """
+CREATE TABLE IF NOT EXISTS daily_operation_totals (
+    day DATE NOT NULL,
+    account_id VARCHAR(50) NOT NULL DEFAULT '',
+    currency VARCHAR(10) NOT NULL,
+    action VARCHAR(200) NOT NULL,
+    operations BIGINT NOT NULL DEFAULT 0,
+    amount DECIMAL(20,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, account_id, currency, action)
+);
+
+CREATE OR REPLACE FUNCTION daily_operation_totals_trigger() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- Строки итогов блокируются в порядке ключа: параллельные пачки upsert
+    -- ждут друг друга по очереди, а не по кругу (deadlock)
+    IF TG_OP = 'INSERT' THEN
+        PERFORM 1 FROM daily_operation_totals t
+        JOIN (
+            SELECT DISTINCT date_msk::date AS day, COALESCE(account_id, '') AS account_id, currency, action
+            FROM new_rows
+        ) k USING (day, account_id, currency, action)
+        ORDER BY t.day, t.account_id, t.currency, t.action FOR UPDATE OF t;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM 1 FROM daily_operation_totals t
+        JOIN (
+            SELECT DISTINCT date_msk::date AS day, COALESCE(account_id, '') AS account_id, currency, action
+            FROM old_rows
+        ) k USING (day, account_id, currency, action)
+        ORDER BY t.day, t.account_id, t.currency, t.action FOR UPDATE OF t;
+    ELSE
+        PERFORM 1 FROM daily_operation_totals t
+        JOIN (
+            SELECT date_msk::date AS day, COALESCE(account_id, '') AS account_id, currency, action FROM old_rows
+            UNION
+            SELECT date_msk::date AS day, COALESCE(account_id, '') AS account_id, currency, action FROM new_rows
+        ) k USING (day, account_id, currency, action)
+        ORDER BY t.day, t.account_id, t.currency, t.action FOR UPDATE OF t;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE daily_operation_totals t
+        SET operations = t.operations - d.operations, amount = t.amount - d.amount
+        FROM (
+            SELECT date_msk::date AS day, COALESCE(account_id, '') AS account_id, currency, action,
+                   count(*) AS operations, sum(amount) AS amount
+            FROM old_rows GROUP BY 1, 2, 3, 4
+        ) d
+        WHERE t.day = d.day AND t.account_id = d.account_id AND t.currency = d.currency AND t.action = d.action;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO daily_operation_totals AS t (day, account_id, currency, action, operations, amount)
+        SELECT date_msk::date, COALESCE(account_id, ''), currency, action, count(*), sum(amount)
+        FROM new_rows GROUP BY 1, 2, 3, 4
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (day, account_id, currency, action) DO UPDATE SET
+            operations = t.operations + EXCLUDED.operations,
+            amount = t.amount + EXCLUDED.amount;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM daily_operation_totals t
+        USING (SELECT DISTINCT date_msk::date AS day FROM old_rows) d
+        WHERE t.day = d.day AND t.operations = 0;
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS daily_operation_totals_insert ON tinkoff_operations;
+CREATE TRIGGER daily_operation_totals_insert AFTER INSERT ON tinkoff_operations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_operation_totals_trigger();
+DROP TRIGGER IF EXISTS daily_operation_totals_update ON tinkoff_operations;
+CREATE TRIGGER daily_operation_totals_update AFTER UPDATE ON tinkoff_operations
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_operation_totals_trigger();
+DROP TRIGGER IF EXISTS daily_operation_totals_delete ON tinkoff_operations;
+CREATE TRIGGER daily_operation_totals_delete AFTER DELETE ON tinkoff_operations
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION daily_operation_totals_trigger();
+
+-- Пересчет дней [from_date, to_date] из tinkoff_operations; возвращает число строк итогов
+CREATE OR REPLACE FUNCTION daily_operation_totals_rebuild(from_date DATE, to_date DATE) RETURNS INTEGER
+LANGUAGE plpgsql AS $$
+DECLARE
+    rebuilt INTEGER;
+BEGIN
+    DELETE FROM daily_operation_totals WHERE day BETWEEN from_date AND to_date;
+    INSERT INTO daily_operation_totals (day, account_id, currency, action, operations, amount)
+    SELECT date_msk::date, COALESCE(account_id, ''), currency, action, count(*), sum(amount)
+    FROM tinkoff_operations
+    WHERE date_msk >= from_date AND date_msk < to_date + 1
+    GROUP BY 1, 2, 3, 4;
+    GET DIAGNOSTICS rebuilt = ROW_COUNT;
+    RETURN rebuilt;
+END $$;
+
+-- Первичное заполнение; дальше итоги ведут триггеры
+SELECT daily_operation_totals_rebuild(r.first_day, r.last_day)
+FROM (SELECT min(date_msk)::date AS first_day, max(date_msk)::date AS last_day FROM tinkoff_operations) r
+WHERE r.first_day IS NOT NULL AND NOT EXISTS (SELECT 1 FROM daily_operation_totals);
+"""
+
+
+def rebuild_daily_totals(supabase, start: datetime.date, end: datetime.date) -> int:
+    """Пересчитывает дневные итоги за период (включительно) и возвращает число строк"""
+    result = supabase.rpc(
+        'daily_operation_totals_rebuild', {'from_date': start.isoformat(), 'to_date': end.isoformat()}
+    ).execute()
+    return int(result.data or 0)
+
+
+def fetch_daily_totals(
+    supabase, start: datetime.date, end: datetime.date, account_id: Optional[str] = None
+) -> List[Dict]:
+    """Дневные итоги за период (включительно), постранично"""
+    rows: List[Dict] = []
+    while True:
+        query = (
+            supabase.table('daily_operation_totals')
+            .select('day, account_id, currency, action, operations, amount')
+            .gte('day', start.isoformat())
+            .lte('day', end.isoformat())
+        )
+        if account_id is not None:
+            query = query.eq('account_id', account_id)
+        # Полный порядок по первичному ключу, чтобы страницы не пересекались
+        page = query.order('day,account_id,currency,action').range(
+            len(rows), len(rows) + DAILY_TOTALS_PAGE - 1
+        ).execute().data
+        rows.extend(page)
+        if len(page) < DAILY_TOTALS_PAGE:
+            return rows
+
+
+def main():
+    """Основная функция"""
+    if len(sys.argv) != 4 or sys.argv[1] != 'rebuild':
+        print("Использование: python3 daily_totals.py rebuild YYYY-MM-DD YYYY-MM-DD")
+        return
+
+    from supabase_client import get_supabase_client
+
+    if not os.environ.get("SUPABASE_URL") or not os.environ.get("SUPABASE_KEY"):
+        print("❌ Переменные SUPABASE_URL и SUPABASE_KEY не настроены")
+        return
+
+    start = datetime.date.fromisoformat(sys.argv[2])
+    end = datetime.date.fromisoformat(sys.argv[3])
+    строк = rebuild_daily_totals(get_supabase_client(), start, end)
+    print(f"✅ Дневные итоги за {start} — {end} пересчитаны: {строк} строк")
+
+
+if __name__ == "__main__":
+    main()
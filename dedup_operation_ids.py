@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Разовая очистка дублей в tinkoff_operations
+Операции без id раньше получали str(abs(hash(...))), который менялся в каждом
+процессе, поэтому каждый запуск добавлял новую копию строки. Скрипт заново
+выгружает историю, находит такие операции (теперь у них стабильный id "fp-..."),
+удаляет их старые копии и записывает строку со стабильным id. Старой копией
+считается только строка того же счета (или без счета) с числовым id, которого
+нет среди id, пришедших из API: строки других счетов и операции с настоящими
+id Тинькофф не удаляются, даже если совпадают по содержимому.
+
+Запуск: python3 dedup_operation_ids.py [--apply]
+Без --apply только показывает, что будет удалено.
+"""
+
+import os
+import sys
+from typing import Dict, List, Set
+
+from invest import (
+    FALLBACK_ID_PREFIX,
+    fetch_operations,
+    get_account_ids,
+    get_fetch_concurrency,
+    row_to_supabase,
+)
+
+from supabase import Client
+from migrations import ensure_schema
+from supabase_client import get_supabase_client
+from upsert_engine import get_upsert_batch_size, upsert_rows
+
+DELETE_CHUNK = 200
+
+
+def load_env_from_file(filename='config.env'):
+    """Загрузка переменных окружения из файла"""
+    if not os.path.exists(filename):
+        print(f"❌ Файл {filename} не найден")
+        return False
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#') and '=' in line:
+                key, value = line.split('=', 1)
+                key = key.strip()
+                value = value.strip()
+                os.environ[key] = value
+
+    return True
+
+
+def найти_дубли(supabase: Client, операция: Dict, id_из_api: Set[str]) -> List[str]:
+    """ID старых копий операции: то же содержимое и счет, числовой id от hash() вместо stable id"""
+    query = (
+        supabase.table('tinkoff_operations')
+        .select('operation_id, amount')
+        .eq('date_msk', операция['date_msk'])
+        .eq('action', операция['action'])
+        .eq('currency', операция['currency'])
+        .eq('description', операция['description'])
+        .neq('operation_id', операция['operation_id'])
+    )
+    if операция.get('account_id'):
+        # Строки, записанные до появления account_id, счета не знают
+        query = query.or_(f"account_id.eq.{операция['account_id']},account_id.is.null")
+    amount = round(float(операция['amount']), 2)
+    return [
+        row['operation_id'] for row in query.execute().data
+        if round(float(row['amount']), 2) == amount
+        and row['operation_id'].isdigit()
+        and row['operation_id'] not in id_из_api
+    ]
+
+
+def main():
+    """Основная функция"""
+    print("🧹 ОЧИСТКА ДУБЛЕЙ ОПЕРАЦИЙ БЕЗ ID")
+    print("="*60)
+
+    apply = '--apply' in sys.argv[1:]
+    if not load_env_from_file():
+        return
+
+    invest_token = os.environ.get("INVEST_TOKEN")
+    supabase_url = os.environ.get("SUPABASE_URL")
+    supabase_key = os.environ.get("SUPABASE_KEY")
+    days_back = max(1, int(os.environ.get("DAYS_BACK", "1000")))
+    if not invest_token or not supabase_url or not supabase_key:
+        print("❌ Нужны INVEST_TOKEN, SUPABASE_URL и SUPABASE_KEY")
+        return
+
+    print(f"📊 Получение операций за последние {days_back} дней...")
+    операции = fetch_operations(
+        invest_token, days_back,
+        account_ids=get_account_ids(), max_workers=get_fetch_concurrency()
+    )
+    без_id = [op for op in операции if op['operation_id'].startswith(FALLBACK_ID_PREFIX)]
+    # Настоящие id Тинькофф тоже бывают числовыми: такие строки не трогаем
+    id_из_api = {op['operation_id'] for op in операции}
+    print(f"✅ Получено {len(операции)} операций, без id: {len(без_id)}")
+
+    supabase = get_supabase_client(supabase_url, supabase_key)
+    try:
+        # Upsert идет по (operation_id, date_msk): без миграций запись невозможна
+        версия = ensure_schema(supabase)
+        print(f"✅ Схема Supabase актуальна (версия {версия})")
+    except Exception as e:
+        print(f"❌ Ошибка миграции схемы: {e}")
+        return
+
+    к_удалению: List[str] = []
+    for операция in без_id:
+        дубли = найти_дубли(supabase, операция, id_из_api)
+        if дубли:
+            print(f"• {операция['date_msk']} {операция['action']} {операция['amount']}: {len(дубли)} копий")
+            к_удалению.extend(дубли)
+
+    print(f"\n🗑️ Старых копий к удалению: {len(к_удалению)}")
+    if not apply:
+        print("💡 Запустите с --apply, чтобы удалить их и записать стабильные id")
+        return
+
+    for i in range(0, len(к_удалению), DELETE_CHUNK):
+        пачка = к_удалению[i:i + DELETE_CHUNK]
+        supabase.table('tinkoff_operations').delete().in_('operation_id', пачка).execute()
+
+    if без_id:
+        upsert_rows(supabase, [row_to_supabase(op) for op in без_id], batch_size=get_upsert_batch_size())
+
+    print(f"✅ Удалено {len(к_удалению)} копий, записано {len(без_id)} операций со стабильным id")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Справочник инструментов: FIGI → тикер, название, тип
+LRU в памяти и кеш в SQLite с TTL, поэтому каждый FIGI запрашивается у
+InstrumentsService не чаще раза за TTL, даже между запусками
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from tinkoff.invest import InstrumentIdType
+
+from rate_limit import get_rate_limiter
+
+DEFAULT_INSTRUMENTS_CACHE_FILE = "instruments_cache.db"
+DEFAULT_INSTRUMENTS_TTL = datetime.timedelta(days=7)
+DEFAULT_LRU_SIZE = 4096
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS instruments (
+    figi TEXT PRIMARY KEY,
+    ticker TEXT NOT NULL,
+    name TEXT NOT NULL,
+    instrument_type TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+"""
+
+
+class InstrumentInfo(NamedTuple):
+    ticker: str
+    name: str
+    instrument_type: str
+
+
+# FIGI, которого нет в справочнике, тоже кешируется, чтобы не спрашивать его каждый запуск
+UNKNOWN_INSTRUMENT = InstrumentInfo("", "", "")
+
+
+def _is_not_found(exc: Exception) -> bool:
+    code = getattr(exc, "code", None)
+    return getattr(code, "name", str(code)) == "NOT_FOUND"
+
+
+def _to_info(response: object) -> InstrumentInfo:
+    instrument = getattr(response, "instrument", None)
+    return InstrumentInfo(
+        ticker=getattr(instrument, "ticker", "") or "",
+        name=getattr(instrument, "name", "") or "",
+        instrument_type=getattr(instrument, "instrument_type", "") or "",
+    )
+
+
+class InstrumentResolver:
+    """Пакетное разрешение FIGI через LRU, диск и API"""
+
+    def __init__(
+        self,
+        path: str = ":memory:",
+        ttl: datetime.timedelta = DEFAULT_INSTRUMENTS_TTL,
+        lru_size: int = DEFAULT_LRU_SIZE,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.lru_size = max(1, lru_size)
+        self._memory: "OrderedDict[str, InstrumentInfo]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+        self.stats: Dict[str, int] = {"memory_hits": 0, "disk_hits": 0, "requests": 0, "failures": 0}
+
+    def _remember(self, figi: str, info: InstrumentInfo) -> None:
+        self._memory[figi] = info
+        self._memory.move_to_end(figi)
+        while len(self._memory) > self.lru_size:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, figis: Iterable[str]) -> tuple[Dict[str, InstrumentInfo], List[str]]:
+        """Известные FIGI из памяти и с диска и список тех, что нужно запросить"""
+        found: Dict[str, InstrumentInfo] = {}
+        with self._lock:
+            on_disk = []
+            for figi in set(figis):
+                if not figi:
+                    continue
+                info = self._memory.get(figi)
+                if info is None:
+                    on_disk.append(figi)
+                    continue
+                self._memory.move_to_end(figi)
+                found[figi] = info
+            self.stats["memory_hits"] += len(found)
+
+            if on_disk:
+                placeholders = ",".join("?" * len(on_disk))
+                rows = self._db.execute(
+                    f"SELECT figi, ticker, name, instrument_type FROM instruments"
+                    f" WHERE fetched_at > ? AND figi IN ({placeholders})",
+                    (time.time() - self.ttl.total_seconds(), *on_disk),
+                ).fetchall()
+                for figi, ticker, name, instrument_type in rows:
+                    info = InstrumentInfo(ticker, name, instrument_type)
+                    self._remember(figi, info)
+                    found[figi] = info
+                self.stats["disk_hits"] += len(rows)
+        return found, [figi for figi in on_disk if figi not in found]
+
+    def _store(self, resolved: Dict[str, InstrumentInfo]) -> None:
+        now = time.time()
+        with self._lock, self._db:
+            for figi, info in resolved.items():
+                self._remember(figi, info)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO instruments VALUES (?, ?, ?, ?, ?)",
+                [(figi, *info, now) for figi, info in resolved.items()],
+            )
+
+    def _record_failure(self, figi: str, exc: Exception) -> None:
+        with self._lock:
+            self.stats["failures"] += 1
+        logging.warning("Failed to resolve instrument %s: %s", figi, exc)
+
+    def resolve(self, client, figis: Iterable[str], max_workers: int = 4) -> Dict[str, InstrumentInfo]:
+        """FIGI → InstrumentInfo; недоступные сейчас FIGI в ответ не попадают"""
+        found, missing = self._lookup(figis)
+        if not missing:
+            return found
+
+        def request(figi: str) -> Optional[InstrumentInfo]:
+            try:
+                return _to_info(get_rate_limiter().call(
+                    "get_instrument_by",
+                    client.instruments.get_instrument_by,
+                    id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI,
+                    id=figi,
+                ))
+            except Exception as exc:  # noqa: BLE001
+                if _is_not_found(exc):
+                    return UNKNOWN_INSTRUMENT
+                self._record_failure(figi, exc)
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as pool:
+            infos = list(pool.map(request, missing))
+        return self._finish(found, missing, infos)
+
+    async def aresolve(self, client, figis: Iterable[str]) -> Dict[str, InstrumentInfo]:
+        """То же, что resolve, для AsyncClient"""
+        found, missing = self._lookup(figis)
+        if not missing:
+            return found
+
+        async def request(figi: str) -> Optional[InstrumentInfo]:
+            try:
+                return _to_info(await get_rate_limiter().acall(
+                    "get_instrument_by",
+                    client.instruments.get_instrument_by,
+                    id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI,
+                    id=figi,
+                ))
+            except Exception as exc:  # noqa: BLE001
+                if _is_not_found(exc):
+                    return UNKNOWN_INSTRUMENT
+                self._record_failure(figi, exc)
+                return None
+
+        infos = await asyncio.gather(*(request(figi) for figi in missing))
+        return self._finish(found, missing, infos)
+
+    def _finish(
+        self, found: Dict[str, InstrumentInfo], missing: List[str], infos: List[Optional[InstrumentInfo]]
+    ) -> Dict[str, InstrumentInfo]:
+        resolved = {figi: info for figi, info in zip(missing, infos) if info is not None}
+        with self._lock:
+            self.stats["requests"] += len(missing)
+        if resolved:
+            self._store(resolved)
+        found.update(resolved)
+        return found
+
+
+def get_instruments_ttl() -> datetime.timedelta:
+    ttl_str = os.environ.get("INSTRUMENTS_CACHE_TTL_HOURS")
+    if not ttl_str:
+        return DEFAULT_INSTRUMENTS_TTL
+    try:
+        return datetime.timedelta(hours=max(0.0, float(ttl_str)))
+    except ValueError:
+        raise RuntimeError("INSTRUMENTS_CACHE_TTL_HOURS must be a number")
+
+
+_resolver: Optional[InstrumentResolver] = None
+_resolver_lock = threading.Lock()
+
+
+def get_instrument_resolver() -> Optional[InstrumentResolver]:
+    """Справочник процесса; ENRICH_INSTRUMENTS=0 отключает обогащение"""
+    global _resolver
+    if os.environ.get("ENRICH_INSTRUMENTS", "1").lower() in ("0", "false", "no"):
+        return None
+    # Пустой INSTRUMENTS_CACHE_FILE — только память, без кеша между запусками
+    path = os.environ.get("INSTRUMENTS_CACHE_FILE", DEFAULT_INSTRUMENTS_CACHE_FILE) or ":memory:"
+    with _resolver_lock:
+        if _resolver is None or _resolver.path != path:
+            try:
+                _resolver = InstrumentResolver(path, get_instruments_ttl())
+            except sqlite3.Error as e:
+                logging.warning("Instruments cache %s is unavailable: %s", path, e)
+                _resolver = InstrumentResolver(":memory:", get_instruments_ttl())
+        return _resolver
@@ -4,16 +4,34 @@ import datetime
 import logging
 import tempfile
 import json
-from decimal import Decimal, ROUND_HALF_UP
+import sys
+import hashlib
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from zoneinfo import ZoneInfo
-from typing import List, Dict
+from typing import TYPE_CHECKING, Callable, List, Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
 
 import boto3
 from botocore.config import Config
-from tinkoff.invest import Client
+from tinkoff.invest import Client, GetOperationsByCursorRequest, OperationState, OperationType
 import gspread
 from google.oauth2.service_account import Credentials
 
+from instruments import InstrumentInfo, get_instrument_resolver
+from parquet_export import export_parquet, get_export_parquet, parquet_name
+from rate_limit import error_code, get_rate_limiter, is_message_size_error
+from s3_exports import (
+    LATEST_ALIAS_KEY,
+    compressed_key,
+    export_key,
+    get_export_compression,
+    publish_latest,
+    upload_file,
+)
+
+if TYPE_CHECKING:
+    from operations_cache import OperationsCache
+
 
 def get_env_variable(name: str) -> str:
     value = os.environ.get(name)
@@ -28,142 +46,713 @@ def build_date_range(days_back: int) -> tuple[datetime.datetime, datetime.dateti
     return start_dt, now
 
 
-def _money_to_decimal_str(money_obj: object) -> str:
+# Watermarks: per-account timestamp (MSK, same format as date_msk) of the last
+# synced operation. "*" applies to accounts that have no watermark of their own,
+# e.g. a value derived from max(date_msk) in tinkoff_operations.
+DATE_MSK_FORMAT = "%Y-%m-%d %H:%M:%S"
+MSK = ZoneInfo("Europe/Moscow")
+ALL_ACCOUNTS_WATERMARK = "*"
+DEFAULT_WATERMARK_OVERLAP = datetime.timedelta(days=3)
+
+# GetOperationsByCursor accepts at most 1000 items per page
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_FETCH_CONCURRENCY = 4
+# Failing shards are halved until this width, then reported as failed
+MIN_SHARD = datetime.timedelta(days=1)
+
+
+def get_page_size() -> int:
+    page_size_str = os.environ.get("FETCH_PAGE_SIZE", str(DEFAULT_PAGE_SIZE))
+    try:
+        return min(DEFAULT_PAGE_SIZE, max(1, int(page_size_str)))
+    except ValueError:
+        raise RuntimeError("FETCH_PAGE_SIZE must be an integer")
+
+
+def load_watermarks(path: str) -> Dict[str, str]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as exc:
+        logging.warning("Ignoring unreadable watermark file %s: %s", path, exc)
+        return {}
+    watermarks = data.get("watermarks", {}) if isinstance(data, dict) else {}
+    return {str(k): str(v) for k, v in watermarks.items() if v}
+
+
+def save_watermarks(path: str, watermarks: Dict[str, str]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"watermarks": watermarks}, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def watermark_from_supabase(supabase: object) -> Dict[str, str]:
+    result = (
+        supabase.table("tinkoff_operations")  # type: ignore[attr-defined]
+        .select("date_msk")
+        .order("date_msk", desc=True)
+        .limit(1)
+        .execute()
+    )
+    if not result.data:
+        return {}
+    # PostgREST returns timestamps as ISO strings ("2024-05-01T10:00:00")
+    latest = str(result.data[0]["date_msk"]).replace("T", " ")[:19]
+    return {ALL_ACCOUNTS_WATERMARK: latest}
+
+
+def get_watermark_overlap() -> datetime.timedelta:
+    hours_str = os.environ.get("WATERMARK_OVERLAP_HOURS", "")
+    if not hours_str:
+        return DEFAULT_WATERMARK_OVERLAP
+    try:
+        return datetime.timedelta(hours=max(0, int(hours_str)))
+    except ValueError:
+        raise RuntimeError("WATERMARK_OVERLAP_HOURS must be an integer")
+
+
+def build_incremental_range(
+    days_back: int,
+    watermark: Optional[str],
+    overlap: datetime.timedelta = DEFAULT_WATERMARK_OVERLAP,
+) -> tuple[datetime.datetime, datetime.datetime]:
+    start_dt, now = build_date_range(days_back)
+    start_dt, now = start_dt.astimezone(), now.astimezone()
+    if not watermark:
+        return start_dt, now
     try:
-        units = getattr(money_obj, "units", 0)
-        nano = getattr(money_obj, "nano", 0)
-        sign = 1
-        if units < 0 or nano < 0:
-            sign = -1
-        total = (Decimal(abs(units)) + (Decimal(abs(nano)) / Decimal(1_000_000_000))) * sign
-        # Format to two decimals as plain string to avoid scientific notation in Sheets
-        return str(total.quantize(Decimal("0.00"), rounding=ROUND_HALF_UP))
+        watermark_dt = datetime.datetime.strptime(watermark, DATE_MSK_FORMAT).replace(tzinfo=MSK)
+    except ValueError:
+        logging.warning("Ignoring malformed watermark %r", watermark)
+        return start_dt, now
+    # Re-read a safety overlap: operations may change status or arrive late
+    return max(start_dt, watermark_dt - overlap), now
+
+
+OPERATION_TYPE_NAMES = {
+    "OPERATION_TYPE_BUY": "Покупка ценных бумаг",
+    "OPERATION_TYPE_SELL": "Продажа ценных бумаг",
+    "OPERATION_TYPE_BROKER_FEE": "Комиссия брокера",
+    "OPERATION_TYPE_SERVICE_FEE": "Удержание комиссии",
+    "OPERATION_TYPE_TAX": "Удержание налога",
+    "OPERATION_TYPE_TAX_DIVIDEND": "Налог на дивиденды",
+    "OPERATION_TYPE_DIVIDEND": "Выплата дивидендов",
+    "OPERATION_TYPE_COUPON": "Выплата купона",
+    "OPERATION_TYPE_INPUT": "Ввод денежных средств",
+    "OPERATION_TYPE_OUTPUT": "Вывод денежных средств",
+    "OPERATION_TYPE_OPTION_EXPIRATION": "Экспирация опциона",
+    "OPERATION_TYPE_WRITE_OFF_MONEY": "Списание средств",
+    "OPERATION_TYPE_PAY_IN": "Пополнение",
+    "OPERATION_TYPE_PAY_OUT": "Вывод",
+}
+
+OPERATION_STATE_NAMES = {
+    "OPERATION_STATE_EXECUTED": "Проведена",
+    "OPERATION_STATE_DECLINED": "Отклонена",
+    "OPERATION_STATE_PROGRESS": "В обработке",
+}
+
+# Enum code -> label, built once at import instead of per row
+OPERATION_TYPE_LABELS: Dict[int, str] = {
+    member.value: OPERATION_TYPE_NAMES.get(member.name, member.name) for member in OperationType
+}
+OPERATION_STATE_LABELS: Dict[int, str] = {
+    member.value: OPERATION_STATE_NAMES.get(member.name, member.name) for member in OperationState
+}
+
+
+class OperationRecord(NamedTuple):
+    """Normalised operation; rendered to strings only at the CSV/JSON sinks."""
+
+    operation_id: str
+    account_id: str
+    timestamp: Optional[datetime.datetime]
+    # Server label: Operation.type, OperationItem.name; enum code is the fallback
+    type_label: str
+    type_code: int
+    amount_minor: int  # kopecks/cents, rounded half away from zero
+    currency: str
+    state_code: int
+    description: str
+    figi: str = ""
+    # Filled in from the instruments service by enrich_records
+    instrument_type: str = ""
+    ticker: str = ""
+    instrument_name: str = ""
+
+
+def _money_to_minor(money_obj: object) -> int:
+    units = getattr(money_obj, "units", 0)
+    nano = getattr(money_obj, "nano", 0)
+    total_nano = units * 1_000_000_000 + nano
+    minor = (abs(total_nano) + 5_000_000) // 10_000_000
+    return -minor if total_nano < 0 else minor
+
+
+def format_minor(amount_minor: int) -> str:
+    # Plain two-decimal string to avoid scientific notation in Sheets
+    sign = "-" if amount_minor < 0 else ""
+    units, cents = divmod(abs(amount_minor), 100)
+    return f"{sign}{units}.{cents:02d}"
+
+
+def format_date_msk(timestamp: Optional[datetime.datetime]) -> str:
+    if timestamp is None:
+        return str(timestamp)
+    try:
+        return timestamp.astimezone(MSK).strftime(DATE_MSK_FORMAT)
     except Exception:
-        return str(money_obj)
-
-
-def _rus_operation_type(op_type: object) -> str:
-    name = getattr(op_type, "name", str(op_type))
-    mapping = {
-        "OPERATION_TYPE_BUY": "Покупка ценных бумаг",
-        "OPERATION_TYPE_SELL": "Продажа ценных бумаг",
-        "OPERATION_TYPE_BROKER_FEE": "Комиссия брокера",
-        "OPERATION_TYPE_SERVICE_FEE": "Удержание комиссии",
-        "OPERATION_TYPE_TAX": "Удержание налога",
-        "OPERATION_TYPE_TAX_DIVIDEND": "Налог на дивиденды",
-        "OPERATION_TYPE_DIVIDEND": "Выплата дивидендов",
-        "OPERATION_TYPE_COUPON": "Выплата купона",
-        "OPERATION_TYPE_INPUT": "Ввод денежных средств",
-        "OPERATION_TYPE_OUTPUT": "Вывод денежных средств",
-        "OPERATION_TYPE_OPTION_EXPIRATION": "Экспирация опциона",
-        "OPERATION_TYPE_WRITE_OFF_MONEY": "Списание средств",
-        "OPERATION_TYPE_PAY_IN": "Пополнение",
-        "OPERATION_TYPE_PAY_OUT": "Вывод",
+        return timestamp.strftime(DATE_MSK_FORMAT)
+
+
+def _rus_operation_type(record: OperationRecord) -> str:
+    return record.type_label or OPERATION_TYPE_LABELS.get(record.type_code, str(record.type_code))
+
+
+def _rus_operation_state(record: OperationRecord) -> str:
+    return OPERATION_STATE_LABELS.get(record.state_code, str(record.state_code))
+
+
+# Instrument columns; empty strings become NULL in tinkoff_operations
+INSTRUMENT_FIELDS = ("figi", "ticker", "instrument_name", "instrument_type")
+
+
+# Operations without an id get a digest of their normalised content. The prefix
+# keeps these ids apart from real Tinkoff ids (see dedup_operation_ids.py).
+FALLBACK_ID_PREFIX = "fp-"
+FINGERPRINT_FIELDS = ("date_msk", "action", "amount", "currency", "description")
+
+
+def stable_operation_id(row: Dict[str, str]) -> str:
+    # Status is left out on purpose: an operation moving from "in progress" to
+    # "executed" must keep its id. The account goes first when it is known, so
+    # identical operations in two accounts get different ids; rows without an
+    # account keep the digest they had before accounts were recorded.
+    fingerprint = "|".join(str(row.get(field, "")) for field in FINGERPRINT_FIELDS)
+    if row.get("account_id"):
+        fingerprint = f"{row['account_id']}|{fingerprint}"
+    digest = hashlib.blake2b(fingerprint.encode("utf-8"), digest_size=16).hexdigest()
+    return FALLBACK_ID_PREFIX + digest
+
+
+def to_record(op: object, account_id: str = "") -> OperationRecord:
+    """Single converter for Operation (get_operations) and OperationItem (cursor API)."""
+    raw_type = getattr(op, "type", "")
+    if isinstance(raw_type, str):
+        type_label, type_code = sys.intern(raw_type), int(getattr(op, "operation_type", 0))
+    else:
+        # OperationItem.type is the enum; the same label as Operation.type is in name,
+        # so both fetch paths produce the same action (and row_hash, stats, fp- id)
+        type_label, type_code = sys.intern(getattr(op, "name", "") or ""), int(raw_type)
+
+    payment = getattr(op, "payment", None)
+    record = OperationRecord(
+        operation_id=getattr(op, "id", None) or getattr(op, "operation_id", None) or getattr(op, "trade_id", None) or "",
+        account_id=account_id,
+        timestamp=getattr(op, "date", None),
+        type_label=type_label,
+        type_code=type_code,
+        amount_minor=_money_to_minor(payment),
+        # OperationItem keeps the currency on payment only
+        currency=sys.intern(getattr(op, "currency", "") or getattr(payment, "currency", "") or ""),
+        state_code=int(getattr(op, "state", 0)),
+        description=getattr(op, "description", ""),
+        figi=getattr(op, "figi", "") or "",
+        instrument_type=sys.intern(getattr(op, "instrument_type", "") or ""),
+    )
+    if not record.operation_id:
+        record = record._replace(operation_id=stable_operation_id(record_to_row(record)))
+    return record
+
+
+def record_to_row(record: OperationRecord) -> Dict[str, str]:
+    return {
+        "operation_id": record.operation_id,
+        "account_id": record.account_id,
+        "date_msk": format_date_msk(record.timestamp),
+        "action": _rus_operation_type(record),
+        "amount": format_minor(record.amount_minor),
+        "currency": record.currency,
+        "status": _rus_operation_state(record),
+        "description": record.description,
+        "figi": record.figi,
+        "ticker": record.ticker,
+        "instrument_name": record.instrument_name,
+        "instrument_type": record.instrument_type,
     }
-    return mapping.get(name, name)
 
 
-def _rus_operation_state(state: object) -> str:
-    name = getattr(state, "name", str(state))
-    mapping = {
-        "OPERATION_STATE_EXECUTED": "Проведена",
-        "OPERATION_STATE_DECLINED": "Отклонена",
-        "OPERATION_STATE_PROGRESS": "В обработке",
+def record_to_supabase(record: OperationRecord) -> Dict[str, object]:
+    row: Dict[str, object] = dict(record_to_row(record))
+    row["account_id"] = record.account_id or None
+    row["amount"] = record.amount_minor / 100
+    for field in INSTRUMENT_FIELDS:
+        row[field] = row[field] or None
+    return row
+
+
+def row_to_supabase(row: Dict[str, str]) -> Dict[str, object]:
+    # Same payload for rows read back from CSV files
+    return {
+        "operation_id": row["operation_id"],
+        "account_id": row.get("account_id") or None,
+        "date_msk": row["date_msk"],
+        "action": row["action"],
+        "amount": float(row["amount"]),
+        "currency": row["currency"],
+        "status": row["status"],
+        "description": row["description"],
+        # CSV files written before enrichment have no instrument columns
+        **{field: row.get(field) or None for field in INSTRUMENT_FIELDS},
     }
-    return mapping.get(name, name)
 
 
-def fetch_operations(invest_token: str, days_back: int) -> List[Dict[str, str]]:
-    start_date, end_date = build_date_range(days_back)
-    logging.info("Fetching operations from %s to %s", start_date, end_date)
+def enrich_records(records: Iterable[OperationRecord], instruments: Dict[str, InstrumentInfo]) -> List[OperationRecord]:
+    enriched = []
+    for record in records:
+        info = instruments.get(record.figi)
+        if info is not None:
+            record = record._replace(
+                ticker=info.ticker,
+                instrument_name=info.name,
+                instrument_type=record.instrument_type or info.instrument_type,
+            )
+        enriched.append(record)
+    return enriched
+
+
+def _enrich_with_client(
+    client: Client, records: List[OperationRecord], max_workers: int = DEFAULT_FETCH_CONCURRENCY
+) -> List[OperationRecord]:
+    resolver = get_instrument_resolver()
+    if resolver is None:
+        return records
+    return enrich_records(records, resolver.resolve(client, {record.figi for record in records}, max_workers))
+
+
+def new_totals() -> Dict[str, int]:
+    return {"count": 0, "amount_minor": 0, "positive": 0, "negative": 0}
+
+
+def add_to_totals(totals: Dict[str, int], records: Iterable[OperationRecord]) -> None:
+    # Integer minor units: no float() re-parsing of the rendered amount
+    for record in records:
+        totals["count"] += 1
+        totals["amount_minor"] += record.amount_minor
+        if record.amount_minor > 0:
+            totals["positive"] += 1
+        elif record.amount_minor < 0:
+            totals["negative"] += 1
+
+
+def track_totals(records: Iterable[OperationRecord], totals: Dict[str, int]) -> Iterator[OperationRecord]:
+    # Lets a single streaming pass feed both a sink and the run summary
+    for record in records:
+        add_to_totals(totals, (record,))
+        yield record
+
+
+def _newest_date_msk(records: Iterable[OperationRecord]) -> str:
+    timestamps = [record.timestamp for record in records if record.timestamp is not None]
+    return format_date_msk(max(timestamps)) if timestamps else ""
+
+
+def _resolve_range(
+    days_back: int,
+    account_id: str,
+    watermarks: Optional[Dict[str, str]],
+    overlap: datetime.timedelta,
+) -> tuple[datetime.datetime, datetime.datetime]:
+    if watermarks is None:
+        return build_date_range(days_back)
+    watermark = watermarks.get(account_id) or watermarks.get(ALL_ACCOUNTS_WATERMARK)
+    return build_incremental_range(days_back, watermark, overlap)
+
+
+def _advance_watermark(watermarks: Optional[Dict[str, str]], account_id: str, newest: str) -> None:
+    if watermarks is not None and newest:
+        watermarks[account_id] = max(newest, watermarks.get(account_id, ""))
+
+
+def get_account_ids() -> Optional[List[str]]:
+    account_ids_str = os.environ.get("ACCOUNT_IDS", "")
+    account_ids = [a.strip() for a in account_ids_str.split(",") if a.strip()]
+    return account_ids or None
+
+
+def get_fetch_concurrency() -> int:
+    concurrency_str = os.environ.get("FETCH_CONCURRENCY", str(DEFAULT_FETCH_CONCURRENCY))
+    try:
+        return max(1, int(concurrency_str))
+    except ValueError:
+        raise RuntimeError("FETCH_CONCURRENCY must be an integer")
+
 
+def _select_accounts(client: Client, account_ids: Optional[Iterable[str]]) -> List[str]:
+    accounts = get_rate_limiter().call("get_accounts", client.users.get_accounts).accounts
+    return _pick_accounts(accounts, account_ids)
+
+
+def _pick_accounts(accounts: List[object], account_ids: Optional[Iterable[str]]) -> List[str]:
+    if not accounts:
+        raise RuntimeError("No Tinkoff Invest accounts available for the token")
+
+    available = [account.id for account in accounts]  # type: ignore[attr-defined]
+    if account_ids is None:
+        return available
+
+    wanted = list(account_ids)
+    missing = [account_id for account_id in wanted if account_id not in available]
+    if missing:
+        raise RuntimeError(f"Accounts not available for the token: {', '.join(missing)}")
+    return wanted
+
+
+def _fetch_account_operations(
+    client: Client,
+    account_id: str,
+    start_date: datetime.datetime,
+    end_date: datetime.datetime,
+) -> List[OperationRecord]:
+    operations = get_rate_limiter().call(
+        "get_operations",
+        client.operations.get_operations,
+        account_id=account_id,
+        from_=start_date,
+        to=end_date,
+    )
+    return [to_record(op, account_id) for op in operations.operations]
+
+
+def build_month_shards(
+    start_date: datetime.datetime, end_date: datetime.datetime
+) -> List[tuple[datetime.datetime, datetime.datetime]]:
+    shards = []
+    shard_start = start_date
+    while shard_start < end_date:
+        month_start = shard_start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        if month_start.month == 12:
+            next_month = month_start.replace(year=month_start.year + 1, month=1)
+        else:
+            next_month = month_start.replace(month=month_start.month + 1)
+        shard_end = min(next_month, end_date)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end
+    return shards
+
+
+def _is_splittable_error(exc: Exception) -> bool:
+    # Deadline hit or response over the gRPC message limit: a narrower window may pass.
+    # Any other RESOURCE_EXHAUSTED is the rate limit, which the limiter already retried;
+    # splitting the shard would only double the requests.
+    return error_code(exc) == "DEADLINE_EXCEEDED" or is_message_size_error(exc)
+
+
+def _fetch_shards(
+    client: Client,
+    shards: List[tuple[str, datetime.datetime, datetime.datetime]],
+    max_workers: int,
+    on_shard: Optional[Callable[[str, datetime.datetime, datetime.datetime, List[OperationRecord]], None]] = None,
+) -> tuple[Dict[str, Dict[str, OperationRecord]], Dict[str, datetime.datetime]]:
+    """Fetch (account_id, start, end) shards in parallel.
+
+    Returns records per account deduplicated by operation_id, and for every account
+    with a shard that could not be fetched the start of its earliest such shard.
+    Shards failing on deadline/size limits are split in half down to MIN_SHARD.
+    ``on_shard`` is called on the calling thread for every fully fetched shard.
+    """
+    rows_by_account: Dict[str, Dict[str, OperationRecord]] = {}
+    failed_from: Dict[str, datetime.datetime] = {}
+    splits = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        pending = {
+            pool.submit(_fetch_account_operations, client, *shard): shard for shard in shards
+        }
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                account_id, start_date, end_date = pending.pop(future)
+                try:
+                    shard_rows = future.result()
+                except Exception as exc:  # noqa: BLE001
+                    if _is_splittable_error(exc) and end_date - start_date > MIN_SHARD:
+                        middle = start_date + (end_date - start_date) / 2
+                        logging.warning(
+                            "Splitting shard %s..%s of account %s: %s", start_date, end_date, account_id, exc
+                        )
+                        splits += 1
+                        for part in ((account_id, start_date, middle), (account_id, middle, end_date)):
+                            pending[pool.submit(_fetch_account_operations, client, *part)] = part
+                        continue
+                    logging.error(
+                        "Failed to fetch shard %s..%s of account %s: %s", start_date, end_date, account_id, exc
+                    )
+                    failed_from[account_id] = min(start_date, failed_from.get(account_id, start_date))
+                    continue
+
+                if on_shard is not None:
+                    on_shard(account_id, start_date, end_date, shard_rows)
+                account_rows = rows_by_account.setdefault(account_id, {})
+                for record in shard_rows:
+                    account_rows[record.operation_id] = record
+
+    logging.info("Fetched %d shards (%d splits, %d accounts with failures)", len(shards), splits, len(failed_from))
+    return rows_by_account, failed_from
+
+
+def fetch_records(
+    invest_token: str,
+    days_back: int,
+    watermarks: Optional[Dict[str, str]] = None,
+    overlap: datetime.timedelta = DEFAULT_WATERMARK_OVERLAP,
+    account_ids: Optional[Iterable[str]] = None,
+    max_workers: int = DEFAULT_FETCH_CONCURRENCY,
+    cache: Optional["OperationsCache"] = None,
+) -> List[OperationRecord]:
+    """Fetch operations for the last ``days_back`` days from every account.
+
+    Each account's window is cut into calendar-month shards, and all shards of
+    all accounts (or of ``account_ids``) are fetched on up to ``max_workers``
+    threads sharing one gRPC channel. Results are deduplicated by operation_id.
+    Shards that still fail are logged and skipped; the run only raises if
+    nothing could be fetched at all.
+
+    When ``watermarks`` is given, only ``[watermark - overlap, now]`` is requested
+    per account and the dict is advanced in place to the newest fetched
+    operation, but never past the first failed shard. Callers persist it with
+    ``save_watermarks`` once the rows are safely stored.
+
+    With an ``OperationsCache`` (see operations_cache.py), windows it already
+    covers are read from disk and only the gaps are requested from the API;
+    every fetched shard is written back to the cache.
+    """
     with Client(invest_token) as client:
-        accounts = client.users.get_accounts().accounts
-        if not accounts:
-            raise RuntimeError("No Tinkoff Invest accounts available for the token")
-
-        account_id = accounts[0].id
-        operations = client.operations.get_operations(
-            account_id=account_id,
-            from_=start_date,
-            to=end_date,
-        )
+        selected = _select_accounts(client, account_ids)
+
+        shards = []
+        cached: Dict[str, List[OperationRecord]] = {}
+        for account_id in selected:
+            start_date, end_date = _resolve_range(days_back, account_id, watermarks, overlap)
+            account_shards = build_month_shards(start_date, end_date)
+            if cache is not None:
+                windows = account_shards
+                account_shards = []
+                for shard_start, shard_end in windows:
+                    shard_cached, gaps = cache.plan(account_id, shard_start, shard_end)
+                    cached.setdefault(account_id, []).extend(shard_cached)
+                    account_shards.extend(gaps)
+            logging.info(
+                "Fetching operations of account %s from %s to %s in %d shards (%d cached)",
+                account_id,
+                start_date,
+                end_date,
+                len(account_shards),
+                len(cached.get(account_id, [])),
+            )
+            shards.extend((account_id, shard_start, shard_end) for shard_start, shard_end in account_shards)
 
-        rows: List[Dict[str, str]] = []
-        msk = ZoneInfo("Europe/Moscow")
-        for op in operations.operations:
-            # Try common identifiers; fall back to a hash of fields if missing
-            op_id = (
-                getattr(op, "id", None)
-                or getattr(op, "operation_id", None)
-                or getattr(op, "trade_id", None)
+        rows_by_account, failed_from = _fetch_shards(
+            client, shards, max_workers, cache.store if cache is not None else None
+        )
+        if failed_from and not rows_by_account and not cached:
+            raise RuntimeError("Failed to fetch operations for every requested window")
+
+        records: List[OperationRecord] = []
+        for account_id in selected:
+            # Fresh API rows win over cached copies of the same operation
+            account_rows = {record.operation_id: record for record in cached.get(account_id, [])}
+            account_rows.update(rows_by_account.get(account_id, {}))
+            account_records = list(account_rows.values())
+            logging.info("Fetched %d operations of account %s", len(account_records), account_id)
+            if account_records:
+                newest = _newest_date_msk(account_records)
+                if account_id in failed_from:
+                    newest = min(newest, format_date_msk(failed_from[account_id]))
+                _advance_watermark(watermarks, account_id, newest)
+            records.extend(account_records)
+
+        records = _enrich_with_client(client, records, max_workers)
+        # Newest first, like a single get_operations response
+        records.sort(key=_record_sort_key, reverse=True)
+        logging.info("Fetched %d operations from %d accounts", len(records), len(selected))
+        return records
+
+
+def _record_sort_key(record: OperationRecord) -> float:
+    return record.timestamp.timestamp() if record.timestamp is not None else 0.0
+
+
+def fetch_operations(
+    invest_token: str,
+    days_back: int,
+    watermarks: Optional[Dict[str, str]] = None,
+    overlap: datetime.timedelta = DEFAULT_WATERMARK_OVERLAP,
+    account_ids: Optional[Iterable[str]] = None,
+    max_workers: int = DEFAULT_FETCH_CONCURRENCY,
+    cache: Optional["OperationsCache"] = None,
+) -> List[Dict[str, str]]:
+    # String rows for scripts that still work with dicts; see fetch_records
+    records = fetch_records(invest_token, days_back, watermarks, overlap, account_ids, max_workers, cache)
+    return [record_to_row(record) for record in records]
+
+
+def iter_records(
+    invest_token: str,
+    days_back: int,
+    watermarks: Optional[Dict[str, str]] = None,
+    overlap: datetime.timedelta = DEFAULT_WATERMARK_OVERLAP,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursors: Optional[Dict[str, str]] = None,
+    account_ids: Optional[Iterable[str]] = None,
+) -> Iterator[OperationRecord]:
+    """Stream operations page by page via GetOperationsByCursor.
+
+    Accounts are walked one after another so that only one page is held in
+    memory at a time. When ``cursors`` is given, the next-page cursor of each
+    account is stored there after every page that was fully consumed, so an
+    interrupted run can resume from the same dict; the entry is removed once
+    the account is exhausted. Watermarks advance per account after its last
+    page, as in ``fetch_records``.
+    """
+    with Client(invest_token) as client:
+        for account_id in _select_accounts(client, account_ids):
+            start_date, end_date = _resolve_range(days_back, account_id, watermarks, overlap)
+            cursor = cursors.get(account_id, "") if cursors is not None else ""
+            logging.info(
+                "Streaming operations of account %s from %s to %s (page size %d%s)",
+                account_id,
+                start_date,
+                end_date,
+                page_size,
+                ", resuming" if cursor else "",
             )
-            if not op_id:
-                fingerprint = (
-                    f"{getattr(op, 'date', '')}|{getattr(op, 'type', '')}|"
-                    f"{getattr(op, 'currency', '')}|{getattr(op, 'payment', '')}|"
-                    f"{getattr(op, 'status', '')}|{getattr(op, 'description', '')}"
+
+            newest: Optional[datetime.datetime] = None
+            pages = 0
+            total = 0
+            while True:
+                response = get_rate_limiter().call(
+                    "get_operations_by_cursor",
+                    client.operations.get_operations_by_cursor,
+                    GetOperationsByCursorRequest(
+                        account_id=account_id,
+                        from_=start_date,
+                        to=end_date,
+                        cursor=cursor,
+                        limit=page_size,
+                        without_trades=True,
+                    )
                 )
-                op_id = str(abs(hash(fingerprint)))
+                pages += 1
+                page = _enrich_with_client(client, [to_record(item, account_id) for item in response.items])
+                for record in page:
+                    if record.timestamp is not None and (newest is None or record.timestamp > newest):
+                        newest = record.timestamp
+                    total += 1
+                    yield record
+
+                if not response.has_next:
+                    break
+                cursor = response.next_cursor
+                if cursors is not None:
+                    cursors[account_id] = cursor
+
+            if cursors is not None:
+                cursors.pop(account_id, None)
+            logging.info("Streamed %d operations of account %s in %d pages", total, account_id, pages)
+            _advance_watermark(watermarks, account_id, format_date_msk(newest) if newest else "")
+
+
+def iter_operations(
+    invest_token: str,
+    days_back: int,
+    watermarks: Optional[Dict[str, str]] = None,
+    overlap: datetime.timedelta = DEFAULT_WATERMARK_OVERLAP,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursors: Optional[Dict[str, str]] = None,
+    account_ids: Optional[Iterable[str]] = None,
+) -> Iterator[Dict[str, str]]:
+    for record in iter_records(invest_token, days_back, watermarks, overlap, page_size, cursors, account_ids):
+        yield record_to_row(record)
+
+
+CSV_FIELDNAMES = [
+    "operation_id",
+    "account_id",
+    "date_msk",
+    "action",
+    "amount",
+    "currency",
+    "status",
+    "description",
+    "figi",
+    "ticker",
+    "instrument_name",
+    "instrument_type",
+]
+
+
+def write_csv(filepath: str, rows: Iterable[Dict[str, str]]) -> int:
+    with open(filepath, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
+        writer.writeheader()
+        # Row by row so generators from iter_operations are consumed lazily
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
 
-            raw_dt = getattr(op, "date", None)
-            if isinstance(raw_dt, datetime.datetime):
-                try:
-                    local_dt = raw_dt.astimezone(msk)
-                except Exception:
-                    local_dt = raw_dt
-                date_str = local_dt.strftime("%Y-%m-%d %H:%M:%S")
-            else:
-                date_str = str(raw_dt)
-
-            amount_str = _money_to_decimal_str(getattr(op, "payment", None))
-            action_ru = _rus_operation_type(getattr(op, "type", ""))
-            status_ru = _rus_operation_state(getattr(op, "status", ""))
-
-            rows.append(
-                {
-                    "operation_id": str(op_id),
-                    "date_msk": date_str,
-                    "action": action_ru,
-                    "amount": amount_str,
-                    "currency": str(getattr(op, "currency", "")),
-                    "status": status_ru,
-                    "description": str(getattr(op, "description", "")),
-                }
+
+def read_csv(filepath: str) -> Iterator[Dict[str, str]]:
+    with open(filepath, "r", newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
+
+_s3_clients: Dict[Tuple[str, str], object] = {}
+_s3_clients_lock = threading.Lock()
+
+
+def create_s3_client(access_key: str, secret_key: str):
+    """S3 client for Yandex Object Storage, one per process and key pair.
+
+    boto3 clients are thread-safe, so uploads, aliases and the pipeline share
+    one client and its connection pool instead of building a new one each time.
+    """
+    with _s3_clients_lock:
+        client = _s3_clients.get((access_key, secret_key))
+        if client is None:
+            session = boto3.session.Session()
+            client = session.client(
+                service_name="s3",
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+                endpoint_url="https://storage.yandexcloud.net",
+                region_name="ru-central1",
+                config=Config(signature_version="s3v4"),
             )
+            _s3_clients[(access_key, secret_key)] = client
+        return client
 
-        logging.info("Fetched %d operations", len(rows))
-        return rows
 
+def upload_to_yandex_s3(
+    filepath: str,
+    bucket_name: str,
+    access_key: str,
+    secret_key: str,
+    key: Optional[str] = None,
+    compression: str = "none",
+) -> None:
+    """Uploads the file under ``key`` (by default the file name in the bucket root).
 
-def write_csv(filepath: str, rows: List[Dict[str, str]]) -> None:
-    fieldnames = [
-        "operation_id",
-        "date_msk",
-        "action",
-        "amount",
-        "currency",
-        "status",
-        "description",
-    ]
-    with open(filepath, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        if rows:
-            writer.writerows(rows)
-
-
-def upload_to_yandex_s3(filepath: str, bucket_name: str, access_key: str, secret_key: str) -> None:
-    session = boto3.session.Session()
-    s3 = session.client(
-        service_name="s3",
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        endpoint_url="https://storage.yandexcloud.net",
-        region_name="ru-central1",
-        config=Config(signature_version="s3v4"),
-    )
-    s3.upload_file(filepath, bucket_name, os.path.basename(filepath))
+    With ``compression`` (gzip/zstd) the CSV is compressed while uploading; the key
+    should already carry the matching suffix (see s3_exports.compressed_key).
+    """
+    s3 = create_s3_client(access_key, secret_key)
+    upload_file(s3, filepath, bucket_name, key or os.path.basename(filepath), compression)
 
 
 def main() -> None:
@@ -186,34 +775,35 @@ def main() -> None:
     date_suffix = now.strftime("%Y-%m-%d_%H-%M")
     filename = f"operations_{date_suffix}.csv"
     filepath = os.path.join(tempfile.gettempdir(), filename)
+    compression = get_export_compression()
+    s3_key = compressed_key(export_key(filename, now.date()), compression)
+    parquet_key = export_key(parquet_name(filename), now.date()) if get_export_parquet() else None
 
     try:
-        rows = fetch_operations(invest_token, days_back)
+        rows = fetch_operations(
+            invest_token,
+            days_back,
+            account_ids=get_account_ids(),
+            max_workers=get_fetch_concurrency(),
+        )
         write_csv(filepath, rows)
-        upload_to_yandex_s3(filepath, bucket_name, ya_access_key, ya_secret_key)
-        logging.info("Upload finished successfully: %s -> bucket %s", filepath, bucket_name)
+        s3_client = create_s3_client(ya_access_key, ya_secret_key)
+        upload_file(s3_client, filepath, bucket_name, s3_key, compression)
+        logging.info("Upload finished successfully: %s -> bucket %s as %s", filepath, bucket_name, s3_key)
+
+        if parquet_key:
+            try:
+                parquet = export_parquet(s3_client, filepath, bucket_name, parquet_key)
+                logging.info("Parquet export: %d rows in %d monthly row groups as %s",
+                             parquet["rows"], parquet["row_groups"], parquet_key)
+            except Exception as parquet_exc:  # noqa: BLE001
+                logging.exception("Parquet export failed: %s", parquet_exc)
 
         # Also publish stable aliases for Apps Script consumption
         try:
-            session = boto3.session.Session()
-            s3_client = session.client(
-                service_name="s3",
-                aws_access_key_id=ya_access_key,
-                aws_secret_access_key=ya_secret_key,
-                endpoint_url="https://storage.yandexcloud.net",
-                region_name="ru-central1",
-                config=Config(signature_version="s3v4"),
-            )
-            # 1) Upload same CSV under a stable key
-            stable_key = "operations_latest.csv"
-            s3_client.upload_file(filepath, bucket_name, stable_key)
-
-            # 2) Upload latest.json with the exact object key
-            latest_info_path = os.path.join(tempfile.gettempdir(), "latest.json")
-            with open(latest_info_path, "w", encoding="utf-8") as jf:
-                jf.write(json.dumps({"key": os.path.basename(filepath)}, ensure_ascii=False))
-            s3_client.upload_file(latest_info_path, bucket_name, "latest.json")
-            logging.info("Published aliases: %s and latest.json", stable_key)
+            # Server-side copy of the export plus latest.json with the exact object key
+            publish_latest(s3_client, filepath, bucket_name, s3_key, compression)
+            logging.info("Published aliases: %s and latest.json", LATEST_ALIAS_KEY)
         except Exception as alias_exc:  # noqa: BLE001
             logging.exception("Failed to publish aliases: %s", alias_exc)
 
@@ -16,10 +16,14 @@ from invest import (
     get_env_variable, 
     fetch_operations, 
     write_csv,
-    upload_to_yandex_s3
+    upload_to_yandex_s3,
+    row_to_supabase
 )
 
-from supabase import create_client, Client
+from supabase import Client
+from migrations import ensure_schema
+from supabase_client import get_supabase_client
+from upsert_engine import get_upsert_batch_size, get_upsert_concurrency, upsert_rows
 
 
 def setup_supabase():
@@ -34,7 +38,7 @@ def setup_supabase():
             print("export SUPABASE_KEY='your_supabase_anon_key'")
             return None
         
-        supabase = create_client(supabase_url, supabase_key)
+        supabase = get_supabase_client(supabase_url, supabase_key)
         print("✅ Supabase подключен")
         return supabase
         
@@ -43,29 +47,19 @@ def setup_supabase():
         return None
 
 
-def создать_таблицу_supabase(supabase: Client):
-    """Создание таблицы в Supabase"""
+def создать_таблицу_supabase(supabase: Client) -> bool:
+    """Применение недостающих миграций схемы Supabase (см. migrations.py)
+
+    Без них upsert по (operation_id, date_msk) невозможен, поэтому при ошибке загрузка не выполняется.
+    """
     try:
-        sql = """
-        CREATE TABLE IF NOT EXISTS tinkoff_operations (
-            id SERIAL PRIMARY KEY,
-            operation_id VARCHAR(100) UNIQUE NOT NULL,
-            date_msk TIMESTAMP NOT NULL,
-            action VARCHAR(200) NOT NULL,
-            amount DECIMAL(15,2) NOT NULL,
-            currency VARCHAR(10) NOT NULL,
-            status VARCHAR(50) NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT NOW(),
-            updated_at TIMESTAMP DEFAULT NOW()
-        );
-        """
-        
-        supabase.rpc('exec_sql', {'sql': sql}).execute()
-        print("✅ Таблица tinkoff_operations создана в Supabase")
+        версия = ensure_schema(supabase)
+        print(f"✅ Схема Supabase актуальна (версия {версия})")
+        return True
         
     except Exception as e:
-        print(f"⚠️ Ошибка создания таблицы: {e}")
+        print(f"❌ Ошибка миграции схемы: {e}")
+        return False
 
 
 def загрузить_в_supabase(supabase: Client, операции: List[Dict]) -> int:
@@ -76,26 +70,16 @@ def загрузить_в_supabase(supabase: Client, операции: List[Dict
             return 0
         
         # Преобразуем данные для Supabase
-        supabase_data = []
-        for операция in операции:
-            supabase_data.append({
-                'operation_id': операция['operation_id'],
-                'date_msk': операция['date_msk'],
-                'action': операция['action'],
-                'amount': float(операция['amount']),
-                'currency': операция['currency'],
-                'status': операция['status'],
-                'description': операция['description']
-            })
-        
-        # Загружаем данные в Supabase (upsert - обновляем существующие)
-        result = supabase.table('tinkoff_operations').upsert(
-            supabase_data, 
-            on_conflict='operation_id'
-        ).execute()
-        
-        загружено = len(result.data)
-        print(f"✅ Загружено {загружено} операций в Supabase")
+        supabase_data = [row_to_supabase(операция) for операция in операции]
+        
+        # Загружаем данные в Supabase пачками (upsert - обновляем существующие)
+        результат = upsert_rows(
+            supabase, supabase_data, batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency()
+        )
+        загружено = результат['loaded']
+        print(f"✅ Загружено {загружено} операций в Supabase ({результат['rows_per_sec']:.0f} строк/с)")
+        if результат['failed']:
+            print(f"⚠️ Не загружено {результат['failed']} операций")
         
         return загружено
         
@@ -168,7 +152,8 @@ def main():
         # НОВОЕ: Загружаем в Supabase
         supabase = setup_supabase()
         if supabase:
-            создать_таблицу_supabase(supabase)
+            if not создать_таблицу_supabase(supabase):
+                return
             загружено = загрузить_в_supabase(supabase, rows)
             статистика = получить_статистику_supabase(supabase)
             
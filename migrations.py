@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Версионированные миграции схемы Supabase
+Примененные версии хранятся в таблице schema_version, а последняя известная
+версия — в локальном маркере (SCHEMA_MARKER_FILE). Если маркер совпадает с
+последней миграцией, запуск синхронизации не делает ни одного DDL-запроса.
+
+С PARTITION_OPERATIONS=1 tinkoff_operations переносится в таблицу,
+секционированную по месяцам date_msk. Секции создаются на
+PARTITION_MONTHS_AHEAD месяцев вперед; маркер помнит, до какого месяца они
+есть, и функция создания секций вызывается, только когда запас кончается.
+Ключ upsert (operation_id, date_msk) есть у обеих раскладок таблицы.
+
+Запуск вручную: python3 migrations.py [--force] [--partition]
+"""
+
+import json
+import logging
+import os
+import sys
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from daily_totals import DAILY_TOTALS_SQL
+from supabase_stats import STATS_SQL
+
+DEFAULT_SCHEMA_MARKER_FILE = ".schema_version.json"
+DEFAULT_PARTITION_MONTHS_AHEAD = 3
+
+OPERATIONS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS tinkoff_operations (
+    id SERIAL PRIMARY KEY,
+    operation_id VARCHAR(100) UNIQUE NOT NULL,
+    date_msk TIMESTAMP NOT NULL,
+    action VARCHAR(200) NOT NULL,
+    amount DECIMAL(15,2) NOT NULL,
+    currency VARCHAR(10) NOT NULL,
+    status VARCHAR(50) NOT NULL,
+    description TEXT,
+    account_id VARCHAR(50),
+    figi VARCHAR(20),
+    ticker VARCHAR(50),
+    instrument_name VARCHAR(200),
+    instrument_type VARCHAR(50),
+    row_hash VARCHAR(32),
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+-- Таблицы, созданные старыми версиями скриптов
+ALTER TABLE tinkoff_operations ADD COLUMN IF NOT EXISTS account_id VARCHAR(50);
+ALTER TABLE tinkoff_operations ADD COLUMN IF NOT EXISTS figi VARCHAR(20);
+ALTER TABLE tinkoff_operations ADD COLUMN IF NOT EXISTS ticker VARCHAR(50);
+ALTER TABLE tinkoff_operations ADD COLUMN IF NOT EXISTS instrument_name VARCHAR(200);
+ALTER TABLE tinkoff_operations ADD COLUMN IF NOT EXISTS instrument_type VARCHAR(50);
+ALTER TABLE tinkoff_operations ADD COLUMN IF NOT EXISTS row_hash VARCHAR(32);
+"""
+
+OPERATIONS_INDEXES_SQL = """
+CREATE INDEX IF NOT EXISTS tinkoff_operations_date_msk_idx ON tinkoff_operations (date_msk DESC);
+CREATE INDEX IF NOT EXISTS tinkoff_operations_currency_action_idx ON tinkoff_operations (currency, action);
+CREATE INDEX IF NOT EXISTS tinkoff_operations_account_id_idx ON tinkoff_operations (account_id);
+"""
+
+OPERATION_KEY_SQL = """
+-- Ключ конфликта upsert; у секционированной таблицы он обязан включать date_msk
+CREATE UNIQUE INDEX IF NOT EXISTS tinkoff_operations_operation_id_date_msk_key
+    ON tinkoff_operations (operation_id, date_msk);
+"""
+
+# Только у секционированной таблицы: у обычной operation_id уникален сам по себе
+OPERATION_ID_GUARD_SQL = """
+-- У секционированной таблицы UNIQUE(operation_id) невозможен: если дата операции
+-- изменилась, прежняя строка удаляется, и upsert не оставляет двух версий операции
+CREATE OR REPLACE FUNCTION tinkoff_operations_operation_id_guard() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    DELETE FROM tinkoff_operations WHERE operation_id = NEW.operation_id AND date_msk <> NEW.date_msk;
+    RETURN NEW;
+END $$;
+
+DROP TRIGGER IF EXISTS tinkoff_operations_operation_id_guard ON tinkoff_operations;
+CREATE TRIGGER tinkoff_operations_operation_id_guard BEFORE INSERT ON tinkoff_operations
+    FOR EACH ROW EXECUTE FUNCTION tinkoff_operations_operation_id_guard();
+"""
+
+# Ранняя версия миграции 4 ставила триггер и на несекционированную таблицу
+OPERATION_ID_GUARD_CLEANUP_SQL = """
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'tinkoff_operations'::regclass) THEN
+        DROP TRIGGER IF EXISTS tinkoff_operations_operation_id_guard ON tinkoff_operations;
+    END IF;
+END $$;
+"""
+
+OPERATIONS_PARTITIONS_SQL = """
+-- Недостающие месячные секции: месяцы строк из секции по умолчанию и месяцы
+-- от start_date до months_ahead месяцев вперед. Строки из секции по умолчанию
+-- переносятся в новые секции.
+CREATE OR REPLACE FUNCTION tinkoff_operations_create_partitions(start_date DATE, months_ahead INTEGER DEFAULT 3)
+RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+    month_start DATE;
+    month_end DATE;
+    partition_name TEXT;
+    created INTEGER := 0;
+BEGIN
+    IF to_regclass('tinkoff_operations_pdefault') IS NULL THEN
+        RETURN 0;
+    END IF;
+    -- Перенос — это DELETE из секции по умолчанию и INSERT в новую: его не должны
+    -- видеть триггеры статистики и дневных итогов, склонированные с родителя
+    ALTER TABLE tinkoff_operations_pdefault DISABLE TRIGGER USER;
+    FOR month_start IN
+        SELECT DISTINCT date_trunc('month', date_msk)::date FROM tinkoff_operations_pdefault
+        UNION
+        SELECT generate_series(
+            date_trunc('month', start_date),
+            date_trunc('month', now()) + make_interval(months => months_ahead),
+            interval '1 month'
+        )::date
+        ORDER BY 1
+    LOOP
+        month_end := (month_start + interval '1 month')::date;
+        partition_name := format('tinkoff_operations_p%s', to_char(month_start, 'YYYY_MM'));
+        IF to_regclass(partition_name) IS NULL THEN
+            -- Таблица без триггеров: вставка в нее тоже не меняет счетчики
+            EXECUTE format('CREATE TABLE %I (LIKE tinkoff_operations INCLUDING DEFAULTS)', partition_name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM tinkoff_operations_pdefault WHERE date_msk >= %L AND date_msk < %L RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved',
+                month_start, month_end, partition_name
+            );
+            EXECUTE format(
+                'ALTER TABLE tinkoff_operations ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end
+            );
+            created := created + 1;
+        END IF;
+    END LOOP;
+    ALTER TABLE tinkoff_operations_pdefault ENABLE TRIGGER USER;
+    RETURN created;
+END $$;
+"""
+
+# Только с PARTITION_OPERATIONS=1 (или migrations.py --partition)
+PARTITION_TABLE_SQL = """
+-- Перенос несекционированной таблицы: строки копируются в секции, старая таблица удаляется
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'tinkoff_operations'::regclass) THEN
+        RETURN;
+    END IF;
+    ALTER TABLE tinkoff_operations RENAME TO tinkoff_operations_unpartitioned;
+    ALTER SEQUENCE IF EXISTS tinkoff_operations_id_seq RENAME TO tinkoff_operations_unpartitioned_id_seq;
+    ALTER INDEX IF EXISTS tinkoff_operations_pkey RENAME TO tinkoff_operations_unpartitioned_pkey;
+    ALTER INDEX IF EXISTS tinkoff_operations_operation_id_key RENAME TO tinkoff_operations_unpartitioned_operation_id_key;
+    ALTER INDEX IF EXISTS tinkoff_operations_operation_id_date_msk_key
+        RENAME TO tinkoff_operations_unpartitioned_operation_id_date_msk_key;
+    DROP INDEX IF EXISTS tinkoff_operations_date_msk_idx;
+    DROP INDEX IF EXISTS tinkoff_operations_currency_action_idx;
+    DROP INDEX IF EXISTS tinkoff_operations_account_id_idx;
+
+    -- Уникальные ключи секционированной таблицы обязаны включать date_msk
+    CREATE TABLE tinkoff_operations (
+        id SERIAL,
+        operation_id VARCHAR(100) NOT NULL,
+        date_msk TIMESTAMP NOT NULL,
+        action VARCHAR(200) NOT NULL,
+        amount DECIMAL(15,2) NOT NULL,
+        currency VARCHAR(10) NOT NULL,
+        status VARCHAR(50) NOT NULL,
+        description TEXT,
+        account_id VARCHAR(50),
+        figi VARCHAR(20),
+        ticker VARCHAR(50),
+        instrument_name VARCHAR(200),
+        instrument_type VARCHAR(50),
+        row_hash VARCHAR(32),
+        created_at TIMESTAMP DEFAULT NOW(),
+        updated_at TIMESTAMP DEFAULT NOW(),
+        PRIMARY KEY (id, date_msk),
+        UNIQUE (operation_id, date_msk)
+    ) PARTITION BY RANGE (date_msk);
+    CREATE TABLE tinkoff_operations_pdefault PARTITION OF tinkoff_operations DEFAULT;
+    PERFORM tinkoff_operations_create_partitions(
+        COALESCE((SELECT min(date_msk) FROM tinkoff_operations_unpartitioned)::date, CURRENT_DATE)
+    );
+
+    INSERT INTO tinkoff_operations (
+        id, operation_id, date_msk, action, amount, currency, status, description, account_id,
+        figi, ticker, instrument_name, instrument_type, row_hash, created_at, updated_at
+    )
+    SELECT
+        id, operation_id, date_msk, action, amount, currency, status, description, account_id,
+        figi, ticker, instrument_name, instrument_type, row_hash, created_at, updated_at
+    FROM tinkoff_operations_unpartitioned;
+    PERFORM setval(
+        pg_get_serial_sequence('tinkoff_operations', 'id'),
+        COALESCE((SELECT max(id) FROM tinkoff_operations), 0) + 1,
+        false
+    );
+    DROP TABLE tinkoff_operations_unpartitioned;
+END $$;
+
+-- Поиск прежней строки операции в триггере идет по всем секциям
+CREATE INDEX IF NOT EXISTS tinkoff_operations_operation_id_idx ON tinkoff_operations (operation_id);
+"""
+
+# (версия, название, SQL) — только дописывать в конец, примененные не менять
+MIGRATIONS: List[Tuple[int, str, str]] = [
+    (1, "tinkoff_operations", OPERATIONS_TABLE_SQL),
+    (2, "tinkoff_operations_stats", STATS_SQL),
+    (3, "tinkoff_operations_indexes", OPERATIONS_INDEXES_SQL),
+    (4, "tinkoff_operations_operation_key", OPERATION_KEY_SQL + OPERATIONS_PARTITIONS_SQL),
+    (5, "daily_operation_totals", DAILY_TOTALS_SQL),
+    (6, "tinkoff_operations_unpartitioned_guard_cleanup", OPERATION_ID_GUARD_CLEANUP_SQL),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Индексы, ключ и триггеры заново: старые уходят вместе со старой таблицей
+PARTITIONING_SQL = (
+    PARTITION_TABLE_SQL + OPERATIONS_INDEXES_SQL + OPERATION_KEY_SQL + OPERATION_ID_GUARD_SQL
+    + STATS_SQL + DAILY_TOTALS_SQL
+)
+
+SCHEMA_VERSION_SQL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name VARCHAR(200) NOT NULL,
+    applied_at TIMESTAMP DEFAULT NOW()
+);
+"""
+
+
+def _marker_file() -> str:
+    return os.environ.get("SCHEMA_MARKER_FILE", DEFAULT_SCHEMA_MARKER_FILE)
+
+
+def get_partition_months_ahead() -> int:
+    months_str = os.environ.get("PARTITION_MONTHS_AHEAD", str(DEFAULT_PARTITION_MONTHS_AHEAD))
+    try:
+        return max(1, int(months_str))
+    except ValueError:
+        raise RuntimeError("PARTITION_MONTHS_AHEAD must be an integer")
+
+
+def get_partition_operations() -> bool:
+    return os.environ.get("PARTITION_OPERATIONS", "").lower() in ("1", "true", "yes")
+
+
+def _month_index(day: date) -> int:
+    return day.year * 12 + day.month - 1
+
+
+def _load_marker(path: str) -> Dict[str, Dict]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            marker = json.load(f)
+        # Маркер первой версии хранил только номер схемы
+        return {str(k): v if isinstance(v, dict) else {"version": int(v)} for k, v in marker.items()}
+    except (OSError, ValueError, AttributeError) as e:
+        logging.warning("Ignoring unreadable schema marker %s: %s", path, e)
+        return {}
+
+
+def _save_marker(path: str, marker: Dict[str, Dict]) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(marker, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _remote_version(supabase) -> int:
+    try:
+        result = supabase.table('schema_version').select('version').order('version', desc=True).limit(1).execute()
+    except Exception as e:
+        # Таблицы еще нет (или PostgREST о ней не знает): миграции идемпотентны
+        logging.info("schema_version is not readable yet, assuming version 0: %s", e)
+        return 0
+    return int(result.data[0]['version']) if result.data else 0
+
+
+def _ensure_partitions(supabase, state: Dict) -> bool:
+    """Создает секции на PARTITION_MONTHS_AHEAD месяцев вперед, если запас меньше месяца"""
+    today = date.today()
+    if state.get("partitions_until", -1) > _month_index(today):
+        return False
+    months_ahead = get_partition_months_ahead()
+    # CREATE TABLE и ATTACH PARTITION требуют прав владельца таблицы: как и остальной DDL, через exec_sql
+    _exec_migration_sql(
+        supabase, f"SELECT tinkoff_operations_create_partitions('{today.isoformat()}'::date, {months_ahead});"
+    )
+    logging.info("tinkoff_operations partitions ensured %d months ahead", months_ahead)
+    state["partitions_until"] = _month_index(today) + months_ahead
+    return True
+
+
+def _exec_migration_sql(supabase, sql: str) -> None:
+    # Один вызов exec_sql — одна транзакция.
+    # NOTIFY обновляет кеш схемы PostgREST, чтобы новые таблицы и функции были видны сразу.
+    supabase.rpc('exec_sql', {'sql': f"{sql}\nNOTIFY pgrst, 'reload schema';"}).execute()
+
+
+def ensure_schema(supabase, force: bool = False, partition: Optional[bool] = None) -> int:
+    """Применяет недостающие миграции, продлевает секции и возвращает текущую версию схемы
+
+    ``partition`` (по умолчанию PARTITION_OPERATIONS) переносит tinkoff_operations
+    в секционированную таблицу; перенос выполняется один раз и отмечается в маркере.
+    """
+    if partition is None:
+        partition = get_partition_operations()
+    marker_key = os.environ.get("SUPABASE_URL", "") or str(getattr(supabase, "supabase_url", ""))
+    marker_path = _marker_file()
+    marker = _load_marker(marker_path)
+    state = marker.setdefault(marker_key, {})
+    changed = False
+
+    if force or state.get("version", 0) < LATEST_VERSION:
+        version = _remote_version(supabase)
+        pending = [migration for migration in MIGRATIONS if migration[0] > version]
+        for number, name, sql in pending:
+            logging.info("Applying schema migration %d (%s)", number, name)
+            # Миграция и отметка о ней применяются вместе
+            _exec_migration_sql(supabase, (
+                f"{SCHEMA_VERSION_SQL}\n{sql}\n"
+                f"INSERT INTO schema_version (version, name) VALUES ({number}, '{name}') ON CONFLICT DO NOTHING;"
+            ))
+            version = number
+        if pending:
+            logging.info("Schema is at version %d", version)
+        state["version"] = version
+        changed = True
+
+    if partition and not state.get("partitioned"):
+        logging.info("Converting tinkoff_operations to a partitioned table")
+        # Перенос создает секции от первой операции; запас вперед продлевает _ensure_partitions
+        _exec_migration_sql(supabase, PARTITIONING_SQL)
+        state["partitioned"] = True
+        state.pop("partitions_until", None)
+        changed = True
+
+    if state.get("partitioned"):
+        changed = _ensure_partitions(supabase, state) or changed
+    if changed:
+        _save_marker(marker_path, marker)
+    return state["version"]
+
+
+def main():
+    """Основная функция"""
+    from supabase_client import get_supabase_client
+
+    supabase_url = os.environ.get("SUPABASE_URL")
+    supabase_key = os.environ.get("SUPABASE_KEY")
+    if not supabase_url or not supabase_key:
+        print("❌ Переменные SUPABASE_URL и SUPABASE_KEY не настроены")
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    version = ensure_schema(
+        get_supabase_client(supabase_url, supabase_key),
+        force='--force' in sys.argv[1:],
+        partition=True if '--partition' in sys.argv[1:] else None,
+    )
+    print(f"✅ Версия схемы: {version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальный кеш операций Тинькофф в SQLite
+Операции хранятся по (account_id, operation_id), рядом — окна, которые уже
+выгружены из API. Повторный запуск читает покрытые окна с диска и запрашивает
+у API только непокрытые промежутки. Кеш включается явно: OPERATIONS_CACHE_FILE.
+Новое окно вытесняет перекрытые части старых, а устоявшиеся окна сливаются,
+поэтому таблица окон не растет от запуска к запуску.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from invest import DEFAULT_WATERMARK_OVERLAP, OperationRecord, get_watermark_overlap, record_to_row
+
+DEFAULT_CACHE_TTL = datetime.timedelta(hours=12)
+
+Window = Tuple[datetime.datetime, datetime.datetime]
+
+# Меняется вместе с _SCHEMA; кеш другой версии пересоздается
+_SCHEMA_VERSION = 3
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS operations (
+    account_id TEXT NOT NULL,
+    operation_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    type_label TEXT NOT NULL,
+    type_code INTEGER NOT NULL,
+    amount_minor INTEGER NOT NULL,
+    currency TEXT NOT NULL,
+    state_code INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    figi TEXT NOT NULL,
+    instrument_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (account_id, operation_id)
+);
+CREATE INDEX IF NOT EXISTS operations_account_ts ON operations (account_id, ts);
+CREATE TABLE IF NOT EXISTS windows (
+    account_id TEXT NOT NULL,
+    start_ts REAL NOT NULL,
+    end_ts REAL NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS windows_account ON windows (account_id, end_ts);
+"""
+
+
+def _to_ts(value: datetime.datetime) -> float:
+    return value.timestamp()
+
+
+def _from_ts(value: float, like: datetime.datetime) -> datetime.datetime:
+    # Окна приходят то наивными (build_date_range), то aware — возвращаем в том же виде
+    if like.tzinfo is None:
+        return datetime.datetime.fromtimestamp(value)
+    return datetime.datetime.fromtimestamp(value, tz=like.tzinfo)
+
+
+def _merge(intervals: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    merged: List[Tuple[float, float]] = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class OperationsCache:
+    """Кеш нормализованных операций и выгруженных окон"""
+
+    def __init__(
+        self,
+        path: str,
+        ttl: datetime.timedelta = DEFAULT_CACHE_TTL,
+        settle: datetime.timedelta = DEFAULT_WATERMARK_OVERLAP,
+    ):
+        self.path = path
+        self.ttl = ttl
+        # Часть окна, которая на момент выгрузки была старше settle, уже не меняется
+        self.settle = settle
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != _SCHEMA_VERSION:
+            self._db.executescript("DROP TABLE IF EXISTS operations; DROP TABLE IF EXISTS windows;")
+            self._db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        self._db.executescript(_SCHEMA)
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "operations": 0, "bytes_saved": 0}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _covered(self, account_id: str, start: float, end: float) -> List[Tuple[float, float]]:
+        """Отрезки [start, end], которые можно прочитать с диска"""
+        now = time.time()
+        rows = self._db.execute(
+            "SELECT start_ts, end_ts, fetched_at FROM windows WHERE account_id = ? AND end_ts > ? AND start_ts < ?",
+            (account_id, start, end),
+        ).fetchall()
+        intervals = []
+        for window_start, window_end, fetched_at in rows:
+            if now - fetched_at >= self.ttl.total_seconds():
+                # Устаревшее окно годится только в устоявшейся части
+                window_end = min(window_end, fetched_at - self.settle.total_seconds())
+            window_start, window_end = max(window_start, start), min(window_end, end)
+            if window_start < window_end:
+                intervals.append((window_start, window_end))
+        return _merge(intervals)
+
+    def _replace_windows(self, account_id: str, start: float, end: float) -> None:
+        """Убирает из окон счета отрезок [start, end] и сливает устоявшиеся окна"""
+        now = time.time()
+        ttl, settle = self.ttl.total_seconds(), self.settle.total_seconds()
+        fresh: List[Tuple[float, float, float]] = []
+        settled: List[Tuple[float, float, float]] = []
+        rows = self._db.execute(
+            "SELECT start_ts, end_ts, fetched_at FROM windows WHERE account_id = ?", (account_id,)
+        ).fetchall()
+        for window_start, window_end, fetched_at in rows:
+            # Часть под новым окном больше не нужна: новое окно свежее
+            for piece_start, piece_end in ((window_start, min(window_end, start)), (max(window_start, end), window_end)):
+                if now - fetched_at >= ttl:
+                    piece_end = min(piece_end, fetched_at - settle)
+                if piece_start >= piece_end:
+                    continue
+                (settled if piece_end <= fetched_at - settle else fresh).append((piece_start, piece_end, fetched_at))
+        # Устоявшееся окно годится бессрочно, поэтому соседние можно слить
+        merged: List[Tuple[float, float, float]] = []
+        for piece_start, piece_end, fetched_at in sorted(settled):
+            if merged and piece_start <= merged[-1][1]:
+                last_start, last_end, last_fetched = merged[-1]
+                merged[-1] = (last_start, max(last_end, piece_end), max(last_fetched, fetched_at))
+            else:
+                merged.append((piece_start, piece_end, fetched_at))
+        self._db.execute("DELETE FROM windows WHERE account_id = ?", (account_id,))
+        self._db.executemany(
+            "INSERT INTO windows VALUES (?, ?, ?, ?)",
+            [(account_id, *window) for window in fresh + merged],
+        )
+
+    def plan(
+        self, account_id: str, start_date: datetime.datetime, end_date: datetime.datetime
+    ) -> Tuple[List[OperationRecord], List[Window]]:
+        """Операции из покрытых частей окна и непокрытые промежутки для API"""
+        start, end = _to_ts(start_date), _to_ts(end_date)
+        with self._lock:
+            covered = self._covered(account_id, start, end)
+            records: List[OperationRecord] = []
+            for covered_start, covered_end in covered:
+                rows = self._db.execute(
+                    "SELECT operation_id, ts, type_label, type_code, amount_minor, currency, state_code,"
+                    " description, figi, instrument_type, size"
+                    " FROM operations WHERE account_id = ? AND ts >= ? AND ts <= ?",
+                    (account_id, covered_start, covered_end),
+                ).fetchall()
+                for (operation_id, ts, type_label, type_code, amount_minor, currency, state_code,
+                     description, figi, instrument_type, size) in rows:
+                    records.append(OperationRecord(
+                        operation_id=operation_id,
+                        account_id=account_id,
+                        timestamp=datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc),
+                        type_label=type_label,
+                        type_code=type_code,
+                        amount_minor=amount_minor,
+                        currency=currency,
+                        state_code=state_code,
+                        description=description,
+                        figi=figi,
+                        instrument_type=instrument_type,
+                    ))
+                    self.stats["bytes_saved"] += size
+
+            gaps: List[Window] = []
+            cursor = start
+            for covered_start, covered_end in covered:
+                if cursor < covered_start:
+                    gaps.append((cursor, covered_start))
+                cursor = max(cursor, covered_end)
+            if cursor < end:
+                gaps.append((cursor, end))
+
+            self.stats["hits"] += len(covered)
+            self.stats["misses"] += len(gaps)
+            self.stats["operations"] += len(records)
+        return records, [(_from_ts(s, start_date), _from_ts(e, end_date)) for s, e in gaps]
+
+    def store(
+        self,
+        account_id: str,
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+        records: Iterable[OperationRecord],
+    ) -> None:
+        """Сохраняет операции полностью выгруженного окна и само окно"""
+        rows = []
+        for record in records:
+            if record.timestamp is None:
+                # Операцию без даты нельзя отнести к окну: окно не кешируется,
+                # иначе при чтении с диска она бы потерялась
+                logging.info("Operation %s of account %s has no date, window is not cached", record.operation_id, account_id)
+                return
+            # Размер строки в CSV — оценка того, сколько не придется скачивать в следующий раз
+            size = len(",".join(record_to_row(record).values()).encode("utf-8"))
+            rows.append((
+                account_id,
+                record.operation_id,
+                _to_ts(record.timestamp),
+                record.type_label,
+                record.type_code,
+                record.amount_minor,
+                record.currency,
+                record.state_code,
+                record.description,
+                record.figi,
+                record.instrument_type,
+                size,
+            ))
+        start, end = _to_ts(start_date), _to_ts(end_date)
+        with self._lock, self._db:
+            # Окно из API — полное содержимое отрезка: исчезнувшие операции тоже уходят
+            self._db.execute(
+                "DELETE FROM operations WHERE account_id = ? AND ts >= ? AND ts <= ?", (account_id, start, end)
+            )
+            self._db.executemany("INSERT OR REPLACE INTO operations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._replace_windows(account_id, start, end)
+            self._db.execute("INSERT INTO windows VALUES (?, ?, ?, ?)", (account_id, start, end, time.time()))
+
+
+def get_cache_ttl() -> datetime.timedelta:
+    ttl_str = os.environ.get("OPERATIONS_CACHE_TTL_HOURS")
+    if not ttl_str:
+        return DEFAULT_CACHE_TTL
+    try:
+        return datetime.timedelta(hours=max(0.0, float(ttl_str)))
+    except ValueError:
+        raise RuntimeError("OPERATIONS_CACHE_TTL_HOURS must be a number")
+
+
+_cache: Optional[OperationsCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_operations_cache() -> Optional[OperationsCache]:
+    """Кеш процесса по OPERATIONS_CACHE_FILE; без него (по умолчанию) кеш выключен"""
+    global _cache
+    path = os.environ.get("OPERATIONS_CACHE_FILE", "")
+    if not path:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.path != path:
+            try:
+                _cache = OperationsCache(path, get_cache_ttl(), get_watermark_overlap())
+            except sqlite3.Error as e:
+                logging.warning("Operations cache %s is unavailable: %s", path, e)
+                return None
+        return _cache
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальная очередь неотправленных записей в Supabase (SQLite)
+Пачки, которые не удалось записать даже после повторов, дописываются в
+очередь вместе с таблицей и ключом конфликта. Следующий запуск сначала
+отправляет их по порядку; upsert по ключу идемпотентен, поэтому повтор
+уже записанной пачки ничего не портит. После сбоя повторно отправляются
+только неотправленные строки, а не вся выгрузка.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from upsert_engine import DEFAULT_UPSERT_BATCH_SIZE, DEFAULT_UPSERT_CONCURRENCY, upsert_rows
+
+DEFAULT_OUTBOX_FILE = "supabase_outbox.db"
+DEFAULT_OUTBOX_MAX_ATTEMPTS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    on_conflict TEXT NOT NULL,
+    rows TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class Outbox:
+    """Очередь пачек строк, ожидающих записи в Supabase"""
+
+    def __init__(self, path: str, max_attempts: int = DEFAULT_OUTBOX_MAX_ATTEMPTS):
+        self.path = path
+        # После стольких неудачных разборов пачка откладывается, чтобы не держать очередь
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA synchronous = FULL")
+        self._db.executescript(_SCHEMA)
+        self.stats: Dict[str, int] = {"queued": 0, "replayed": 0, "dead": 0}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def append(self, table: str, on_conflict: str, rows: List[Dict]) -> None:
+        """Дописывает пачку в конец очереди"""
+        if not rows:
+            return
+        payload = json.dumps(rows, ensure_ascii=False, default=str)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO batches (table_name, on_conflict, rows, row_count, created_at) VALUES (?, ?, ?, ?, ?)",
+                (table, on_conflict, payload, len(rows), time.time()),
+            )
+            self.stats["queued"] += len(rows)
+
+    def extend(self, table: str, on_conflict: str, batches: Iterable[List[Dict]]) -> int:
+        """Дописывает несколько пачек; возвращает число строк"""
+        count = 0
+        for batch in batches:
+            self.append(table, on_conflict, batch)
+            count += len(batch)
+        return count
+
+    def pending(self) -> int:
+        """Сколько строк ждет отправки (без отложенных пачек)"""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(row_count), 0) FROM batches WHERE dead = 0").fetchone()[0]
+
+    def drain(
+        self,
+        supabase,
+        batch_size: int = DEFAULT_UPSERT_BATCH_SIZE,
+        concurrency: int = DEFAULT_UPSERT_CONCURRENCY,
+    ) -> Dict[str, int]:
+        """Отправляет пачки по порядку; на первой неудаче останавливается, чтобы не нарушить порядок"""
+        replayed = dead = 0
+        while True:
+            with self._lock:
+                entry = self._db.execute(
+                    "SELECT id, table_name, on_conflict, rows, row_count, attempts"
+                    " FROM batches WHERE dead = 0 ORDER BY id LIMIT 1"
+                ).fetchone()
+            if entry is None:
+                break
+            entry_id, table, on_conflict, payload, row_count, attempts = entry
+            result = upsert_rows(
+                supabase, json.loads(payload), table, on_conflict,
+                batch_size=batch_size, concurrency=concurrency,
+            )
+            if not result["failed"]:
+                with self._lock, self._db:
+                    self._db.execute("DELETE FROM batches WHERE id = ?", (entry_id,))
+                replayed += row_count
+                continue
+
+            attempts += 1
+            if attempts < self.max_attempts:
+                with self._lock, self._db:
+                    self._db.execute("UPDATE batches SET attempts = ? WHERE id = ?", (attempts, entry_id))
+                logging.warning(
+                    "Outbox batch %d (%d rows into %s) failed again, attempt %d/%d",
+                    entry_id, row_count, table, attempts, self.max_attempts,
+                )
+                break
+            # Скорее всего, ошибка в самих данных: пачка остается в файле для разбора
+            with self._lock, self._db:
+                self._db.execute("UPDATE batches SET attempts = ?, dead = 1 WHERE id = ?", (attempts, entry_id))
+            logging.error(
+                "Outbox batch %d (%d rows into %s) failed %d times, setting it aside",
+                entry_id, row_count, table, attempts,
+            )
+            dead += row_count
+
+        self.stats["replayed"] += replayed
+        self.stats["dead"] += dead
+        return {"replayed": replayed, "dead": dead, "remaining": self.pending()}
+
+
+def get_outbox_max_attempts() -> int:
+    attempts_str = os.environ.get("OUTBOX_MAX_ATTEMPTS", str(DEFAULT_OUTBOX_MAX_ATTEMPTS))
+    try:
+        return max(1, int(attempts_str))
+    except ValueError:
+        raise RuntimeError("OUTBOX_MAX_ATTEMPTS must be an integer")
+
+
+_outbox: Optional[Outbox] = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox() -> Optional[Outbox]:
+    """Очередь процесса по OUTBOX_FILE; пустое значение отключает очередь"""
+    global _outbox
+    path = os.environ.get("OUTBOX_FILE", DEFAULT_OUTBOX_FILE)
+    if not path:
+        return None
+    with _outbox_lock:
+        if _outbox is None or _outbox.path != path:
+            try:
+                _outbox = Outbox(path, get_outbox_max_attempts())
+            except sqlite3.Error as e:
+                logging.warning("Supabase outbox %s is unavailable: %s", path, e)
+                return None
+        return _outbox
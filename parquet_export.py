@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Выгрузка операций в Parquet рядом с CSV
+С EXPORT_PARQUET=1 локальный CSV выгрузки дополнительно переписывается в
+типизированный Parquet: сумма — целые копейки, date_msk — время без пояса
+(МСК), action/currency/status — словарные колонки. Строки отсортированы по
+date_msk, и каждый месяц пишется отдельной группой строк со статистикой
+min/max, поэтому читатель с фильтром по дате пропускает чужие месяцы, а
+колоночный формат позволяет читать только нужные колонки. Нужен pyarrow.
+"""
+
+import os
+from typing import Dict, List
+
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+# Сжатие страниц внутри файла; EXPORT_COMPRESSION к Parquet не применяется
+PARQUET_CODEC = "zstd"
+DICTIONARY_COLUMNS = ["action", "currency", "status", "instrument_type"]
+DATE_MSK_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("EXPORT_PARQUET=1 requires pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def get_export_parquet() -> bool:
+    enabled = os.environ.get("EXPORT_PARQUET", "").lower() in ("1", "true", "yes")
+    if enabled:
+        _pyarrow()
+    return enabled
+
+
+def parquet_name(csv_name: str) -> str:
+    """operations_*.csv → operations_*.parquet"""
+    return f"{csv_name[:-len('.csv')] if csv_name.endswith('.csv') else csv_name}.parquet"
+
+
+def _schema(pa):
+    text = pa.string()
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ("operation_id", text),
+        ("account_id", text),
+        ("date_msk", pa.timestamp("s")),
+        ("action", dictionary),
+        ("amount_minor", pa.int64()),
+        ("currency", dictionary),
+        ("status", dictionary),
+        ("description", text),
+        ("figi", text),
+        ("ticker", text),
+        ("instrument_name", text),
+        ("instrument_type", dictionary),
+    ])
+
+
+def _read_csv_table(pa, csv_path: str):
+    schema = _schema(pa)
+    column_types = {field.name: field.type for field in schema if field.name != "amount_minor"}
+    # format_minor всегда пишет два знака после точки: "-12.30" → -1230 копеек
+    column_types["amount"] = pa.string()
+    table = pa.csv.read_csv(
+        csv_path,
+        convert_options=pa.csv.ConvertOptions(
+            column_types=column_types,
+            timestamp_parsers=[DATE_MSK_FORMAT],
+            # Операция без даты записана в CSV как "None"
+            null_values=["", "None"],
+            strings_can_be_null=False,
+        ),
+    )
+    amount = pa.compute.cast(pa.compute.replace_substring(table["amount"], ".", ""), pa.int64())
+    table = table.set_column(table.schema.get_field_index("amount"), "amount_minor", amount)
+    # CSV, записанные до обогащения, без колонок инструмента
+    for field in schema:
+        if field.name not in table.column_names:
+            table = table.append_column(field.name, pa.array([""] * table.num_rows, field.type))
+    return table.select(schema.names).cast(schema)
+
+
+def _month_lengths(pa, table) -> List[int]:
+    # Таблица отсортирована по date_msk, поэтому value_counts идет по месяцам по порядку
+    dates = table["date_msk"]
+    months = pa.compute.add(pa.compute.multiply(pa.compute.year(dates), 12), pa.compute.month(dates))
+    return [count.as_py() for count in pa.compute.value_counts(months).field("counts")]
+
+
+def write_parquet(csv_path: str, parquet_path: str) -> Dict[str, int]:
+    """Переписывает CSV выгрузки в Parquet по группе строк на месяц; возвращает число строк и групп"""
+    pa = _pyarrow()
+    table = _read_csv_table(pa, csv_path).sort_by([("date_msk", "ascending")])
+    row_groups = 0
+    with pa.parquet.ParquetWriter(
+        parquet_path,
+        table.schema,
+        compression=PARQUET_CODEC,
+        use_dictionary=DICTIONARY_COLUMNS,
+        write_statistics=True,
+    ) as writer:
+        offset = 0
+        for length in _month_lengths(pa, table):
+            writer.write_table(table.slice(offset, length), row_group_size=length)
+            offset += length
+            row_groups += 1
+    return {"rows": table.num_rows, "row_groups": row_groups}
+
+
+def upload_parquet(s3_client, parquet_path: str, bucket: str, key: str) -> None:
+    s3_client.upload_file(parquet_path, bucket, key, ExtraArgs={"ContentType": PARQUET_CONTENT_TYPE})
+
+
+def export_parquet(s3_client, csv_path: str, bucket: str, key: str) -> Dict[str, int]:
+    """Parquet из локального CSV рядом с ним на диске и под key в бакете"""
+    parquet_path = os.path.join(os.path.dirname(csv_path), os.path.basename(key))
+    result = write_parquet(csv_path, parquet_path)
+    upload_parquet(s3_client, parquet_path, bucket, key)
+    return result
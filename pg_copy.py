@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Загрузка в Postgres Supabase напрямую через COPY
+Строки копируются во временную таблицу (она не пишет WAL) и одним
+INSERT ... ON CONFLICT DO UPDATE ... WHERE row_hash IS DISTINCT FROM
+сливаются в целевую таблицу. Нужен пакет psycopg 3 и DATABASE_URL.
+"""
+
+import logging
+import os
+import random
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+DEFAULT_COPY_BATCH_SIZE = 50_000
+STAGING_TABLE = "_operations_staging"
+
+
+def get_database_url() -> str:
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise RuntimeError("DATABASE_URL is required for UPSERT_BACKEND=copy")
+    return database_url
+
+
+def get_copy_batch_size() -> int:
+    batch_size_str = os.environ.get("COPY_BATCH_SIZE", str(DEFAULT_COPY_BATCH_SIZE))
+    try:
+        return max(1, int(batch_size_str))
+    except ValueError:
+        raise RuntimeError("COPY_BATCH_SIZE must be an integer")
+
+
+def _merge_sql(table: str, key: str, columns: List[str], hash_column: str) -> str:
+    column_list = ", ".join(columns)
+    key_columns = {column.strip() for column in key.split(",")}
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in columns if column not in key_columns)
+    matches = " AND ".join(f"t.{column} = k.{column}" for column in sorted(key_columns))
+    # Новые ключи считаются по снимку до вставки: подзапросы одного запроса не видят
+    # строк, записанных его CTE. Системная колонка xmax у секционированной таблицы недоступна
+    return f"""
+        WITH keys AS (
+            SELECT DISTINCT {key} FROM {STAGING_TABLE}
+        ), merged AS (
+            INSERT INTO {table} ({column_list})
+            SELECT DISTINCT ON ({key}) {column_list} FROM {STAGING_TABLE} ORDER BY {key}
+            ON CONFLICT ({key}) DO UPDATE SET {updates}
+            WHERE {table}.{hash_column} IS DISTINCT FROM EXCLUDED.{hash_column}
+            RETURNING 1
+        )
+        SELECT
+            (SELECT count(*) FROM keys),
+            (SELECT count(*) FROM keys k WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {matches})),
+            (SELECT count(*) FROM merged)
+    """
+
+
+def _copy_batch(conn, table: str, key: str, batch: List[Dict], hash_column: str) -> Dict[str, int]:
+    columns = list(batch[0].keys())
+    with conn.transaction(), conn.cursor() as cur:
+        # Те же типы колонок, что в целевой таблице, но без ограничений и индексов
+        cur.execute(
+            f"CREATE TEMP TABLE {STAGING_TABLE} ON COMMIT DROP AS "
+            f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA"
+        )
+        with cur.copy(f"COPY {STAGING_TABLE} ({', '.join(columns)}) FROM STDIN") as copy:
+            for row in batch:
+                copy.write_row([row.get(column) for column in columns])
+        cur.execute(_merge_sql(table, key, columns, hash_column))
+        staged, inserted, merged = cur.fetchone()
+    updated = merged - inserted
+    return {"inserted": inserted, "updated": updated, "unchanged": staged - merged}
+
+
+def copy_rows(
+    rows: Iterable[List[Dict]],
+    table: str,
+    on_conflict: str,
+    hash_column: str,
+    retries: int,
+    database_url: str = "",
+    on_failed: Optional[Callable[[List[Dict]], None]] = None,
+) -> Dict[str, float]:
+    """То же, что upsert_engine.upsert_rows, но через COPY; rows — пачки строк с row_hash.
+
+    on_failed получает каждую незаписанную пачку (например, Outbox.append).
+    """
+    try:
+        import psycopg
+    except ImportError:
+        raise RuntimeError("UPSERT_BACKEND=copy requires psycopg: pip install 'psycopg[binary]'")
+
+    result: Dict[str, float] = {
+        "loaded": 0, "failed": 0, "queued": 0, "inserted": 0, "updated": 0, "unchanged": 0,
+        "batches": 0, "seconds": 0.0, "rows_per_sec": 0.0,
+    }
+    started = time.monotonic()
+    # autocommit: каждая пачка — отдельная транзакция conn.transaction();
+    # prepare_threshold=None — совместимость с пулером Supabase в режиме transaction
+    with psycopg.connect(database_url or get_database_url(), autocommit=True, prepare_threshold=None) as conn:
+        for batch in rows:
+            attempt = 0
+            while True:
+                try:
+                    counts = _copy_batch(conn, table, on_conflict, batch, hash_column)
+                    break
+                except psycopg.OperationalError as exc:
+                    if attempt >= retries or conn.closed:
+                        counts = None
+                        logging.error("Failed to COPY %d rows into %s: %s", len(batch), table, exc)
+                        break
+                    delay = random.uniform(0, min(10.0, 0.5 * (2 ** attempt)))
+                    logging.warning(
+                        "COPY of %d rows into %s failed (%s), retry %d/%d in %.1fs",
+                        len(batch), table, exc, attempt + 1, retries, delay,
+                    )
+                    attempt += 1
+                    time.sleep(delay)
+                except psycopg.Error as exc:
+                    # Ошибка данных или схемы: повтор той же пачки не поможет
+                    counts = None
+                    logging.error("Failed to COPY %d rows into %s: %s", len(batch), table, exc)
+                    break
+
+            result["batches"] += 1
+            if counts is None:
+                result["failed"] += len(batch)
+                if on_failed is not None:
+                    on_failed(batch)
+                    result["queued"] += len(batch)
+                continue
+            for name, count in counts.items():
+                result[name] += count
+            result["loaded"] += len(batch)
+
+    result["seconds"] = time.monotonic() - started
+    if result["seconds"] > 0:
+        result["rows_per_sec"] = result["loaded"] / result["seconds"]
+    logging.info(
+        "Copied %d rows into %s in %d batches (%d new, %d changed, %d unchanged, %d failed), %.1fs, %.0f rows/s",
+        result["loaded"], table, result["batches"], result["inserted"], result["updated"], result["unchanged"],
+        result["failed"], result["seconds"], result["rows_per_sec"],
+    )
+    return result
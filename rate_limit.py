@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ограничение частоты запросов к Tinkoff Invest API
+Token bucket на каждый метод, повторы RESOURCE_EXHAUSTED/UNAVAILABLE с джиттером.
+RESOURCE_EXHAUSTED из-за размера ответа не повторяется: тот же запрос упадет
+снова, и его разбивает на части вызывающий (см. invest._is_splittable_error).
+"""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Лимиты unary-методов, запросов в минуту (см. документацию Tinkoff Invest API)
+DEFAULT_LIMITS_PER_MINUTE: Dict[str, int] = {
+    "get_accounts": 100,
+    "get_operations": 200,
+    "get_operations_by_cursor": 200,
+    "get_instrument_by": 200,
+}
+DEFAULT_LIMIT_PER_MINUTE = 100
+
+RETRYABLE_CODES = ("RESOURCE_EXHAUSTED", "UNAVAILABLE")
+# gRPC сообщает о превышении лимита размера сообщения тем же RESOURCE_EXHAUSTED
+MESSAGE_SIZE_MARKERS = ("message larger than max", "message too large")
+
+
+def error_code(exc: Exception) -> str:
+    code = getattr(exc, "code", None)
+    if callable(code):
+        # grpc.RpcError: code() — метод; у RequestError из tinkoff.invest — атрибут
+        code = code()
+    return getattr(code, "name", str(code))
+
+
+def is_message_size_error(exc: Exception) -> bool:
+    if error_code(exc) != "RESOURCE_EXHAUSTED":
+        return False
+    details = getattr(exc, "details", None)
+    if callable(details):
+        details = details()
+    text = f"{details or ''} {exc}".lower()
+    return any(marker in text for marker in MESSAGE_SIZE_MARKERS)
+
+
+class _TokenBucket:
+    """Корзина токенов: capacity запросов, пополняется равномерно за минуту"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(1, per_minute))
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд нужно подождать"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float) -> None:
+        """Сервер сообщил, что квота исчерпана до сброса окна"""
+        now = time.monotonic()
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = min(self.tokens, 0.0)
+        self.updated = now
+
+
+class RateLimiter:
+    """Общий планировщик вызовов API с учетом лимитов сервера"""
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, int]] = None,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        self.limits = dict(DEFAULT_LIMITS_PER_MINUTE)
+        self.limits.update(limits or {})
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._buckets: Dict[str, _TokenBucket] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, float] = {"calls": 0, "waits": 0, "wait_seconds": 0.0, "retries": 0, "failures": 0}
+
+    def _bucket(self, method: str) -> _TokenBucket:
+        bucket = self._buckets.get(method)
+        if bucket is None:
+            bucket = _TokenBucket(self.limits.get(method, DEFAULT_LIMIT_PER_MINUTE))
+            self._buckets[method] = bucket
+        return bucket
+
+    def _reserve(self, method: str) -> float:
+        with self._lock:
+            wait = self._bucket(method).reserve()
+            self.stats["calls"] += 1
+            if wait > 0:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += wait
+        return wait
+
+    def _retry_delay(self, method: str, attempt: int, exc: Exception) -> Optional[float]:
+        """Задержка перед повтором или None, если ошибку нужно пробросить"""
+        code = error_code(exc)
+        if code not in RETRYABLE_CODES or is_message_size_error(exc) or attempt >= self.max_retries:
+            with self._lock:
+                self.stats["failures"] += 1
+            return None
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        # RequestError несет метаданные x-ratelimit-*: ждем до сброса окна
+        reset = getattr(getattr(exc, "metadata", None), "ratelimit_reset", None)
+        with self._lock:
+            if reset:
+                self._bucket(method).block(float(reset))
+                delay = max(delay, float(reset))
+            self.stats["retries"] += 1
+        logging.warning("%s failed (%s), retry %d/%d in %.1fs", method, code, attempt + 1, self.max_retries, delay)
+        return delay
+
+    def call(self, method: str, func: Callable[..., T], *args, **kwargs) -> T:
+        """Вызов func с ожиданием квоты метода и повторами временных ошибок"""
+        attempt = 0
+        while True:
+            wait = self._reserve(method)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                return func(*args, **kwargs)
+            except Exception as exc:
+                delay = self._retry_delay(method, attempt, exc)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+
+    async def acall(self, method: str, func: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """То же, что call, для корутин AsyncClient (ожидание не блокирует цикл событий)"""
+        attempt = 0
+        while True:
+            wait = self._reserve(method)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                return await func(*args, **kwargs)
+            except Exception as exc:
+                delay = self._retry_delay(method, attempt, exc)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Один планировщик на процесс, чтобы все потоки делили квоты"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
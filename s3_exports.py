@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Раскладка выгрузок операций в Yandex Object Storage
+Выгрузки пишутся в секции по дате: operations/YYYY/MM/DD/operations_*.csv.
+Ключи в листинге S3 отсортированы лексикографически, а значит и по дате,
+поэтому «что нового с такого-то дня» — это один постраничный листинг с
+Prefix и StartAfter, сколько бы объектов ни лежало в бакете.
+Выгрузки читаются потоком из тела get_object, без временных файлов.
+
+С EXPORT_COMPRESSION=gzip|zstd выгрузки сжимаются потоком при загрузке
+(operations_*.csv.gz / .csv.zst с Content-Encoding), а чтение распознает
+сжатие по Content-Encoding или расширению и распаковывает тоже потоком.
+"""
+
+import codecs
+import csv
+import datetime
+import io
+import json
+import os
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional
+
+EXPORT_PREFIX = "operations/"
+# Так назывались выгрузки в корне бакета до секций по датам
+LEGACY_PREFIX = "operations_"
+LATEST_ALIAS_KEY = "operations_latest.csv"
+LATEST_INFO_KEY = "latest.json"
+# На сколько дней назад последовательно расширяется поиск последней выгрузки
+LATEST_LOOKBACK_DAYS = (1, 7, 31, 366)
+READ_CHUNK_SIZE = 1024 * 1024
+# Сжатие → расширение ключа; значение совпадает с Content-Encoding
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def day_prefix(day: datetime.date) -> str:
+    return f"{EXPORT_PREFIX}{day:%Y/%m/%d}/"
+
+
+def export_key(filename: str, day: datetime.date) -> str:
+    """Ключ выгрузки в секции ее дня"""
+    return f"{day_prefix(day)}{filename}"
+
+
+def is_export_key(key: str) -> bool:
+    name = key.rsplit("/", 1)[-1]
+    if not name.startswith(LEGACY_PREFIX) or name == LATEST_ALIAS_KEY:
+        return False
+    return any(name.endswith(f".csv{suffix}") for suffix in COMPRESSION_SUFFIXES.values())
+
+
+def _export_name(key: str) -> str:
+    # operations_YYYY-MM-DD_HH-MM.csv: имя файла сортируется по времени выгрузки
+    return key.rsplit("/", 1)[-1]
+
+
+def iter_keys(s3_client, bucket: str, prefix: str, start_after: Optional[str] = None) -> Iterator[str]:
+    """Все ключи с префиксом; list_objects_v2 отдает не больше 1000 за запрос, дальше — по токену"""
+    params = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        params["StartAfter"] = start_after
+    for page in s3_client.get_paginator("list_objects_v2").paginate(**params):
+        for obj in page.get("Contents", []):
+            yield obj["Key"]
+
+
+def list_exports(s3_client, bucket: str, since: Optional[datetime.date] = None) -> List[str]:
+    """Ключи выгрузок начиная с дня since (все, если since не задан), от старых к новым"""
+    keys = [
+        key for key in iter_keys(s3_client, bucket, EXPORT_PREFIX, day_prefix(since) if since else None)
+        if is_export_key(key)
+    ]
+    # Старые выгрузки из корня бакета: тот же прием, имя начинается с даты
+    legacy_start = f"{LEGACY_PREFIX}{since.isoformat()}" if since else None
+    keys += [key for key in iter_keys(s3_client, bucket, LEGACY_PREFIX, legacy_start) if is_export_key(key)]
+    return sorted(keys, key=_export_name)
+
+
+def export_day(key: str) -> Optional[datetime.date]:
+    """День выгрузки из имени operations_YYYY-MM-DD_HH-MM.csv"""
+    try:
+        return datetime.date.fromisoformat(_export_name(key)[len(LEGACY_PREFIX):][:10])
+    except ValueError:
+        return None
+
+
+def exports_after(s3_client, bucket: str, key: str) -> List[str]:
+    """Выгрузки новее key, от старых к новым; листинг начинается с дня key"""
+    return [
+        candidate for candidate in list_exports(s3_client, bucket, export_day(key))
+        if _export_name(candidate) > _export_name(key)
+    ]
+
+
+def latest_export(s3_client, bucket: str, today: Optional[datetime.date] = None) -> Optional[str]:
+    """Ключ последней выгрузки: сначала смотрим последние дни и только потом весь префикс"""
+    today = today or datetime.date.today()
+    for days in LATEST_LOOKBACK_DAYS:
+        keys = list_exports(s3_client, bucket, today - datetime.timedelta(days=days))
+        if keys:
+            return keys[-1]
+    keys = list_exports(s3_client, bucket)
+    return keys[-1] if keys else None
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("EXPORT_COMPRESSION=zstd requires zstandard: pip install zstandard")
+    return zstandard
+
+
+def get_export_compression() -> str:
+    compression = os.environ.get("EXPORT_COMPRESSION", "none").lower() or "none"
+    if compression not in COMPRESSION_SUFFIXES:
+        raise RuntimeError(f"EXPORT_COMPRESSION must be one of: {', '.join(COMPRESSION_SUFFIXES)}")
+    if compression == "zstd":
+        _zstandard()
+    return compression
+
+
+def compressed_key(key: str, compression: str) -> str:
+    return f"{key}{COMPRESSION_SUFFIXES[compression]}"
+
+
+def compression_of(key: str, content_encoding: Optional[str] = None) -> str:
+    """Сжатие объекта по Content-Encoding, а если его нет — по расширению ключа"""
+    if content_encoding in COMPRESSION_SUFFIXES:
+        return content_encoding
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if suffix and key.endswith(suffix):
+            return compression
+    return "none"
+
+
+def upload_args(compression: str) -> Dict[str, str]:
+    """ExtraArgs/параметры put_object для CSV-выгрузки"""
+    args = {"ContentType": "text/csv; charset=utf-8"}
+    if compression != "none":
+        args["ContentEncoding"] = compression
+    return args
+
+
+def new_compressor(compression: str):
+    """Объект с compress(data) и flush(), как у zlib.compressobj"""
+    if compression == "gzip":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return _zstandard().ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+def compress_chunks(chunks: Iterable[bytes], compression: str) -> Iterator[bytes]:
+    if compression == "none":
+        yield from chunks
+        return
+    compressor = new_compressor(compression)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def decompress_chunks(chunks: Iterable[bytes], compression: str) -> Iterator[bytes]:
+    if compression == "none":
+        yield from chunks
+        return
+    if compression == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        decompressor = _zstandard().ZstdDecompressor().decompressobj()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if hasattr(decompressor, "flush"):
+        yield decompressor.flush()
+
+
+class ChunkStream(io.RawIOBase):
+    """Файлоподобная обертка над потоком байтов для upload_fileobj"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = chunk
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def upload_file(s3_client, filepath: str, bucket: str, key: str, compression: str = "none") -> None:
+    """Загружает локальный CSV под key; со сжатием — потоком, без промежуточного файла"""
+    if compression == "none":
+        s3_client.upload_file(filepath, bucket, key, ExtraArgs=upload_args(compression))
+        return
+    with open(filepath, "rb") as f:
+        chunks = compress_chunks(iter(lambda: f.read(READ_CHUNK_SIZE), b""), compression)
+        s3_client.upload_fileobj(
+            io.BufferedReader(ChunkStream(chunks), READ_CHUNK_SIZE), bucket, key, ExtraArgs=upload_args(compression)
+        )
+
+
+def publish_latest(s3_client, filepath: str, bucket: str, key: str, compression: str = "none") -> None:
+    """Псевдоним operations_latest.csv и latest.json для выгрузки, уже загруженной под key"""
+    if compression == "none":
+        # Копия внутри бакета: байты выгрузки не передаются второй раз
+        s3_client.copy_object(
+            Bucket=bucket, Key=LATEST_ALIAS_KEY, CopySource={"Bucket": bucket, "Key": key}, MetadataDirective="COPY"
+        )
+    else:
+        # Псевдоним читают Apps Script и внешние потребители, он всегда несжатый
+        upload_file(s3_client, filepath, bucket, LATEST_ALIAS_KEY)
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=LATEST_INFO_KEY,
+        Body=json.dumps({"key": key}, ensure_ascii=False).encode("utf-8"),
+        ContentType="application/json",
+    )
+
+
+def iter_text_lines(chunks: Iterable[bytes], encoding: str = "utf-8") -> Iterator[str]:
+    """Строки текста с переводом строки на конце из потока байтов; символ может быть разрезан между кусками"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def _iter_body_lines(body, compression: str, chunk_size: int) -> Iterator[str]:
+    try:
+        yield from iter_text_lines(decompress_chunks(body.iter_chunks(chunk_size), compression))
+    finally:
+        body.close()
+
+
+def read_s3_lines(s3_client, bucket: str, key: str, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[str]:
+    """Строки текстового объекта по мере скачивания (и распаковки); в памяти не больше одного куска тела"""
+    # get_object вызывается сразу, чтобы ошибка доступа всплыла здесь, а не при первой строке
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    return _iter_body_lines(response["Body"], compression_of(key, response.get("ContentEncoding")), chunk_size)
+
+
+def read_s3_csv(s3_client, bucket: str, key: str, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[Dict[str, str]]:
+    """Строки CSV-объекта по мере скачивания"""
+    # csv сам склеивает строки, если в поле в кавычках есть перевод строки
+    return csv.DictReader(read_s3_lines(s3_client, bucket, key, chunk_size))
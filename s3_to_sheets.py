@@ -2,14 +2,14 @@ import os
 import csv
 import json
 import logging
-import tempfile
-from typing import List
 
 import boto3
 from botocore.config import Config
 import gspread
 from google.oauth2.service_account import Credentials
 
+from s3_exports import latest_export, read_s3_lines
+
 
 def get_env(name: str) -> str:
     v = os.environ.get(name)
@@ -18,17 +18,6 @@ def get_env(name: str) -> str:
     return v
 
 
-def list_csv_objects(s3, bucket: str) -> List[dict]:
-    paginator = s3.get_paginator("list_objects_v2")
-    csv_objects: List[dict] = []
-    for page in paginator.paginate(Bucket=bucket):
-        for obj in page.get("Contents", []):
-            key: str = obj["Key"]
-            if key.lower().endswith(".csv"):
-                csv_objects.append(obj)
-    return csv_objects
-
-
 def main() -> None:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
@@ -51,20 +40,13 @@ def main() -> None:
         config=Config(signature_version="s3v4"),
     )
 
-    # find latest CSV by LastModified
-    objs = list_csv_objects(s3, bucket)
-    if not objs:
+    # find latest export (date-partitioned listing, see s3_exports)
+    key = latest_export(s3, bucket)
+    if not key:
         logging.info("No CSV files found in bucket %s", bucket)
         return
-    latest = max(objs, key=lambda o: o["LastModified"])  # type: ignore[arg-type]
-    key = latest["Key"]
     logging.info("Latest CSV in bucket: %s", key)
 
-    # download to temp
-    local = os.path.join(tempfile.gettempdir(), os.path.basename(key))
-    s3.download_file(bucket, key, local)
-    logging.info("Downloaded to %s", local)
-
     # authorize Google Sheets
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
@@ -79,10 +61,8 @@ def main() -> None:
     except gspread.WorksheetNotFound:
         ws = sh.add_worksheet(title=worksheet, rows=1000, cols=10)
 
-    # read CSV and append
-    with open(local, newline="", encoding="utf-8") as f:
-        reader = csv.reader(f)
-        rows = list(reader)
+    # read CSV straight from S3 (decompressed on the fly if gzip/zstd)
+    rows = list(csv.reader(read_s3_lines(s3, bucket, key)))
 
     if not rows:
         logging.info("CSV is empty, nothing to append")
@@ -6,16 +6,19 @@
 """
 
 import os
-import csv
 import json
 import logging
-import tempfile
 from datetime import datetime
 from typing import List, Dict, Optional
 
-import boto3
-from botocore.config import Config
-from supabase import create_client, Client
+from supabase import Client
+
+from invest import create_s3_client, row_to_supabase
+from migrations import ensure_schema
+from s3_exports import LATEST_INFO_KEY, exports_after, latest_export, read_s3_csv
+from supabase_client import get_supabase_client
+from supabase_stats import empty_stats, fetch_stats
+from upsert_engine import get_upsert_batch_size, get_upsert_concurrency, upsert_rows
 
 
 def get_env_variable(name: str) -> str:
@@ -31,6 +34,28 @@ def get_optional_env_variable(name: str, default: str = "") -> str:
     return os.environ.get(name, default)
 
 
+def load_last_export(path: str) -> Optional[str]:
+    """Ключ последней выгрузки, целиком загруженной в Supabase"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as exc:
+        logging.warning("Ignoring unreadable S3 sync state file %s: %s", path, exc)
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data.get("last_key") or None
+
+
+def save_last_export(path: str, key: str) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"last_key": key}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
 class S3ToSupabase:
     """Класс для передачи данных из S3 в Supabase"""
     
@@ -44,122 +69,86 @@ class S3ToSupabase:
         # Supabase
         self.supabase_url = get_env_variable("SUPABASE_URL")
         self.supabase_key = get_env_variable("SUPABASE_KEY")
-        self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
+        self.supabase: Client = get_supabase_client(self.supabase_url, self.supabase_key)
         
-        # Настройка S3 клиента
-        self.s3_client = boto3.client(
-            service_name="s3",
-            aws_access_key_id=self.ya_access_key,
-            aws_secret_access_key=self.ya_secret_key,
-            endpoint_url="https://storage.yandexcloud.net",
-            region_name="ru-central1",
-            config=Config(signature_version="s3v4"),
-        )
+        # S3 клиент: общий на процесс, настраивается в invest.create_s3_client
+        self.s3_client = create_s3_client(self.ya_access_key, self.ya_secret_key)
+        
+        # Последняя загруженная выгрузка: следующий запуск берет только более новые
+        self.state_file = get_optional_env_variable("S3_SYNC_STATE_FILE", "s3_sync_state.json")
         
         logging.info("✅ Подключения к S3 и Supabase настроены")
     
-    def создать_таблицу_supabase(self) -> None:
-        """Создание таблицы в Supabase для операций Тинькофф"""
+    def создать_таблицу_supabase(self) -> bool:
+        """Применение недостающих миграций схемы Supabase (см. migrations.py)
+
+        Без них upsert по (operation_id, date_msk) невозможен, поэтому при ошибке синхронизация останавливается.
+        """
         try:
-            sql = """
-            CREATE TABLE IF NOT EXISTS tinkoff_operations (
-                id SERIAL PRIMARY KEY,
-                operation_id VARCHAR(100) UNIQUE NOT NULL,
-                date_msk TIMESTAMP NOT NULL,
-                action VARCHAR(200) NOT NULL,
-                amount DECIMAL(15,2) NOT NULL,
-                currency VARCHAR(10) NOT NULL,
-                status VARCHAR(50) NOT NULL,
-                description TEXT,
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-            """
-            
-            self.supabase.rpc('exec_sql', {'sql': sql}).execute()
-            logging.info("✅ Таблица tinkoff_operations создана в Supabase")
+            версия = ensure_schema(self.supabase)
+            logging.info(f"✅ Схема Supabase актуальна (версия {версия})")
+            return True
             
         except Exception as e:
-            logging.warning(f"⚠️ Ошибка создания таблицы: {e}")
+            logging.error(f"❌ Ошибка миграции схемы: {e}")
+            return False
     
-    def получить_список_файлов_s3(self) -> List[str]:
-        """Получение списка CSV файлов из S3"""
+    def получить_список_файлов_s3(self, последний_ключ: str) -> Optional[List[str]]:
+        """Получение списка CSV выгрузок из S3 новее последней загруженной
+
+        Возвращает None, если листинг не удался: пустой список означает «новых выгрузок нет».
+        """
         try:
-            response = self.s3_client.list_objects_v2(Bucket=self.bucket_name)
+            # Постранично и только по секциям operations/YYYY/MM/DD/ начиная с дня последней выгрузки
+            csv_files = exports_after(self.s3_client, self.bucket_name, последний_ключ)
             
-            csv_files = []
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    key = obj['Key']
-                    if key.endswith('.csv') and 'operations' in key:
-                        csv_files.append(key)
-            
-            logging.info(f"📁 Найдено {len(csv_files)} CSV файлов в S3")
+            logging.info(f"📁 Найдено {len(csv_files)} новых CSV файлов в S3")
             return csv_files
             
         except Exception as e:
             logging.error(f"❌ Ошибка получения списка файлов из S3: {e}")
-            return []
-    
-    def скачать_файл_из_s3(self, key: str) -> Optional[str]:
-        """Скачивание файла из S3 во временную директорию"""
-        try:
-            temp_file = os.path.join(tempfile.gettempdir(), f"temp_{key}")
-            
-            self.s3_client.download_file(self.bucket_name, key, temp_file)
-            logging.info(f"📥 Файл {key} скачан во временную директорию")
-            
-            return temp_file
-            
-        except Exception as e:
-            logging.error(f"❌ Ошибка скачивания файла {key}: {e}")
             return None
     
-    def загрузить_csv_в_supabase(self, file_path: str) -> int:
-        """Загрузка данных из CSV файла в Supabase"""
+    def загрузить_csv_в_supabase(self, key: str) -> Optional[int]:
+        """Загрузка CSV файла из S3 в Supabase потоком, без временного файла
+
+        Возвращает None, если файл загружен не целиком.
+        """
         try:
-            операции = []
+            # Тело объекта разбирается по мере скачивания, строки уходят в Supabase пачками параллельно
+            строки = read_s3_csv(self.s3_client, self.bucket_name, key)
+            logging.info(f"📥 Читаем {key} из S3")
+            результат = upsert_rows(
+                self.supabase,
+                (row_to_supabase(row) for row in строки),
+                batch_size=get_upsert_batch_size(),
+                concurrency=get_upsert_concurrency(),
+            )
             
-            with open(file_path, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    # Преобразуем данные для Supabase
-                    операция = {
-                        'operation_id': row['operation_id'],
-                        'date_msk': row['date_msk'],
-                        'action': row['action'],
-                        'amount': float(row['amount']),
-                        'currency': row['currency'],
-                        'status': row['status'],
-                        'description': row['description']
-                    }
-                    операции.append(операция)
-            
-            if not операции:
+            if not результат['loaded'] and not результат['failed']:
                 logging.warning("⚠️ Нет данных для загрузки")
                 return 0
             
-            # Загружаем данные в Supabase (upsert - обновляем существующие)
-            result = self.supabase.table('tinkoff_operations').upsert(
-                операции, 
-                on_conflict='operation_id'
-            ).execute()
-            
-            загружено = len(result.data)
-            logging.info(f"✅ Загружено {загружено} операций в Supabase")
+            загружено = результат['loaded']
+            logging.info(f"✅ Загружено {загружено} операций в Supabase ({результат['rows_per_sec']:.0f} строк/с)")
+            logging.info(f"   новых: {результат['inserted']}, измененных: {результат['updated']}, "
+                         f"без изменений: {результат['unchanged']}")
+            if результат['failed']:
+                logging.error(f"❌ Не загружено {результат['failed']} операций")
+                return None
             
             return загружено
             
         except Exception as e:
             logging.error(f"❌ Ошибка загрузки CSV в Supabase: {e}")
-            return 0
+            return None
     
     def получить_последний_файл(self) -> Optional[str]:
         """Получение последнего файла из S3"""
         try:
             # Пытаемся получить latest.json
             try:
-                latest_info = self.s3_client.get_object(Bucket=self.bucket_name, Key="latest.json")
+                latest_info = self.s3_client.get_object(Bucket=self.bucket_name, Key=LATEST_INFO_KEY)
                 latest_data = json.loads(latest_info['Body'].read().decode('utf-8'))
                 latest_file = latest_data.get('key')
                 
@@ -170,16 +159,11 @@ class S3ToSupabase:
             except Exception:
                 logging.info("📄 latest.json не найден, ищем последний CSV файл")
             
-            # Если latest.json нет, ищем последний CSV файл
-            csv_files = self.получить_список_файлов_s3()
-            if csv_files:
-                # Сортируем по дате создания (последний файл)
-                csv_files.sort(reverse=True)
-                latest_file = csv_files[0]
+            # Если latest.json нет, ищем последнюю выгрузку по секциям последних дней
+            latest_file = latest_export(self.s3_client, self.bucket_name)
+            if latest_file:
                 logging.info(f"📄 Последний CSV файл: {latest_file}")
-                return latest_file
-            
-            return None
+            return latest_file
             
         except Exception as e:
             logging.error(f"❌ Ошибка получения последнего файла: {e}")
@@ -191,36 +175,41 @@ class S3ToSupabase:
             logging.info("🔄 Начинаем синхронизацию данных S3 → Supabase")
             
             # Создаем таблицу в Supabase
-            self.создать_таблицу_supabase()
-            
-            # Получаем последний файл
-            latest_file = self.получить_последний_файл()
+            if not self.создать_таблицу_supabase():
+                return {'status': 'error', 'message': 'Ошибка миграции схемы Supabase'}
             
-            if not latest_file:
-                logging.warning("⚠️ Не найден файл для синхронизации")
-                return {'status': 'error', 'message': 'Файл не найден'}
+            # Выгрузки новее последней загруженной; при первом запуске — только последняя
+            последний_ключ = load_last_export(self.state_file)
+            if последний_ключ:
+                файлы = self.получить_список_файлов_s3(последний_ключ)
+                if файлы is None:
+                    return {'status': 'error', 'message': 'Ошибка получения списка файлов из S3'}
+                if not файлы:
+                    logging.info("Новых выгрузок нет")
+            else:
+                latest_file = self.получить_последний_файл()
+                if not latest_file:
+                    logging.warning("⚠️ Не найден файл для синхронизации")
+                    return {'status': 'error', 'message': 'Файл не найден'}
+                файлы = [latest_file]
             
-            # Скачиваем файл
-            temp_file = self.скачать_файл_из_s3(latest_file)
-            
-            if not temp_file:
-                return {'status': 'error', 'message': 'Ошибка скачивания файла'}
-            
-            # Загружаем в Supabase
-            загружено = self.загрузить_csv_в_supabase(temp_file)
-            
-            # Удаляем временный файл
-            try:
-                os.remove(temp_file)
-            except Exception:
-                pass
+            # Загружаем в Supabase прямо из S3, по порядку: отметка сдвигается только за целиком загруженным файлом
+            загружено = 0
+            for key in файлы:
+                загружено_из_файла = self.загрузить_csv_в_supabase(key)
+                if загружено_из_файла is None:
+                    return {'status': 'error', 'message': f'Ошибка загрузки {key}', 'loaded_operations': загружено}
+                загружено += загружено_из_файла
+                последний_ключ = key
+                save_last_export(self.state_file, key)
             
             # Получаем статистику из Supabase
             stats = self.получить_статистику_supabase()
             
             результат = {
                 'status': 'success',
-                'file': latest_file,
+                'file': последний_ключ,
+                'files_loaded': len(файлы),
                 'loaded_operations': загружено,
                 'total_operations': stats.get('total', 0),
                 'last_update': stats.get('last_update', ''),
@@ -235,24 +224,13 @@ class S3ToSupabase:
             return {'status': 'error', 'message': str(e)}
     
     def получить_статистику_supabase(self) -> Dict:
-        """Получение статистики из Supabase"""
+        """Получение статистики из Supabase (серверный агрегат, без чтения таблицы)"""
         try:
-            # Получаем общее количество операций
-            result = self.supabase.table('tinkoff_operations').select('*', count='exact').execute()
-            total = result.count if result.count else 0
-            
-            # Получаем последнюю операцию
-            last_op = self.supabase.table('tinkoff_operations').select('date_msk').order('date_msk', desc=True).limit(1).execute()
-            last_update = last_op.data[0]['date_msk'] if last_op.data else ''
-            
-            return {
-                'total': total,
-                'last_update': last_update
-            }
+            return fetch_stats(self.supabase)
             
         except Exception as e:
             logging.error(f"❌ Ошибка получения статистики: {e}")
-            return {'total': 0, 'last_update': ''}
+            return empty_stats()
     
     def создать_отчет(self, результат: Dict) -> str:
         """Создание отчета о синхронизации"""
@@ -265,6 +243,7 @@ class S3ToSupabase:
 
 📊 РЕЗУЛЬТАТЫ:
 • Файл: {результат.get('file', 'N/A')}
+• Новых выгрузок загружено: {результат.get('files_loaded', 0)}
 • Загружено операций: {результат.get('loaded_operations', 0)}
 • Всего операций в Supabase: {результат.get('total_operations', 0)}
 • Последнее обновление: {результат.get('last_update', 'N/A')}
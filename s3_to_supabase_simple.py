@@ -5,11 +5,12 @@
 """
 
 import os
-import csv
-import tempfile
-from supabase import create_client
-import boto3
-from botocore.config import Config
+
+from invest import create_s3_client, row_to_supabase
+from migrations import ensure_schema
+from s3_exports import LATEST_ALIAS_KEY, read_s3_csv
+from supabase_client import get_supabase_client
+from upsert_engine import get_upsert_batch_size, get_upsert_concurrency, upsert_rows
 
 
 def load_env_from_file(filename='config.env'):
@@ -24,85 +25,46 @@ def load_env_from_file(filename='config.env'):
                 os.environ[key] = value
 
 
-def download_from_s3():
-    """Скачивание файла из S3"""
+def read_from_s3():
+    """Чтение последней выгрузки из S3 потоком, без сохранения на диск"""
     try:
-        # Настройка S3 клиента
-        s3_client = boto3.client(
-            service_name="s3",
-            aws_access_key_id=os.environ.get("YA_ACCESS_KEY"),
-            aws_secret_access_key=os.environ.get("YA_SECRET_KEY"),
-            endpoint_url="https://storage.yandexcloud.net",
-            region_name="ru-central1",
-            config=Config(signature_version="s3v4"),
-        )
+        # S3 клиент: общий на процесс, настраивается в invest.create_s3_client
+        s3_client = create_s3_client(os.environ.get("YA_ACCESS_KEY"), os.environ.get("YA_SECRET_KEY"))
         
         bucket_name = os.environ.get("BUCKET_NAME")
         
-        # Скачиваем последний файл
-        s3_client.download_file(bucket_name, "operations_latest.csv", "operations_latest.csv")
-        print("✅ Файл скачан из S3")
+        # Строки разбираются по мере скачивания
+        строки = read_s3_csv(s3_client, bucket_name, LATEST_ALIAS_KEY)
+        print("✅ Файл открыт в S3")
         
-        return "operations_latest.csv"
+        return строки
         
     except Exception as e:
-        print(f"❌ Ошибка скачивания из S3: {e}")
+        print(f"❌ Ошибка чтения из S3: {e}")
         return None
 
 
-def upload_to_supabase(csv_file):
+def upload_to_supabase(строки):
     """Загрузка данных в Supabase"""
     try:
         # Подключение к Supabase
-        supabase = create_client(
-            os.environ.get("SUPABASE_URL"),
-            os.environ.get("SUPABASE_KEY")
-        )
+        supabase = get_supabase_client()
         
-        # Создание таблицы
-        sql = """
-        CREATE TABLE IF NOT EXISTS tinkoff_operations (
-            id SERIAL PRIMARY KEY,
-            operation_id VARCHAR(100) UNIQUE NOT NULL,
-            date_msk TIMESTAMP NOT NULL,
-            action VARCHAR(200) NOT NULL,
-            amount DECIMAL(15,2) NOT NULL,
-            currency VARCHAR(10) NOT NULL,
-            status VARCHAR(50) NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT NOW(),
-            updated_at TIMESTAMP DEFAULT NOW()
-        );
-        """
+        # Схема: DDL выполняется, только если локальный маркер отстал от миграций
+        версия = ensure_schema(supabase)
+        print(f"✅ Схема Supabase актуальна (версия {версия})")
         
-        supabase.rpc('exec_sql', {'sql': sql}).execute()
-        print("✅ Таблица создана в Supabase")
+        # Строки CSV лениво превращаются в строки таблицы и уходят пачками
+        supabase_data = (row_to_supabase(row) for row in строки)
         
-        # Чтение CSV и загрузка в Supabase
-        supabase_data = []
-        
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                supabase_data.append({
-                    'operation_id': row['operation_id'],
-                    'date_msk': row['date_msk'],
-                    'action': row['action'],
-                    'amount': float(row['amount']),
-                    'currency': row['currency'],
-                    'status': row['status'],
-                    'description': row['description']
-                })
-        
-        # Загрузка данных
-        result = supabase.table('tinkoff_operations').upsert(
-            supabase_data, 
-            on_conflict='operation_id'
-        ).execute()
+        # Загрузка данных пачками
+        результат = upsert_rows(
+            supabase, supabase_data, batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency()
+        )
         
-        print(f"✅ Загружено {len(result.data)} операций в Supabase")
+        print(f"✅ Загружено {результат['loaded']} операций в Supabase ({результат['rows_per_sec']:.0f} строк/с)")
         
-        return len(result.data)
+        return результат['loaded']
         
     except Exception as e:
         print(f"❌ Ошибка загрузки в Supabase: {e}")
@@ -117,13 +79,13 @@ def main():
     # Загружаем переменные
     load_env_from_file()
     
-    # Скачиваем из S3
-    csv_file = download_from_s3()
-    if not csv_file:
+    # Открываем выгрузку в S3
+    строки = read_from_s3()
+    if строки is None:
         return
     
     # Загружаем в Supabase
-    uploaded = upload_to_supabase(csv_file)
+    uploaded = upload_to_supabase(строки)
     
     if uploaded > 0:
         print(f"\n🎉 Успешно загружено {uploaded} операций в Supabase!")
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Один клиент Supabase на процесс
+Клиент создается при первом обращении и дальше переиспользуется всеми
+загрузками, миграциями и запросами статистики. HTTP-сессия PostgREST
+заменяется на httpx.Client с настраиваемым пулом keep-alive соединений,
+таймаутами и (по желанию) HTTP/2, поэтому TLS-рукопожатие с Supabase
+выполняется один раз за запуск, а не для каждого этапа.
+"""
+
+import importlib.util
+import logging
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import httpx
+from supabase import Client, create_client
+
+DEFAULT_SUPABASE_TIMEOUT = 60.0
+DEFAULT_SUPABASE_MAX_CONNECTIONS = 20
+DEFAULT_SUPABASE_KEEPALIVE_SECONDS = 60.0
+CONNECT_TIMEOUT = 10.0
+
+_clients: Dict[Tuple[str, str], Client] = {}
+_lock = threading.Lock()
+
+
+def get_supabase_timeout() -> float:
+    timeout_str = os.environ.get("SUPABASE_TIMEOUT", str(DEFAULT_SUPABASE_TIMEOUT))
+    try:
+        return max(1.0, float(timeout_str))
+    except ValueError:
+        raise RuntimeError("SUPABASE_TIMEOUT must be a number of seconds")
+
+
+def get_supabase_max_connections() -> int:
+    connections_str = os.environ.get("SUPABASE_MAX_CONNECTIONS", str(DEFAULT_SUPABASE_MAX_CONNECTIONS))
+    try:
+        return max(1, int(connections_str))
+    except ValueError:
+        raise RuntimeError("SUPABASE_MAX_CONNECTIONS must be an integer")
+
+
+def get_supabase_http2() -> bool:
+    if os.environ.get("SUPABASE_HTTP2", "0").lower() not in ("1", "true", "yes"):
+        return False
+    # HTTP/2 в httpx работает только с пакетом h2; сам модуль здесь не нужен
+    if importlib.util.find_spec("h2") is None:
+        logging.warning("SUPABASE_HTTP2 is set but the h2 package is missing, using HTTP/1.1")
+        return False
+    return True
+
+
+def http_client_options(max_connections: Optional[int] = None) -> Dict:
+    """Общие параметры httpx-клиентов для Supabase (синхронного и асинхронного)"""
+    connections = max_connections or get_supabase_max_connections()
+    return {
+        "timeout": httpx.Timeout(get_supabase_timeout(), connect=CONNECT_TIMEOUT),
+        "limits": httpx.Limits(
+            max_connections=connections,
+            max_keepalive_connections=connections,
+            keepalive_expiry=DEFAULT_SUPABASE_KEEPALIVE_SECONDS,
+        ),
+        "http2": get_supabase_http2(),
+    }
+
+
+def _pool_postgrest(client: Client) -> None:
+    postgrest = client.postgrest
+    session = postgrest.session
+    postgrest.session = httpx.Client(
+        base_url=session.base_url,
+        headers=session.headers,
+        **http_client_options(),
+    )
+    session.close()
+
+
+def get_supabase_client(supabase_url: Optional[str] = None, supabase_key: Optional[str] = None) -> Client:
+    """Клиент Supabase, общий для процесса; по умолчанию SUPABASE_URL и SUPABASE_KEY"""
+    url = supabase_url or os.environ.get("SUPABASE_URL")
+    key = supabase_key or os.environ.get("SUPABASE_KEY")
+    if not url or not key:
+        raise RuntimeError("SUPABASE_URL and SUPABASE_KEY are required")
+
+    with _lock:
+        client = _clients.get((url, key))
+        if client is None:
+            client = create_client(url, key)
+            _pool_postgrest(client)
+            _clients[(url, key)] = client
+        return client
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Статистика tinkoff_operations без чтения всей таблицы
+Триггеры уровня оператора поддерживают таблицу tinkoff_operations_stats
+(число операций, сумма и последняя дата по паре валюта/тип операции), а
+функция tinkoff_operations_summary() сворачивает ее в один JSON-ответ.
+Размер ответа и работа сервера зависят от числа валют и типов, а не от
+числа операций. STATS_SQL применяется миграцией 2 в migrations.py.
+"""
+
+import logging
+from typing import Dict
+
+STATS_SQL = """
+CREATE TABLE IF NOT EXISTS tinkoff_operations_stats (
+    currency VARCHAR(10) NOT NULL,
+    action VARCHAR(200) NOT NULL,
+    operations BIGINT NOT NULL DEFAULT 0,
+    amount DECIMAL(20,2) NOT NULL DEFAULT 0,
+    last_date_msk TIMESTAMP,
+    PRIMARY KEY (currency, action)
+);
+
+CREATE OR REPLACE FUNCTION tinkoff_operations_stats_trigger() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- Параллельные пачки upsert трогают одни и те же строки счетчиков: блокируем
+    -- их в порядке ключа, чтобы писатели не ждали друг друга по кругу (deadlock)
+    IF TG_OP = 'INSERT' THEN
+        PERFORM 1 FROM tinkoff_operations_stats s
+        JOIN (SELECT DISTINCT currency, action FROM new_rows) k USING (currency, action)
+        ORDER BY s.currency, s.action FOR UPDATE OF s;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM 1 FROM tinkoff_operations_stats s
+        JOIN (SELECT DISTINCT currency, action FROM old_rows) k USING (currency, action)
+        ORDER BY s.currency, s.action FOR UPDATE OF s;
+    ELSE
+        PERFORM 1 FROM tinkoff_operations_stats s
+        JOIN (
+            SELECT currency, action FROM old_rows UNION SELECT currency, action FROM new_rows
+        ) k USING (currency, action)
+        ORDER BY s.currency, s.action FOR UPDATE OF s;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE tinkoff_operations_stats s
+        SET operations = s.operations - d.operations, amount = s.amount - d.amount
+        FROM (
+            SELECT currency, action, count(*) AS operations, sum(amount) AS amount
+            FROM old_rows GROUP BY currency, action
+        ) d
+        WHERE s.currency = d.currency AND s.action = d.action;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO tinkoff_operations_stats AS s (currency, action, operations, amount, last_date_msk)
+        SELECT currency, action, count(*), sum(amount), max(date_msk)
+        FROM new_rows GROUP BY currency, action
+        ORDER BY currency, action
+        ON CONFLICT (currency, action) DO UPDATE SET
+            operations = s.operations + EXCLUDED.operations,
+            amount = s.amount + EXCLUDED.amount,
+            last_date_msk = GREATEST(s.last_date_msk, EXCLUDED.last_date_msk);
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS tinkoff_operations_stats_insert ON tinkoff_operations;
+CREATE TRIGGER tinkoff_operations_stats_insert AFTER INSERT ON tinkoff_operations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tinkoff_operations_stats_trigger();
+DROP TRIGGER IF EXISTS tinkoff_operations_stats_update ON tinkoff_operations;
+CREATE TRIGGER tinkoff_operations_stats_update AFTER UPDATE ON tinkoff_operations
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tinkoff_operations_stats_trigger();
+DROP TRIGGER IF EXISTS tinkoff_operations_stats_delete ON tinkoff_operations;
+CREATE TRIGGER tinkoff_operations_stats_delete AFTER DELETE ON tinkoff_operations
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION tinkoff_operations_stats_trigger();
+
+-- Полный пересчет: при установке и если счетчики разошлись с таблицей
+CREATE OR REPLACE FUNCTION tinkoff_operations_stats_rebuild() RETURNS void
+LANGUAGE sql AS $$
+    DELETE FROM tinkoff_operations_stats;
+    INSERT INTO tinkoff_operations_stats (currency, action, operations, amount, last_date_msk)
+    SELECT currency, action, count(*), sum(amount), max(date_msk)
+    FROM tinkoff_operations GROUP BY currency, action;
+$$;
+
+CREATE OR REPLACE FUNCTION tinkoff_operations_summary() RETURNS json
+LANGUAGE sql STABLE AS $$
+    SELECT json_build_object(
+        'total', COALESCE(sum(operations), 0),
+        'last_update', max(last_date_msk),
+        'by_currency', (
+            SELECT COALESCE(json_object_agg(currency, amount), '{}'::json)
+            FROM (
+                SELECT currency, sum(amount) AS amount FROM tinkoff_operations_stats
+                WHERE operations > 0 GROUP BY currency
+            ) c
+        ),
+        'by_action', (
+            SELECT COALESCE(json_object_agg(action, operations), '{}'::json)
+            FROM (
+                SELECT action, sum(operations) AS operations FROM tinkoff_operations_stats
+                WHERE operations > 0 GROUP BY action
+            ) a
+        )
+    )
+    FROM tinkoff_operations_stats
+    WHERE operations > 0;
+$$;
+
+-- Первичное заполнение; дальше счетчики ведут триггеры
+SELECT tinkoff_operations_stats_rebuild() WHERE NOT EXISTS (SELECT 1 FROM tinkoff_operations_stats);
+"""
+
+
+def empty_stats() -> Dict:
+    return {'total': 0, 'last_update': '', 'by_currency': {}, 'by_action': {}}
+
+
+def fetch_stats(supabase) -> Dict:
+    """Число операций, последняя дата, суммы по валютам и число операций по типам"""
+    try:
+        summary = supabase.rpc('tinkoff_operations_summary').execute().data or {}
+        return {
+            'total': summary.get('total') or 0,
+            'last_update': summary.get('last_update') or '',
+            'by_currency': summary.get('by_currency') or {},
+            'by_action': summary.get('by_action') or {},
+        }
+    except Exception as e:
+        logging.warning(f"tinkoff_operations_summary() is unavailable, falling back to a count query: {e}")
+
+    # Без функции: HEAD-запрос только со счетчиком и одна последняя дата
+    stats = empty_stats()
+    result = supabase.table('tinkoff_operations').select('operation_id', count='exact', head=True).execute()
+    stats['total'] = result.count or 0
+    last_op = supabase.table('tinkoff_operations').select('date_msk').order('date_msk', desc=True).limit(1).execute()
+    stats['last_update'] = last_op.data[0]['date_msk'] if last_op.data else ''
+    return stats
@@ -5,8 +5,10 @@
 """
 
 import os
-from invest import fetch_operations
-from supabase import create_client
+from invest import fetch_operations, row_to_supabase
+from migrations import ensure_schema
+from supabase_client import get_supabase_client
+from upsert_engine import get_upsert_batch_size, get_upsert_concurrency, upsert_rows
 
 
 def main():
@@ -45,55 +47,33 @@ def main():
         print("❌ Не получено операций из Тинькофф")
         return
     
-    print(f"✅ Получено {len(операций)} операций из Тинькофф")
+    print(f"✅ Получено {len(операции)} операций из Тинькофф")
     
     # Подключаемся к Supabase
     print("🔗 Подключение к Supabase...")
-    supabase = create_client(supabase_url, supabase_key)
+    supabase = get_supabase_client(supabase_url, supabase_key)
     
-    # Создаем таблицу
-    print("📋 Создание таблицы...")
+    # Применяем миграции схемы (см. migrations.py)
+    print("📋 Проверка схемы...")
     try:
-        sql = """
-        CREATE TABLE IF NOT EXISTS tinkoff_operations (
-            id SERIAL PRIMARY KEY,
-            operation_id VARCHAR(100) UNIQUE NOT NULL,
-            date_msk TIMESTAMP NOT NULL,
-            action VARCHAR(200) NOT NULL,
-            amount DECIMAL(15,2) NOT NULL,
-            currency VARCHAR(10) NOT NULL,
-            status VARCHAR(50) NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT NOW(),
-            updated_at TIMESTAMP DEFAULT NOW()
-        );
-        """
-        supabase.rpc('exec_sql', {'sql': sql}).execute()
-        print("✅ Таблица создана")
+        версия = ensure_schema(supabase)
+        print(f"✅ Схема актуальна (версия {версия})")
     except Exception as e:
-        print(f"⚠️ Ошибка создания таблицы: {e}")
+        # Без миграций upsert по (operation_id, date_msk) невозможен
+        print(f"❌ Ошибка миграции схемы: {e}")
+        return
     
     # Загружаем данные
     print("💾 Загрузка данных в Supabase...")
     try:
-        supabase_data = []
-        for операция in операции:
-            supabase_data.append({
-                'operation_id': операция['operation_id'],
-                'date_msk': операция['date_msk'],
-                'action': операция['action'],
-                'amount': float(операция['amount']),
-                'currency': операция['currency'],
-                'status': операция['status'],
-                'description': операция['description']
-            })
-        
-        result = supabase.table('tinkoff_operations').upsert(
-            supabase_data, 
-            on_conflict='operation_id'
-        ).execute()
+        результат = upsert_rows(
+            supabase, [row_to_supabase(операция) for операция in операции],
+            batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency()
+        )
         
-        print(f"✅ Загружено {len(result.data)} операций в Supabase")
+        print(f"✅ Загружено {результат['loaded']} операций в Supabase")
+        if результат['failed']:
+            print(f"⚠️ Не загружено {результат['failed']} операций")
         
     except Exception as e:
         print(f"❌ Ошибка загрузки: {e}")
@@ -107,7 +87,7 @@ def main():
     print("\n" + "="*50)
     print("📈 СТАТИСТИКА:")
     print("="*50)
-    print(f"• Операций: {len(операций)}")
+    print(f"• Операций: {len(операции)}")
     print(f"• Общая сумма: {total_amount:,.2f} ₽")
     print(f"• Положительных: {positive_ops}")
     print(f"• Отрицательных: {negative_ops}")
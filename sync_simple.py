@@ -13,10 +13,21 @@ from typing import List, Dict
 # Импортируем функции из существующего invest.py
 from invest import (
     get_env_variable, 
-    fetch_operations
+    fetch_operations,
+    get_account_ids,
+    get_fetch_concurrency,
+    load_watermarks,
+    save_watermarks,
+    watermark_from_supabase,
+    get_watermark_overlap,
+    row_to_supabase
 )
 
-from supabase import create_client, Client
+from supabase import Client
+from migrations import ensure_schema
+from supabase_client import get_supabase_client
+from supabase_stats import empty_stats, fetch_stats
+from upsert_engine import get_upsert_batch_size, get_upsert_concurrency, upsert_rows
 
 
 def load_env_from_file(filename='config.env'):
@@ -47,7 +58,7 @@ def setup_supabase():
             print("❌ SUPABASE_URL или SUPABASE_KEY не настроены!")
             return None
         
-        supabase = create_client(supabase_url, supabase_key)
+        supabase = get_supabase_client(supabase_url, supabase_key)
         print("✅ Supabase подключен")
         return supabase
         
@@ -56,29 +67,19 @@ def setup_supabase():
         return None
 
 
-def создать_таблицу_supabase(supabase: Client):
-    """Создание таблицы в Supabase"""
+def создать_таблицу_supabase(supabase: Client) -> bool:
+    """Применение недостающих миграций схемы Supabase (см. migrations.py)
+
+    Без них upsert по (operation_id, date_msk) невозможен, поэтому при ошибке загрузка не выполняется.
+    """
     try:
-        sql = """
-        CREATE TABLE IF NOT EXISTS tinkoff_operations (
-            id SERIAL PRIMARY KEY,
-            operation_id VARCHAR(100) UNIQUE NOT NULL,
-            date_msk TIMESTAMP NOT NULL,
-            action VARCHAR(200) NOT NULL,
-            amount DECIMAL(15,2) NOT NULL,
-            currency VARCHAR(10) NOT NULL,
-            status VARCHAR(50) NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT NOW(),
-            updated_at TIMESTAMP DEFAULT NOW()
-        );
-        """
-        
-        supabase.rpc('exec_sql', {'sql': sql}).execute()
-        print("✅ Таблица tinkoff_operations создана в Supabase")
+        версия = ensure_schema(supabase)
+        print(f"✅ Схема Supabase актуальна (версия {версия})")
+        return True
         
     except Exception as e:
-        print(f"⚠️ Ошибка создания таблицы: {e}")
+        print(f"❌ Ошибка миграции схемы: {e}")
+        return False
 
 
 def загрузить_в_supabase(supabase: Client, операции: List[Dict]) -> int:
@@ -89,26 +90,18 @@ def загрузить_в_supabase(supabase: Client, операции: List[Dict
             return 0
         
         # Преобразуем данные для Supabase
-        supabase_data = []
-        for операция in операции:
-            supabase_data.append({
-                'operation_id': операция['operation_id'],
-                'date_msk': операция['date_msk'],
-                'action': операция['action'],
-                'amount': float(операция['amount']),
-                'currency': операция['currency'],
-                'status': операция['status'],
-                'description': операция['description']
-            })
-        
-        # Загружаем данные в Supabase (upsert - обновляем существующие)
-        result = supabase.table('tinkoff_operations').upsert(
-            supabase_data, 
-            on_conflict='operation_id'
-        ).execute()
-        
-        загружено = len(result.data)
-        print(f"✅ Загружено {загружено} операций в Supabase")
+        supabase_data = [row_to_supabase(операция) for операция in операции]
+        
+        # Загружаем данные в Supabase пачками (upsert - обновляем существующие)
+        результат = upsert_rows(
+            supabase, supabase_data, batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency()
+        )
+        загружено = результат['loaded']
+        print(f"✅ Загружено {загружено} операций в Supabase ({результат['rows_per_sec']:.0f} строк/с)")
+        print(f"   новых: {результат['inserted']}, измененных: {результат['updated']}, "
+              f"без изменений: {результат['unchanged']}")
+        if результат['failed']:
+            print(f"⚠️ Не загружено {результат['failed']} операций")
         
         return загружено
         
@@ -118,22 +111,13 @@ def загрузить_в_supabase(supabase: Client, операции: List[Dict
 
 
 def получить_статистику_supabase(supabase: Client) -> Dict:
-    """Получение статистики из Supabase"""
+    """Получение статистики из Supabase (серверный агрегат, без чтения таблицы)"""
     try:
-        result = supabase.table('tinkoff_operations').select('*', count='exact').execute()
-        total = result.count if result.count else 0
-        
-        last_op = supabase.table('tinkoff_operations').select('date_msk').order('date_msk', desc=True).limit(1).execute()
-        last_update = last_op.data[0]['date_msk'] if last_op.data else ''
-        
-        return {
-            'total': total,
-            'last_update': last_update
-        }
+        return fetch_stats(supabase)
         
     except Exception as e:
         print(f"❌ Ошибка получения статистики: {e}")
-        return {'total': 0, 'last_update': ''}
+        return empty_stats()
 
 
 def main():
@@ -156,27 +140,50 @@ def main():
             print("📝 Установите токен Тинькофф в config.env")
             return
         
+        # Настраиваем Supabase
+        supabase = setup_supabase()
+        if not supabase:
+            return
+        
+        # Водяные знаки для инкрементальной загрузки
+        state_file = os.environ.get("SYNC_STATE_FILE", "sync_state.json")
+        watermarks = None
+        if os.environ.get("FULL_SYNC", "").lower() not in ("1", "true", "yes"):
+            watermarks = load_watermarks(state_file)
+            if not watermarks:
+                try:
+                    watermarks = watermark_from_supabase(supabase)
+                except Exception as e:
+                    print(f"⚠️ Не удалось получить водяной знак из Supabase: {e}")
+        
         print(f"📊 Получение операций за последние {days_back} дней...")
+        if watermarks:
+            print(f"⏩ Инкрементальная загрузка с {max(watermarks.values())}")
         
         # Получаем операции из Тинькофф
-        операции = fetch_operations(invest_token, days_back)
+        операции = fetch_operations(
+            invest_token, days_back, watermarks, get_watermark_overlap(),
+            account_ids=get_account_ids(), max_workers=get_fetch_concurrency()
+        )
         
         if not операции:
-            print("❌ Не получено операций из Тинькофф")
+            if watermarks:
+                print("✅ Новых операций нет")
+            else:
+                print("❌ Не получено операций из Тинькофф")
             return
         
-        print(f"✅ Получено {len(операций)} операций из Тинькофф")
-        
-        # Настраиваем Supabase
-        supabase = setup_supabase()
-        if not supabase:
-            return
+        print(f"✅ Получено {len(операции)} операций из Тинькофф")
         
         # Создаем таблицу
-        создать_таблицу_supabase(supabase)
+        if not создать_таблицу_supabase(supabase):
+            return
         
         # Загружаем данные
         загружено = загрузить_в_supabase(supabase, операции)
+        # Водяной знак сдвигаем, только если прошли все пачки
+        if загружено == len(операции) and watermarks is not None:
+            save_watermarks(state_file, watermarks)
         
         # Получаем статистику
         статистика = получить_статистику_supabase(supabase)
@@ -189,7 +196,7 @@ def main():
         print("\n" + "="*60)
         print("📈 ИТОГОВАЯ СТАТИСТИКА:")
         print("="*60)
-        print(f"• Операций получено: {len(операций)}")
+        print(f"• Операций получено: {len(операции)}")
         print(f"• Загружено в Supabase: {загружено}")
         print(f"• Всего в Supabase: {статистика.get('total', 0)}")
         print(f"• Общая сумма: {total_amount:,.2f} ₽")
@@ -14,10 +14,14 @@ from typing import List, Dict
 # Импортируем функции из существующего invest.py
 from invest import (
     get_env_variable, 
-    fetch_operations
+    fetch_operations,
+    row_to_supabase
 )
 
-from supabase import create_client, Client
+from supabase import Client
+from migrations import ensure_schema
+from supabase_client import get_supabase_client
+from upsert_engine import get_upsert_batch_size, get_upsert_concurrency, upsert_rows
 
 
 def load_env_from_file(filename='config.env'):
@@ -48,7 +52,7 @@ def setup_supabase():
             print("❌ SUPABASE_URL или SUPABASE_KEY не настроены!")
             return None
         
-        supabase = create_client(supabase_url, supabase_key)
+        supabase = get_supabase_client(supabase_url, supabase_key)
         print("✅ Supabase подключен")
         return supabase
         
@@ -57,29 +61,19 @@ def setup_supabase():
         return None
 
 
-def создать_таблицу_supabase(supabase: Client):
-    """Создание таблицы в Supabase"""
+def создать_таблицу_supabase(supabase: Client) -> bool:
+    """Применение недостающих миграций схемы Supabase (см. migrations.py)
+
+    Без них upsert по (operation_id, date_msk) невозможен, поэтому при ошибке загрузка не выполняется.
+    """
     try:
-        sql = """
-        CREATE TABLE IF NOT EXISTS tinkoff_operations (
-            id SERIAL PRIMARY KEY,
-            operation_id VARCHAR(100) UNIQUE NOT NULL,
-            date_msk TIMESTAMP NOT NULL,
-            action VARCHAR(200) NOT NULL,
-            amount DECIMAL(15,2) NOT NULL,
-            currency VARCHAR(10) NOT NULL,
-            status VARCHAR(50) NOT NULL,
-            description TEXT,
-            created_at TIMESTAMP DEFAULT NOW(),
-            updated_at TIMESTAMP DEFAULT NOW()
-        );
-        """
-        
-        supabase.rpc('exec_sql', {'sql': sql}).execute()
-        print("✅ Таблица tinkoff_operations создана в Supabase")
+        версия = ensure_schema(supabase)
+        print(f"✅ Схема Supabase актуальна (версия {версия})")
+        return True
         
     except Exception as e:
-        print(f"⚠️ Ошибка создания таблицы: {e}")
+        print(f"❌ Ошибка миграции схемы: {e}")
+        return False
 
 
 def загрузить_в_supabase(supabase: Client, операции: List[Dict]) -> int:
@@ -90,26 +84,16 @@ def загрузить_в_supabase(supabase: Client, операции: List[Dict
             return 0
         
         # Преобразуем данные для Supabase
-        supabase_data = []
-        for операция in операции:
-            supabase_data.append({
-                'operation_id': операция['operation_id'],
-                'date_msk': операция['date_msk'],
-                'action': операция['action'],
-                'amount': float(операция['amount']),
-                'currency': операция['currency'],
-                'status': операция['status'],
-                'description': операция['description']
-            })
-        
-        # Загружаем данные в Supabase (upsert - обновляем существующие)
-        result = supabase.table('tinkoff_operations').upsert(
-            supabase_data, 
-            on_conflict='operation_id'
-        ).execute()
-        
-        загружено = len(result.data)
-        print(f"✅ Загружено {загружено} операций в Supabase")
+        supabase_data = [row_to_supabase(операция) for операция in операции]
+        
+        # Загружаем данные в Supabase пачками (upsert - обновляем существующие)
+        результат = upsert_rows(
+            supabase, supabase_data, batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency()
+        )
+        загружено = результат['loaded']
+        print(f"✅ Загружено {загружено} операций в Supabase ({результат['rows_per_sec']:.0f} строк/с)")
+        if результат['failed']:
+            print(f"⚠️ Не загружено {результат['failed']} операций")
         
         return загружено
         
@@ -166,7 +150,7 @@ def main():
             print("❌ Не получено операций из Тинькофф")
             return
         
-        print(f"✅ Получено {len(операций)} операций из Тинькофф")
+        print(f"✅ Получено {len(операции)} операций из Тинькофф")
         
         # Настраиваем Supabase
         supabase = setup_supabase()
@@ -174,7 +158,8 @@ def main():
             return
         
         # Создаем таблицу
-        создать_таблицу_supabase(supabase)
+        if not создать_таблицу_supabase(supabase):
+            return
         
         # Загружаем данные
         загружено = загрузить_в_supabase(supabase, операции)
@@ -190,7 +175,7 @@ def main():
         print("\n" + "="*60)
         print("📈 ИТОГОВАЯ СТАТИСТИКА:")
         print("="*60)
-        print(f"• Операций получено: {len(операций)}")
+        print(f"• Операций получено: {len(операции)}")
         print(f"• Загружено в Supabase: {загружено}")
         print(f"• Всего в Supabase: {статистика.get('total', 0)}")
         print(f"• Общая сумма: {total_amount:,.2f} ₽")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Тест: Operation (get_operations) и OperationItem (GetOperationsByCursor)
+одной и той же операции дают одинаковую строку выгрузки
+Запуск: python3 test_operation_labels.py (или pytest)
+"""
+
+import datetime
+from types import SimpleNamespace
+
+from tinkoff.invest import OperationState, OperationType
+
+from invest import record_to_row, to_record
+
+# Подпись сервера не обязана совпадать с локальной OPERATION_TYPE_NAMES
+LABEL = "Покупка ценных бумаг с брокерского счета"
+DATE = datetime.datetime(2024, 1, 5, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def _payment():
+    return SimpleNamespace(units=-1234, nano=-500_000_000, currency="rub")
+
+
+def _operation(operation_id: str):
+    # Operation: type — готовая подпись, код — в operation_type
+    return SimpleNamespace(
+        id=operation_id,
+        date=DATE,
+        type=LABEL,
+        operation_type=OperationType.OPERATION_TYPE_BUY,
+        payment=_payment(),
+        currency="rub",
+        state=OperationState.OPERATION_STATE_EXECUTED,
+        description="Тест",
+        figi="BBG000000001",
+        instrument_type="share",
+    )
+
+
+def _operation_item(operation_id: str):
+    # OperationItem: type — enum, подпись — в name, валюта — только у payment
+    return SimpleNamespace(
+        id=operation_id,
+        date=DATE,
+        type=OperationType.OPERATION_TYPE_BUY,
+        name=LABEL,
+        payment=_payment(),
+        state=OperationState.OPERATION_STATE_EXECUTED,
+        description="Тест",
+        figi="BBG000000001",
+        instrument_type="share",
+    )
+
+
+def test_operation_and_item_rows_match():
+    """Одинаковые action, row_hash-поля и fp- id в обоих режимах выгрузки"""
+    for operation_id in ("12345", ""):
+        из_operation = record_to_row(to_record(_operation(operation_id), "2000000001"))
+        из_item = record_to_row(to_record(_operation_item(operation_id), "2000000001"))
+        assert из_operation == из_item, (из_operation, из_item)
+        assert из_item["action"] == LABEL
+
+
+def main():
+    """Основная функция"""
+    print("🧪 ТЕСТ ПОДПИСЕЙ ОПЕРАЦИЙ")
+    print("="*40)
+
+    test_operation_and_item_rows_match()
+    print("\n✅ Operation и OperationItem дают одинаковые строки")
+
+
+if __name__ == "__main__":
+    main()
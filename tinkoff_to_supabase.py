@@ -8,10 +8,26 @@
 import os
 import logging
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Optional
 
-from tinkoff.invest import Client
-from supabase import create_client, Client
+from supabase import Client
+
+from rate_limit import get_rate_limiter
+from migrations import ensure_schema
+from supabase_client import get_supabase_client
+from supabase_stats import empty_stats, fetch_stats
+from upsert_engine import get_upsert_batch_size, get_upsert_concurrency, upsert_rows
+
+from invest import (
+    fetch_operations,
+    get_account_ids,
+    get_fetch_concurrency,
+    get_watermark_overlap,
+    load_watermarks,
+    row_to_supabase,
+    save_watermarks,
+    watermark_from_supabase,
+)
 
 
 def get_env_variable(name: str) -> str:
@@ -33,107 +49,53 @@ class TinkoffToSupabase:
         # Supabase
         self.supabase_url = get_env_variable("SUPABASE_URL")
         self.supabase_key = get_env_variable("SUPABASE_KEY")
-        self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
+        self.supabase: Client = get_supabase_client(self.supabase_url, self.supabase_key)
+        
+        # Состояние инкрементальной синхронизации
+        self.state_file = os.environ.get("SYNC_STATE_FILE", "sync_state.json")
+        self.full_sync = os.environ.get("FULL_SYNC", "").lower() in ("1", "true", "yes")
         
         logging.info("✅ Подключения к Тинькофф и Supabase настроены")
     
-    def создать_таблицу_supabase(self) -> None:
-        """Создание таблицы в Supabase"""
+    def создать_таблицу_supabase(self) -> bool:
+        """Применение недостающих миграций схемы Supabase (см. migrations.py)
+
+        Без них upsert по (operation_id, date_msk) невозможен, поэтому при ошибке синхронизация останавливается.
+        """
         try:
-            sql = """
-            CREATE TABLE IF NOT EXISTS tinkoff_operations (
-                id SERIAL PRIMARY KEY,
-                operation_id VARCHAR(100) UNIQUE NOT NULL,
-                date_msk TIMESTAMP NOT NULL,
-                action VARCHAR(200) NOT NULL,
-                amount DECIMAL(15,2) NOT NULL,
-                currency VARCHAR(10) NOT NULL,
-                status VARCHAR(50) NOT NULL,
-                description TEXT,
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-            """
-            
-            self.supabase.rpc('exec_sql', {'sql': sql}).execute()
-            logging.info("✅ Таблица tinkoff_operations создана в Supabase")
+            версия = ensure_schema(self.supabase)
+            logging.info(f"✅ Схема Supabase актуальна (версия {версия})")
+            return True
             
         except Exception as e:
-            logging.warning(f"⚠️ Ошибка создания таблицы: {e}")
+            logging.error(f"❌ Ошибка миграции схемы: {e}")
+            return False
     
-    def получить_операции_тинькофф(self, days_back: int = 1000) -> List[Dict]:
-        """Получение операций из Тинькофф"""
-        try:
-            from zoneinfo import ZoneInfo
-            from decimal import Decimal, ROUND_HALF_UP
-            
-            # Импортируем функции из invest.py
-            from invest import build_date_range, _money_to_decimal_str, _rus_operation_type, _rus_operation_state
-            
-            start_date, end_date = build_date_range(days_back)
-            logging.info("Получение операций из Тинькофф с %s по %s", start_date, end_date)
-
-            with Client(self.invest_token) as client:
-                accounts = client.users.get_accounts().accounts
-                if not accounts:
-                    raise RuntimeError("No Tinkoff Invest accounts available for the token")
+    def получить_операции_тинькофф(
+        self, days_back: int = 1000, watermarks: Optional[Dict[str, str]] = None
+    ) -> Optional[List[Dict]]:
+        """Получение операций из Тинькофф по всем счетам (инкрементально, если переданы водяные знаки)
 
-                account_id = accounts[0].id
-                operations = client.operations.get_operations(
-                    account_id=account_id,
-                    from_=start_date,
-                    to=end_date,
-                )
-
-                операции = []
-                msk = ZoneInfo("Europe/Moscow")
-                
-                for op in operations.operations:
-                    # Генерация ID операции
-                    op_id = (
-                        getattr(op, "id", None)
-                        or getattr(op, "operation_id", None)
-                        or getattr(op, "trade_id", None)
-                    )
-                    if not op_id:
-                        fingerprint = (
-                            f"{getattr(op, 'date', '')}|{getattr(op, 'type', '')}|"
-                            f"{getattr(op, 'currency', '')}|{getattr(op, 'payment', '')}|"
-                            f"{getattr(op, 'status', '')}|{getattr(op, 'description', '')}"
-                        )
-                        op_id = str(abs(hash(fingerprint)))
-
-                    # Обработка даты
-                    raw_dt = getattr(op, "date", None)
-                    if isinstance(raw_dt, datetime):
-                        try:
-                            local_dt = raw_dt.astimezone(msk)
-                        except Exception:
-                            local_dt = raw_dt
-                        date_str = local_dt.strftime("%Y-%m-%d %H:%M:%S")
-                    else:
-                        date_str = str(raw_dt)
-
-                    amount_str = _money_to_decimal_str(getattr(op, "payment", None))
-                    action_ru = _rus_operation_type(getattr(op, "type", ""))
-                    status_ru = _rus_operation_state(getattr(op, "status", ""))
-
-                    операции.append({
-                        "operation_id": str(op_id),
-                        "date_msk": date_str,
-                        "action": action_ru,
-                        "amount": float(amount_str),
-                        "currency": str(getattr(op, "currency", "")),
-                        "status": status_ru,
-                        "description": str(getattr(op, "description", ""))
-                    })
-
-                logging.info("Получено %d операций из Тинькофф", len(операции))
-                return операции
+        Возвращает None, если выгрузка не удалась: пустой список означает «новых операций нет».
+        """
+        try:
+            # Используем общую выгрузку из invest.py: счета опрашиваются параллельно
+            операции = fetch_operations(
+                self.invest_token,
+                days_back,
+                watermarks,
+                get_watermark_overlap(),
+                account_ids=get_account_ids(),
+                max_workers=get_fetch_concurrency(),
+            )
+            операции = [row_to_supabase(операция) for операция in операции]
+            
+            logging.info("Получено %d операций из Тинькофф", len(операции))
+            return операции
                 
         except Exception as e:
             logging.error(f"Ошибка получения операций из Тинькофф: {e}")
-            return []
+            return None
     
     def загрузить_в_supabase(self, операции: List[Dict]) -> int:
         """Загрузка операций в Supabase"""
@@ -142,14 +104,15 @@ class TinkoffToSupabase:
                 logging.warning("Нет операций для загрузки")
                 return 0
             
-            # Загружаем данные в Supabase (upsert - обновляем существующие)
-            result = self.supabase.table('tinkoff_operations').upsert(
-                операции, 
-                on_conflict='operation_id'
-            ).execute()
-            
-            загружено = len(result.data)
-            logging.info(f"✅ Загружено {загружено} операций в Supabase")
+            # Загружаем данные в Supabase пачками (upsert - обновляем существующие)
+            результат = upsert_rows(
+                self.supabase, операции,
+                batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency()
+            )
+            загружено = результат['loaded']
+            logging.info(f"✅ Загружено {загружено} операций в Supabase ({результат['rows_per_sec']:.0f} строк/с)")
+            logging.info(f"   новых: {результат['inserted']}, измененных: {результат['updated']}, "
+                         f"без изменений: {результат['unchanged']}")
             
             return загружено
             
@@ -158,22 +121,13 @@ class TinkoffToSupabase:
             return 0
     
     def получить_статистику(self) -> Dict:
-        """Получение статистики из Supabase"""
+        """Получение статистики из Supabase (серверный агрегат, без чтения таблицы)"""
         try:
-            result = self.supabase.table('tinkoff_operations').select('*', count='exact').execute()
-            total = result.count if result.count else 0
-            
-            last_op = self.supabase.table('tinkoff_operations').select('date_msk').order('date_msk', desc=True).limit(1).execute()
-            last_update = last_op.data[0]['date_msk'] if last_op.data else ''
-            
-            return {
-                'total': total,
-                'last_update': last_update
-            }
+            return fetch_stats(self.supabase)
             
         except Exception as e:
             logging.error(f"❌ Ошибка получения статистики: {e}")
-            return {'total': 0, 'last_update': ''}
+            return empty_stats()
     
     def синхронизировать(self) -> Dict:
         """Основная функция синхронизации"""
@@ -181,16 +135,36 @@ class TinkoffToSupabase:
             logging.info("🔄 Начинаем синхронизацию Тинькофф → Supabase")
             
             # Создаем таблицу
-            self.создать_таблицу_supabase()
+            if not self.создать_таблицу_supabase():
+                return {'status': 'error', 'message': 'Ошибка миграции схемы Supabase'}
+            
+            # Водяные знаки: локальный файл, иначе max(date_msk) из Supabase
+            watermarks = None
+            if not self.full_sync:
+                watermarks = load_watermarks(self.state_file)
+                if not watermarks:
+                    try:
+                        watermarks = watermark_from_supabase(self.supabase)
+                    except Exception as e:
+                        logging.warning(f"⚠️ Не удалось получить водяной знак из Supabase: {e}")
             
             # Получаем операции из Тинькофф
-            операции = self.получить_операции_тинькофф()
+            операции = self.получить_операции_тинькофф(watermarks=watermarks)
+            if операции is None:
+                return {'status': 'error', 'message': 'Ошибка получения операций из Тинькофф'}
             
             if not операции:
-                return {'status': 'error', 'message': 'Не получено операций из Тинькофф'}
-            
-            # Загружаем в Supabase
-            загружено = self.загрузить_в_supabase(операции)
+                if watermarks:
+                    logging.info("Новых операций нет")
+                    загружено = 0
+                else:
+                    return {'status': 'error', 'message': 'Не получено операций из Тинькофф'}
+            else:
+                # Загружаем в Supabase
+                загружено = self.загрузить_в_supabase(операции)
+                # Водяной знак сдвигаем, только если прошли все пачки
+                if загружено == len(операции) and watermarks is not None:
+                    save_watermarks(self.state_file, watermarks)
             
             # Получаем статистику
             stats = self.получить_статистику()
@@ -201,6 +175,9 @@ class TinkoffToSupabase:
                 'loaded_operations': загружено,
                 'total_in_supabase': stats.get('total', 0),
                 'last_update': stats.get('last_update', ''),
+                'api_calls': get_rate_limiter().stats['calls'],
+                'api_waits': get_rate_limiter().stats['waits'],
+                'api_retries': get_rate_limiter().stats['retries'],
                 'sync_time': datetime.now().isoformat()
             }
             
@@ -240,6 +217,8 @@ def main():
         print(f"• Загружено в Supabase: {результат.get('loaded_operations', 0)}")
         print(f"• Всего в Supabase: {результат.get('total_in_supabase', 0)}")
         print(f"• Последнее обновление: {результат.get('last_update', 'N/A')}")
+        print(f"• Запросов к API Тинькофф: {результат.get('api_calls', 0)} "
+              f"(ожиданий квоты: {результат.get('api_waits', 0)}, повторов: {результат.get('api_retries', 0)})")
         
         if результат.get('status') == 'success':
             print("\n🎉 Синхронизация завершена успешно!")
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Простая загрузка данных из S3 в Supabase (без создания таблицы)
+Простая загрузка данных из S3 в Supabase
 """
 
 import os
 import csv
-from supabase import create_client
+
+from invest import row_to_supabase
+from migrations import ensure_schema
+from supabase_client import get_supabase_client
+from upsert_engine import get_upsert_batch_size, get_upsert_concurrency, upsert_rows
 
 
 def load_env_from_file(filename='config.env'):
@@ -25,40 +29,28 @@ def upload_to_supabase(csv_file):
     """Загрузка данных в Supabase"""
     try:
         # Подключение к Supabase
-        supabase = create_client(
-            os.environ.get("SUPABASE_URL"),
-            os.environ.get("SUPABASE_KEY")
-        )
+        supabase = get_supabase_client()
         
         print("✅ Подключение к Supabase установлено")
         
-        # Чтение CSV и загрузка в Supabase
-        supabase_data = []
+        # Upsert идет по (operation_id, date_msk): без миграций загрузка невозможна
+        версия = ensure_schema(supabase)
+        print(f"✅ Схема Supabase актуальна (версия {версия})")
         
+        # Чтение CSV и загрузка в Supabase
         with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                supabase_data.append({
-                    'operation_id': row['operation_id'],
-                    'date_msk': row['date_msk'],
-                    'action': row['action'],
-                    'amount': float(row['amount']),
-                    'currency': row['currency'],
-                    'status': row['status'],
-                    'description': row['description']
-                })
+            supabase_data = [row_to_supabase(row) for row in csv.DictReader(f)]
         
         print(f"📊 Прочитано {len(supabase_data)} операций из CSV")
         
-        # Загрузка данных
-        result = supabase.table('tinkoff_operations').upsert(
-            supabase_data, 
-            on_conflict='operation_id'
-        ).execute()
+        # Загрузка данных пачками
+        результат = upsert_rows(
+            supabase, supabase_data, batch_size=get_upsert_batch_size(), concurrency=get_upsert_concurrency()
+        )
         
-        print(f"✅ Загружено {len(result.data)} операций в Supabase")
+        print(f"✅ Загружено {результат['loaded']} операций в Supabase ({результат['rows_per_sec']:.0f} строк/с)")
         
-        return len(result.data)
+        return результат['loaded']
         
     except Exception as e:
         print(f"❌ Ошибка загрузки в Supabase: {e}")
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Загрузка строк в Supabase пачками
+Строки режутся на пачки по UPSERT_BATCH_SIZE и отправляются через пул из
+UPSERT_CONCURRENCY потоков, которые делят keep-alive соединения клиента.
+Упавшая пачка повторяется отдельно, а если не проходит — делится пополам.
+Строки, хеш которых совпадает с row_hash в таблице, не отправляются вовсе.
+Ключ конфликта — (operation_id, date_msk): он годится и для секционированной
+по date_msk таблицы (PARTITION_OPERATIONS=1), а поиск хешей ограничен датами
+пачки и читает только ее секции.
+С UPSERT_BACKEND=copy строки идут напрямую в Postgres через COPY (pg_copy.py).
+Пачки, не записанные и после повторов, можно сохранить в локальную очередь (outbox.py).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from postgrest.types import CountMethod, ReturnMethod
+
+if TYPE_CHECKING:
+    from outbox import Outbox
+
+DEFAULT_UPSERT_BATCH_SIZE = 500
+DEFAULT_UPSERT_CONCURRENCY = 4
+DEFAULT_UPSERT_RETRIES = 3
+# Меньше этого размера пачка не делится: ошибка, скорее всего, в самих строках
+MIN_SPLIT_BATCH = 25
+# Сколько ключей спрашивать за один запрос row_hash (фильтр in.(...) идет в URL)
+HASH_LOOKUP_CHUNK = 100
+HASH_COLUMN = "row_hash"
+# Уникальный ключ секционированной таблицы обязан включать ключ секционирования;
+# уникальность самого operation_id держит триггер (см. migrations.OPERATION_KEY_SQL)
+CONFLICT_COLUMNS = "operation_id,date_msk"
+PARTITION_COLUMN = "date_msk"
+UPSERT_BACKENDS = ("postgrest", "copy")
+
+
+def get_upsert_batch_size() -> int:
+    batch_size_str = os.environ.get("UPSERT_BATCH_SIZE", str(DEFAULT_UPSERT_BATCH_SIZE))
+    try:
+        return max(1, int(batch_size_str))
+    except ValueError:
+        raise RuntimeError("UPSERT_BATCH_SIZE must be an integer")
+
+
+def get_upsert_concurrency() -> int:
+    concurrency_str = os.environ.get("UPSERT_CONCURRENCY", str(DEFAULT_UPSERT_CONCURRENCY))
+    try:
+        return max(1, int(concurrency_str))
+    except ValueError:
+        raise RuntimeError("UPSERT_CONCURRENCY must be an integer")
+
+
+def get_upsert_backend() -> str:
+    backend = os.environ.get("UPSERT_BACKEND", "postgrest").lower() or "postgrest"
+    if backend not in UPSERT_BACKENDS:
+        raise RuntimeError(f"UPSERT_BACKEND must be one of: {', '.join(UPSERT_BACKENDS)}")
+    return backend
+
+
+def row_hash(row: Dict) -> str:
+    """Хеш нормализованных полей строки (без самого row_hash)"""
+    canonical = json.dumps(
+        {key: value for key, value in row.items() if key != HASH_COLUMN},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def new_counts() -> Dict[str, int]:
+    return {"inserted": 0, "updated": 0, "unchanged": 0}
+
+
+def split_changed(
+    batch: List[Dict], stored: Dict[str, Optional[str]], key: str, counts: Dict[str, int]
+) -> List[Dict]:
+    """Оставляет новые и измененные строки; stored — key → row_hash из таблицы"""
+    changed = []
+    for row in batch:
+        if row[key] not in stored:
+            counts["inserted"] += 1
+        elif stored[row[key]] != row[HASH_COLUMN]:
+            # В том числе строки, записанные до появления row_hash
+            counts["updated"] += 1
+        else:
+            counts["unchanged"] += 1
+            continue
+        changed.append(row)
+    return changed
+
+
+def lookup_key(on_conflict: str) -> str:
+    """Колонка, по которой сопоставляются хеши: первая колонка ключа конфликта"""
+    return on_conflict.split(",")[0].strip()
+
+
+def partition_bounds(rows: List[Dict], on_conflict: str) -> Optional[Tuple[str, str]]:
+    """Минимальная и максимальная date_msk строк, если таблица секционирована по ней"""
+    if PARTITION_COLUMN not in on_conflict.split(","):
+        return None
+    values = [row.get(PARTITION_COLUMN) for row in rows]
+    if not values or None in values:
+        return None
+    # date_msk всегда в формате YYYY-MM-DD HH:MM:SS, поэтому строки сравнимы
+    return min(values), max(values)
+
+
+def _stored_hashes(supabase, table: str, on_conflict: str, batch: List[Dict]) -> Dict[str, Optional[str]]:
+    key = lookup_key(on_conflict)
+    stored: Dict[str, Optional[str]] = {}
+    for i in range(0, len(batch), HASH_LOOKUP_CHUNK):
+        chunk = batch[i:i + HASH_LOOKUP_CHUNK]
+        query = supabase.table(table).select(f"{key},{HASH_COLUMN}").in_(key, [row[key] for row in chunk])
+        bounds = partition_bounds(chunk, on_conflict)
+        if bounds:
+            query = query.gte(PARTITION_COLUMN, bounds[0]).lte(PARTITION_COLUMN, bounds[1])
+        response = query.execute()
+        stored.update((row[key], row[HASH_COLUMN]) for row in response.data)
+    return stored
+
+
+def _batches(rows: Iterable[Dict], batch_size: int) -> Iterator[List[Dict]]:
+    batch: List[Dict] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _send(
+    supabase, table: str, on_conflict: str, batch: List[Dict], retries: int, skip_unchanged: bool
+) -> Tuple[Dict[str, int], int]:
+    """Отправляет пачку; возвращает счетчики и число записанных строк"""
+    attempt = 0
+    while True:
+        counts = new_counts()
+        try:
+            if skip_unchanged:
+                stored = _stored_hashes(supabase, table, on_conflict, batch)
+                changed = split_changed(batch, stored, lookup_key(on_conflict), counts)
+            else:
+                changed = batch
+                counts["updated"] = len(batch)
+            written = 0
+            if changed:
+                # return=minimal: в ответе только Content-Range со счетчиком, без строк
+                response = supabase.table(table).upsert(
+                    changed,
+                    on_conflict=on_conflict,
+                    returning=ReturnMethod.minimal,
+                    count=CountMethod.exact,
+                ).execute()
+                written = response.count if response.count is not None else len(changed)
+            return counts, written
+        except Exception as exc:  # noqa: BLE001
+            if attempt >= retries:
+                raise
+            delay = random.uniform(0, min(10.0, 0.5 * (2 ** attempt)))
+            logging.warning(
+                "Upsert of %d rows into %s failed (%s), retry %d/%d in %.1fs",
+                len(batch), table, exc, attempt + 1, retries, delay,
+            )
+            attempt += 1
+            time.sleep(delay)
+
+
+def upsert_rows(
+    supabase,
+    rows: Iterable[Dict],
+    table: str = "tinkoff_operations",
+    on_conflict: str = CONFLICT_COLUMNS,
+    batch_size: int = DEFAULT_UPSERT_BATCH_SIZE,
+    concurrency: int = DEFAULT_UPSERT_CONCURRENCY,
+    retries: int = DEFAULT_UPSERT_RETRIES,
+    skip_unchanged: bool = True,
+    backend: Optional[str] = None,
+    outbox: Optional["Outbox"] = None,
+) -> Dict[str, float]:
+    """Upsert rows пачками через пул потоков.
+
+    rows читаются лениво: в памяти одновременно не больше ``concurrency`` пачек,
+    поэтому сюда можно передавать генератор по CSV. Каждой строке проставляется
+    row_hash; при ``skip_unchanged`` перед отправкой пачки из таблицы читаются
+    хеши тех же ключей, и отправляются только новые и измененные строки.
+    Возвращает loaded (новые, измененные и неизмененные), failed, queued, inserted,
+    updated, unchanged, batches, seconds и rows_per_sec.
+
+    ``backend`` (по умолчанию UPSERT_BACKEND) выбирает PostgREST или COPY в
+    Postgres; результат у обоих одинаковый, supabase для COPY не используется.
+
+    С ``outbox`` незаписанные пачки сохраняются в локальную очередь и считаются
+    и в failed, и в queued. Пока в очереди есть пачки прошлых запусков, новые
+    строки только дописываются за ними: иначе повтор старой пачки перезаписал
+    бы более новую версию тех же строк.
+    """
+    hashed = ({**row, HASH_COLUMN: row_hash(row)} for row in rows)
+    if outbox is not None and outbox.pending():
+        queued = outbox.extend(table, on_conflict, _batches(hashed, max(1, batch_size)))
+        logging.warning("Outbox is not empty, queued %d rows for %s behind it", queued, table)
+        return {
+            "loaded": 0, "failed": queued, "queued": queued, **new_counts(),
+            "batches": 0, "seconds": 0.0, "rows_per_sec": 0.0,
+        }
+
+    on_failed = (lambda batch: outbox.append(table, on_conflict, batch)) if outbox is not None else None
+    if (backend or get_upsert_backend()) == "copy":
+        from pg_copy import copy_rows, get_copy_batch_size
+
+        # COPY выгоднее большими пачками; изменения отбирает сам MERGE по row_hash
+        return copy_rows(
+            _batches(hashed, get_copy_batch_size()), table, on_conflict, HASH_COLUMN, retries, on_failed=on_failed
+        )
+
+    result: Dict[str, float] = {
+        "loaded": 0, "failed": 0, "queued": 0, **new_counts(), "batches": 0, "seconds": 0.0, "rows_per_sec": 0.0
+    }
+    started = time.monotonic()
+    source = _batches(hashed, max(1, batch_size))
+    workers = max(1, concurrency)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < workers:
+                batch = next(source, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                pending[pool.submit(_send, supabase, table, on_conflict, batch, retries, skip_unchanged)] = batch
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                result["batches"] += 1
+                try:
+                    counts, written = future.result()
+                    for name, count in counts.items():
+                        result[name] += count
+                    result["loaded"] += counts["unchanged"] + written
+                except Exception as exc:  # noqa: BLE001
+                    if len(batch) >= 2 * MIN_SPLIT_BATCH:
+                        # Лимит размера запроса или statement timeout: половины могут пройти
+                        middle = len(batch) // 2
+                        logging.warning("Splitting failed batch of %d rows into %s: %s", len(batch), table, exc)
+                        for part in (batch[:middle], batch[middle:]):
+                            pending[pool.submit(
+                                _send, supabase, table, on_conflict, part, retries, skip_unchanged
+                            )] = part
+                        continue
+                    logging.error("Failed to upsert %d rows into %s: %s", len(batch), table, exc)
+                    result["failed"] += len(batch)
+                    if on_failed is not None:
+                        on_failed(batch)
+                        result["queued"] += len(batch)
+
+    result["seconds"] = time.monotonic() - started
+    if result["seconds"] > 0:
+        result["rows_per_sec"] = result["loaded"] / result["seconds"]
+    logging.info(
+        "Upserted %d rows into %s in %d batches (%d new, %d changed, %d unchanged, %d failed), %.1fs, %.0f rows/s",
+        result["loaded"], table, result["batches"], result["inserted"], result["updated"], result["unchanged"],
+        result["failed"], result["seconds"], result["rows_per_sec"],
+    )
+    return result